@@ -1,14 +1,27 @@
 import rasterio
-from rasterio.mask import mask
 from shapely.geometry import mapping
 import numpy as np
-import pandas as pd
 from tqdm.auto import tqdm
 import os
+from functools import partial
 import geopandas as gpd
+import pandas as pd
 
 
 from ..utils import extractDateFromFilename, loadTiff
+from .checkpoint import Checkpoint, retryAggregation
+from .mask_cache import MaskCache
+from .output_sink import getOutputSink
+from .raster_cube import load_cube
+from .raster_io import GeometryReader, ReadStats, read_window
+from .result_builder import ResultBuilder, zone_attributes
+from .run_manifest import incrementalRun, runSignature
+from .zone_index import (
+    buildZoneIndex, parse_statistic, zonal_mean, zonal_statistics, zonal_sum)
+
+
+# Default bytes of raster data stacked by one batched task
+BATCH_MEMORY_BUDGET = 256 * 1024 ** 2
 
 
 def process_and_aggregate_raster(
@@ -20,7 +33,10 @@ def process_and_aggregate_raster(
     mask_path=None,
     calculation_mode="overall_mean",
     predictor_name="Value",
-    all_touched=False
+    all_touched=False,
+    io_mode="geometry",
+    read_stats=None,
+    mask_cache=None
 ):
     """
     Processes a single raster for aggregation into shapefile geometries.
@@ -34,29 +50,93 @@ def process_and_aggregate_raster(
         calculation_mode (str): Mode of calculation ('overall_mean', 'weighted_mean', or 'filtered_mean').
         predictor_name (str): Column name for the output data.
         all_touched (bool): Consider all pixels that touch geometry for masking.
+        io_mode (str): 'geometry' reads every geometry window separately, 'window' reads the
+            union window of all geometries, and of the mask, once per raster.
+        read_stats (ReadStats, optional): Counter recording the reads of the raster and mask.
+        mask_cache (MaskCache, optional): Mask loaded once per run, used instead of reading
+            the mask at mask_path again.
 
     Returns:
         list: Aggregated data for each geometry in the shapefile.
     """
 
+    date_str, zone_values = aggregate_raster_geometries(
+
+        raster_path,
+        shape_file.geometry,
+        invalid_values,
+        use_mask,
+        mask_path,
+        calculation_mode,
+        all_touched,
+        io_mode,
+        read_stats,
+        mask_cache
+    )
+
+    attributes = zone_attributes(shape_file).to_dict('records')
+
+    return zone_rows(date_str, zone_values, attributes, predictor_name)
+
+
+def aggregate_raster_geometries(
+
+    raster_path,
+    geometries,
+    invalid_values=None,
+    use_mask=False,
+    mask_path=None,
+    calculation_mode="overall_mean",
+    all_touched=False,
+    io_mode="geometry",
+    read_stats=None,
+    mask_cache=None
+):
+    """
+    Aggregates a single raster into every geometry, masking the geometries one by one.
+
+    Args:
+        raster_path (str): Path to the raster file.
+        geometries (GeoSeries): Geometries to aggregate into.
+        invalid_values (list, optional): Values to consider as invalid in raster.
+        use_mask (bool): If True, uses an additional mask for calculations.
+        mask_path (str, optional): Path to the mask file, required if use_mask is True.
+        calculation_mode (str): Mode of calculation ('overall_mean', 'weighted_mean', or 'filtered_mean').
+        all_touched (bool): Consider all pixels that touch geometry for masking.
+        io_mode (str): 'geometry' reads every geometry window separately, 'window' reads the
+            union window of all geometries, and of the mask, once per raster.
+        read_stats (ReadStats, optional): Counter recording the reads of the raster and mask.
+        mask_cache (MaskCache, optional): Mask loaded once per run.
+
+    Returns:
+        tuple: The date string of the raster and an array with one value per geometry.
+    """
+
     file_name = os.path.basename(raster_path)
     date_str = extractDateFromFilename(file_name)
-    aggregated_data = []
+    geoms = [mapping(shape) for shape in geometries]
+    zone_values = np.full(len(geoms), np.nan)
 
     with rasterio.open(raster_path) as src:
         no_data_value = src.nodata
-        geoms = [mapping(shape) for shape in shape_file.geometry]
 
         mask_no_data_value = None
         mask_src = None
+        mask_reader = None
+
+        if use_mask and mask_cache is not None:
+            mask_no_data_value = mask_cache.nodata
+            mask_reader = mask_cache
 
-        if use_mask and mask_path:
+        elif use_mask and mask_path:
             mask_src = rasterio.open(mask_path)
             mask_no_data_value = mask_src.nodata
+            mask_reader = GeometryReader(mask_src, geoms, io_mode, read_stats)
+
+        reader = GeometryReader(src, geoms, io_mode, read_stats)
 
         for index, geom in enumerate(geoms):
-            geom_mask, geom_transform = mask(
-                src, [geom], crop=True, all_touched=all_touched)
+            geom_mask = reader.crop(geom, all_touched=all_touched)
             geom_mask = geom_mask.astype('float32')
             geom_mask[geom_mask == no_data_value] = np.nan
 
@@ -64,9 +144,8 @@ def process_and_aggregate_raster(
                 for invalid_value in invalid_values:
                     geom_mask[geom_mask == invalid_value] = np.nan
 
-            if use_mask and mask_path and mask_src:
-                crop_mask, _ = mask(
-                    mask_src, [geom], crop=True, all_touched=all_touched)
+            if use_mask and mask_reader is not None:
+                crop_mask = mask_reader.crop(geom, all_touched=all_touched)
 
                 if calculation_mode == "weighted_mean":
                     valid_mask = (crop_mask[0] != mask_no_data_value)
@@ -84,15 +163,414 @@ def process_and_aggregate_raster(
             elif calculation_mode == "overall_mean" or not use_mask:
                 mean_value = np.nanmean(geom_mask)
 
-            new_row = {col: shape_file.iloc[index][col]
-                       for col in shape_file.columns if col != 'geometry'}
-            new_row.update({'date': date_str, predictor_name: mean_value})
-            aggregated_data.append(new_row)
+            zone_values[index] = mean_value
 
         if mask_src:
             mask_src.close()
 
-    return aggregated_data
+    return date_str, zone_values
+
+
+def process_and_aggregate_zones(
+
+    raster_path,
+    zone_index,
+    invalid_values=None,
+    use_mask=False,
+    mask_path=None,
+    calculation_mode="overall_mean",
+    read_stats=None,
+    mask_cache=None,
+    stats=None,
+    cube=None
+):
+    """
+    Aggregates a single raster into every zone of a precomputed zone index.
+
+    The raster, and the mask if used, are read once over the zone index window and
+    all zones are reduced in one vectorized pass.
+
+    Args:
+        raster_path (str): Path to the raster file.
+        zone_index (ZoneIndex): Zone index built on the grid of the raster.
+        invalid_values (list, optional): Values to consider as invalid in raster.
+        use_mask (bool): If True, uses an additional mask for calculations.
+        mask_path (str, optional): Path to the mask file, required if use_mask is True.
+        calculation_mode (str): Mode of calculation ('overall_mean', 'weighted_mean', or 'filtered_mean').
+        read_stats (ReadStats, optional): Counter recording the reads of the raster and mask.
+        mask_cache (MaskCache, optional): Mask with precomputed zone weights, loaded once per
+            run. Without it the mask at mask_path is read for this raster.
+        stats (list of str, optional): Statistics computed in the same pass, see
+            `zonal_statistics`. 'mean' is the mean of calculation_mode, the other statistics
+            use the pixels selected by calculation_mode.
+        cube (RasterCube, optional): Cube built from the raster directory, the raster window is
+            copied from it instead of reading the GeoTIFF.
+
+    Returns:
+        tuple: The date string of the raster and an array with one value per zone, or of
+        shape (n_zones, len(stats)) with stats.
+    """
+
+    file_name = os.path.basename(raster_path)
+    date_str = extractDateFromFilename(file_name)
+
+    block = np.empty((zone_index.window.height, zone_index.window.width), dtype='float32')
+    read_zone_block(raster_path, zone_index, block, invalid_values, read_stats, cube)
+
+    return date_str, reduce_zones(
+        zone_index.gather(block), zone_index, use_mask, mask_path, calculation_mode,
+        read_stats, mask_cache, stats)
+
+
+def process_and_aggregate_batch(
+
+    raster_paths,
+    zone_index,
+    invalid_values=None,
+    use_mask=False,
+    mask_path=None,
+    calculation_mode="overall_mean",
+    read_stats=None,
+    mask_cache=None,
+    stats=None,
+    cube=None
+):
+    """
+    Aggregates a batch of rasters into every zone, stacking them into one array.
+
+    The rasters are read over the zone index window into a (dates, height, width)
+    stack, and every zone reduction runs once over the whole stack instead of once
+    per raster.
+
+    Args:
+        raster_paths (list): Paths to the raster files of the batch.
+        zone_index (ZoneIndex): Zone index built on the grid of the rasters.
+        invalid_values (list, optional): Values to consider as invalid in raster.
+        use_mask (bool): If True, uses an additional mask for calculations.
+        mask_path (str, optional): Path to the mask file, required if use_mask is True.
+        calculation_mode (str): Mode of calculation ('overall_mean', 'weighted_mean', or 'filtered_mean').
+        read_stats (ReadStats, optional): Counter recording the reads of the rasters and mask.
+        mask_cache (MaskCache, optional): Mask with precomputed zone weights, loaded once per run.
+        stats (list of str, optional): Statistics computed in the same pass, see `zonal_statistics`.
+        cube (RasterCube, optional): Cube built from the raster directory, read instead of the GeoTIFFs.
+
+    Returns:
+        list: The date string and the zone values of every raster, as returned by
+        `process_and_aggregate_zones`.
+    """
+    stack = np.empty(
+        (len(raster_paths), zone_index.window.height, zone_index.window.width),
+        dtype='float32')
+
+    for position, raster_path in enumerate(raster_paths):
+        read_zone_block(
+            raster_path, zone_index, stack[position], invalid_values, read_stats, cube)
+
+    zone_values = reduce_zones(
+        zone_index.gather(stack), zone_index, use_mask, mask_path, calculation_mode,
+        read_stats, mask_cache, stats)
+
+    return [(extractDateFromFilename(os.path.basename(raster_path)), zone_values[position])
+            for position, raster_path in enumerate(raster_paths)]
+
+
+class RasterBatch():
+    """
+    A task aggregating consecutive rasters of a run stacked together.
+
+    Attributes:
+        positions (range): Positions of the rasters in the run.
+        raster_paths (list): Paths of the rasters.
+    """
+
+    def __init__(self, positions, raster_paths):
+
+        self.positions = positions
+        self.raster_paths = raster_paths
+
+    def __str__(self):
+        return f"{len(self.raster_paths)} rasters from {self.raster_paths[0]}"
+
+
+def batchSize(zone_index, n_rasters, max_workers=1, memory_budget=None):
+    """
+    Returns the number of rasters stacked per task fitting a memory budget.
+
+    Args:
+        zone_index (ZoneIndex): Zone index the rasters are read with.
+        n_rasters (int): Number of rasters of the run.
+        max_workers (int): Number of workers, every worker gets about four batches.
+        memory_budget (int, optional): Bytes a task may use, `BATCH_MEMORY_BUDGET` by default.
+
+    Returns:
+        int: The batch size, at least 1.
+    """
+    memory_budget = memory_budget if memory_budget else BATCH_MEMORY_BUDGET
+
+    # The float32 window and about three float64 copies of the gathered pixels per date
+    bytes_per_date = (zone_index.window.height * zone_index.window.width * 4
+                      + zone_index.indices.size * 8 * 3)
+    per_batch = -(-n_rasters // (max(max_workers, 1) * 4))
+
+    return int(max(min(memory_budget // max(bytes_per_date, 1), per_batch), 1))
+
+
+def read_zone_block(raster_path, zone_index, out, invalid_values=None, read_stats=None,
+                    cube=None):
+    """Reads a raster over the zone index window into out, with NaN for invalid pixels."""
+    # The cube already holds NaN for nodata
+    if cube is not None:
+        cube.read(raster_path, zone_index.window, out, read_stats)
+
+    else:
+        with rasterio.open(raster_path) as src:
+            zone_index.check_grid(src)
+            no_data_value = src.nodata
+            out[...] = read_window(src, zone_index.window, read_stats, indexes=1)
+
+        out[out == no_data_value] = np.nan
+
+    if invalid_values:
+        for invalid_value in invalid_values:
+            out[out == invalid_value] = np.nan
+
+
+def reduce_zones(values, zone_index, use_mask=False, mask_path=None,
+                 calculation_mode="overall_mean", read_stats=None, mask_cache=None,
+                 stats=None):
+    """Reduces gathered pixels of shape (..., n_pixels) following the calculation mode."""
+    has_mask = mask_cache is not None or mask_path
+
+    if not (use_mask and has_mask) or calculation_mode not in ("weighted_mean", "filtered_mean"):
+        if stats:
+            return zonal_statistics(values, zone_index, stats)
+
+        return zonal_mean(values, zone_index)
+
+    if mask_cache is None:
+        mask_cache = MaskCache.from_raster(
+            mask_path, zone_index, read_stats=read_stats)
+
+    if calculation_mode == "weighted_mean":
+        weight_sum = mask_cache.weight_sum
+        weighted_sum = zonal_sum(values * mask_cache.weights, zone_index)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_value = np.where(
+                weight_sum > 0, weighted_sum / weight_sum, np.nan)
+
+    else:
+        masked_data = np.where(mask_cache.valid, values, np.nan)
+        mean_value = np.where(
+            zonal_sum(masked_data, zone_index) > 0,
+            zonal_mean(masked_data, zone_index), np.nan)
+
+    if stats:
+        zone_values = zonal_statistics(
+            np.where(mask_cache.valid, values, np.nan), zone_index, stats)
+
+        if "mean" in stats:
+            zone_values[..., list(stats).index("mean")] = mean_value
+
+        return zone_values
+
+    return mean_value
+
+
+def zone_rows(date_str, zone_values, attributes, predictor_name="Value"):
+    """
+    Builds output rows from the per-zone values of a single raster.
+
+    Args:
+        date_str (str): Date of the raster.
+        zone_values (ndarray): One aggregated value per zone.
+        attributes (list of dict): Attribute columns of every zone.
+        predictor_name (str): Column name for the output data.
+
+    Returns:
+        list: Aggregated data for each geometry in the shapefile.
+    """
+    return [
+        {**attribute, 'date': date_str, predictor_name: value}
+        for attribute, value in zip(attributes, zone_values)
+    ]
+
+
+def write_results(sink, results, attributes, n_dates):
+    """
+    Writes the first dates of a result builder to an output sink.
+
+    Args:
+        sink (OutputSink): The output to append to.
+        results (ResultBuilder): The builder holding the aggregated values.
+        attributes (DataFrame): Attribute columns of every zone.
+        n_dates (int): Number of date slots of the builder to write.
+    """
+    df = results.to_frame(attributes, dates=slice(0, n_dates))
+
+    # Counts are written as integers
+    for name in results.stat_names:
+        if pd.api.types.is_float_dtype(df[name]):
+            df[name] = df[name].round(3)
+
+    sink.write(df)
+
+
+def flush_results(sink, results, attributes, n_dates, paths, checkpoint=None):
+    """
+    Writes the first dates of a result builder to an output sink, then clears the builder.
+
+    Args:
+        sink (OutputSink): The output to append to.
+        results (ResultBuilder): The builder holding the aggregated values.
+        attributes (DataFrame): Attribute columns of every zone.
+        n_dates (int): Number of date slots of the builder to write.
+        paths (list): Path of the raster of every date slot.
+        checkpoint (Checkpoint, optional): Checkpoint saving the block before it is written.
+    """
+    # Saved first, so the checkpoint holds every row the output may contain
+    if checkpoint:
+        checkpoint.save_block(results, paths, n_dates)
+
+    write_results(sink, results, attributes, n_dates)
+    results.clear()
+
+
+def write_checkpoint(checkpoint, sink, attributes, stat_names, manifest=None,
+                     integer_columns=()):
+    """
+    Writes the blocks saved by an interrupted run to the output of the resumed run.
+
+    Args:
+        checkpoint (Checkpoint): Checkpoint of the interrupted run.
+        sink (OutputSink): The output to append to.
+        attributes (DataFrame): Attribute columns of every zone.
+        stat_names (list of str): Output column of every statistic.
+        manifest (RunManifest, optional): Manifest recording the rasters of the blocks.
+        integer_columns (list of str): Columns of the statistics holding whole numbers.
+    """
+    for _, paths, dates, values in checkpoint.blocks():
+        block = ResultBuilder(values.shape[0], len(dates), stat_names,
+                              integer_columns=integer_columns)
+        block.values[:] = values
+        block.set_dates(dates)
+        write_results(sink, block, attributes, len(dates))
+
+        if manifest:
+            for path, date in zip(paths, dates):
+                manifest.record(path, [date])
+
+
+def skip_raster(raster_path, error, checkpoint=None):
+    """
+    Reports a raster that failed to aggregate and is skipped.
+
+    Args:
+        raster_path (str): Path of the raster.
+        error (str): Error message of the last attempt.
+        checkpoint (Checkpoint, optional): Checkpoint listing the failed rasters.
+    """
+    print(f"{error}. Skipping the raster.")
+
+    if checkpoint:
+        checkpoint.record_failure(raster_path, error)
+
+
+def stat_columns(predictor_name, stats=None):
+    """
+    Returns the output column of every statistic.
+
+    Args:
+        predictor_name (str): Column name for the output data.
+        stats (list of str, optional): Statistics of the run, validated here.
+
+    Returns:
+        list: predictor_name alone without stats, else '{predictor_name}_{stat}' per statistic.
+    """
+    if not stats:
+        return [predictor_name]
+
+    for stat in stats:
+        parse_statistic(stat)
+
+    return [f"{predictor_name}_{stat}" for stat in stats]
+
+
+def count_columns(predictor_name, stats=None):
+    """Returns the output column of the 'count' statistic, see `stat_columns`."""
+    return [f"{predictor_name}_count"] if stats and "count" in stats else []
+
+
+def prepare_run(predictor_dir, shapefile_path, output_csv_path, engines, mask_path=None,
+                use_mask=False, invalid_values=None, calculation_mode="overall_mean",
+                predictor_name="Value", all_touched=False, engine="zone_index",
+                output_format="csv", coverage=False, stats=None, incremental=False,
+                manifest_path=None, checkpoint_dir=None, resume=False, cube_dir=None):
+    """
+    Validates the options shared by the aggregation runs and opens their output.
+
+    The checkpoint of the run is opened, and an incremental run only keeps the rasters
+    new or changed since the last run, see `incrementalRun`. The arguments follow
+    `conAggregate`.
+
+    Args:
+        engines (tuple of str): Engines supported by the run, 'mask' and zone engines.
+
+    Raises:
+        ValueError: If use_mask is True without mask_path, or an option is invalid.
+
+    Returns:
+        tuple: The zones, the raster paths to aggregate, the output sink, None when
+            every raster is up to date, the RunManifest and the Checkpoint, None when
+            unused.
+    """
+    predictor_paths = loadTiff(predictor_dir)
+    shape_file = gpd.read_file(shapefile_path)
+    zone_engines = " or ".join(f"'{name}'" for name in engines if name != "mask")
+
+    if use_mask and not mask_path:
+        raise ValueError("Mask path must be provided if use_mask is True.")
+
+    if engine not in engines:
+        raise ValueError(
+            f"Invalid engine: {engine}. Options are "
+            f"{', '.join(repr(name) for name in engines)}.")
+
+    if coverage and engine == "mask":
+        raise ValueError(f"coverage requires the {zone_engines} engine.")
+
+    if stats and engine == "mask":
+        raise ValueError(f"stats requires the {zone_engines} engine.")
+
+    if cube_dir and engine != "zone_index":
+        raise ValueError("cube_dir requires the 'zone_index' engine.")
+
+    if resume and not checkpoint_dir:
+        raise ValueError("resume requires a checkpoint_dir.")
+
+    run_options = dict(
+        invalid_values=invalid_values, calculation_mode=calculation_mode,
+        all_touched=all_touched, engine=engine, coverage=coverage, stats=stats)
+    mask_file = mask_path if use_mask else None
+    manifest = None
+    checkpoint = None
+
+    if checkpoint_dir:
+        checkpoint = Checkpoint(checkpoint_dir, runSignature(
+            shape_file, mask_file, output_format=output_format,
+            variable=predictor_name, **run_options), resume=resume)
+
+    if incremental:
+        # Rows appended by the interrupted run are rewritten from the checkpoint
+        manifest, predictor_paths, sink = incrementalRun(
+            predictor_paths, output_csv_path, output_format, predictor_name,
+            manifest_path, shape_file, mask_file,
+            stale_dates=checkpoint.dates() if checkpoint else (), **run_options)
+
+    else:
+        sink = getOutputSink(output_csv_path, output_format, variable=predictor_name)
+
+    return shape_file, predictor_paths, sink, manifest, checkpoint
 
 
 def conAggregate(
@@ -105,7 +583,22 @@ def conAggregate(
         invalid_values=None,
         calculation_mode="overall_mean",
         predictor_name="Value",
-        all_touched=False
+        all_touched=False,
+        engine="zone_index",
+        io_mode="geometry",
+        report_io=False,
+        output_format="csv",
+        write_every=100,
+        zone_cache_dir=None,
+        coverage=False,
+        stats=None,
+        incremental=False,
+        manifest_path=None,
+        checkpoint_dir=None,
+        resume=False,
+        retries=0,
+        skip_failed=False,
+        cube_dir=None
 ):
     """
     Aggregates raster values to polygons in a shapefile, optionally using a crop mask for weighted calculations.
@@ -117,6 +610,37 @@ def conAggregate(
         crop_mask_path (str, optional): Path to the crop mask raster, required if use_crop_mask is True.
         use_crop_mask (bool): Whether to use the crop mask for weighted aggregation.
         predictor_name (str): Column name for the aggregated values in the output CSV.
+        engine (str): 'zone_index' rasterizes the shapefile once and reduces all zones per raster
+            in one pass, 'mask' masks every geometry of every raster separately.
+        io_mode (str): For the 'mask' engine, 'geometry' reads every geometry window separately,
+            'window' reads the union window of all geometries once per raster.
+        report_io (bool): Print the number of raster reads and bytes read at the end of the run.
+        output_format (str): 'csv', 'parquet' (partitioned by year and variable) or 'feather'.
+        write_every (int): Number of rasters aggregated before their rows are appended to the output.
+        zone_cache_dir (str, optional): Directory of a persistent zone index cache, so runs with the
+            same shapefile and grid skip the rasterization. Disabled by default.
+        coverage (bool): With the 'zone_index' engine, weight every pixel by the exact fraction of its
+            area covered by the geometry, computed once per zone. In 'weighted_mean' mode the
+            fractions multiply the mask weights.
+        stats (list of str, optional): With the 'zone_index' engine, statistics computed in one pass
+            over every raster, e.g. ['mean', 'min', 'max', 'std', 'count', 'p90'], written as one
+            '{predictor_name}_{stat}' column each. 'mean' follows calculation_mode.
+        incremental (bool): Only aggregate the rasters that are new or changed since the last
+            incremental run into the same output, and merge their rows into it. The rasters are
+            tracked in a run manifest, and every raster is aggregated again when the shapefile,
+            the mask or an option changes.
+        manifest_path (str, optional): Path of the run manifest, '{output_csv_path}.manifest.json'
+            by default.
+        checkpoint_dir (str, optional): Directory where every block of write_every rasters is
+            saved once aggregated, so an interrupted run can be resumed. Deleted once the run
+            finishes.
+        resume (bool): Resume the interrupted run of the same options from checkpoint_dir: its
+            saved blocks are written to the output and their rasters are skipped.
+        retries (int): Number of times a raster failing to aggregate is attempted again.
+        skip_failed (bool): Skip the rasters that still fail after the retries instead of
+            stopping the run. They are listed in '{checkpoint_dir}/failed.json' with a checkpoint.
+        cube_dir (str, optional): With the 'zone_index' engine, directory of a cube built from
+            predictor_dir with `buildCube`, read memory-mapped instead of the GeoTIFFs.
 
     Raises:
         ValueError: If use_crop_mask is True but crop_mask_path is not provided.
@@ -125,31 +649,111 @@ def conAggregate(
     writing the results to a CSV file. If a crop mask is used, values are aggregated using weights from
     the mask; otherwise, simple averaging is applied.
     """
-    predictor_paths = loadTiff(predictor_dir)
-    data_list = []
-
-    shape_file = gpd.read_file(shapefile_path)
-
-    if use_mask and not mask_path:
-        raise ValueError("Mask path must be provided if use_mask is True.")
-
-    for raster_path in tqdm(predictor_paths, desc="Processing rasters", unit="raster"):
-
-        # Directly call the processing function for each raster
-        data = process_and_aggregate_raster(
-
-            raster_path,
-            shape_file,
-            invalid_values,
-            use_mask,
-            mask_path,
-            calculation_mode,
-            predictor_name,
-            all_touched
-        )
-
-        data_list.extend(data)
+    read_stats = ReadStats()
+
+    shape_file, predictor_paths, sink, manifest, checkpoint = prepare_run(
+        predictor_dir, shapefile_path, output_csv_path, ("zone_index", "mask"),
+        mask_path=mask_path, use_mask=use_mask, invalid_values=invalid_values,
+        calculation_mode=calculation_mode, predictor_name=predictor_name,
+        all_touched=all_touched, engine=engine, output_format=output_format,
+        coverage=coverage, stats=stats, incremental=incremental,
+        manifest_path=manifest_path, checkpoint_dir=checkpoint_dir, resume=resume,
+        cube_dir=cube_dir)
+
+    if sink is None:
+        print("Every raster is up to date, nothing to aggregate.")
+        return output_csv_path
+
+    try:
+        attributes = zone_attributes(shape_file)
+        stat_names = stat_columns(predictor_name, stats)
+        integer_columns = count_columns(predictor_name, stats)
+
+        if checkpoint:
+            write_checkpoint(
+                checkpoint, sink, attributes, stat_names, manifest, integer_columns)
+            predictor_paths = [
+                path for path in predictor_paths if path not in checkpoint.completed]
+
+        mask_cache = None
+        block_size = max(min(write_every, len(predictor_paths)), 1)
+        results = ResultBuilder(len(shape_file), block_size, stat_names,
+                                integer_columns=integer_columns)
+        block_paths = [None] * block_size
+
+        # Nothing is left to aggregate when the checkpoint holds every raster
+        if not predictor_paths:
+            aggregate = None
+
+        elif engine == "zone_index":
+            zone_index = buildZoneIndex(
+                predictor_paths[0], shape_file, all_touched=all_touched,
+                cache_dir=zone_cache_dir, coverage=coverage)
+
+            if use_mask:
+                mask_cache = MaskCache.from_raster(
+                    mask_path, zone_index, read_stats=read_stats)
+
+            cube = load_cube(cube_dir, zone_index, predictor_paths) if cube_dir else None
+
+            aggregate = partial(
+                process_and_aggregate_zones, zone_index=zone_index,
+                invalid_values=invalid_values, use_mask=use_mask, mask_path=mask_path,
+                calculation_mode=calculation_mode, read_stats=read_stats,
+                mask_cache=mask_cache, stats=stats, cube=cube)
+
+        else:
+            if use_mask:
+                mask_cache = MaskCache.from_raster(
+                    mask_path, shape_file=shape_file, read_stats=read_stats)
+
+            aggregate = partial(
+                aggregate_raster_geometries, geometries=shape_file.geometry,
+                invalid_values=invalid_values, use_mask=use_mask, mask_path=mask_path,
+                calculation_mode=calculation_mode, all_touched=all_touched,
+                io_mode=io_mode, read_stats=read_stats, mask_cache=mask_cache)
+
+        slot = 0
+
+        for raster_path in tqdm(predictor_paths, desc="Processing rasters", unit="raster"):
+
+            result, error = retryAggregation(
+                aggregate, raster_path, retries=retries, skip_failed=skip_failed)
+
+            if error:
+                skip_raster(raster_path, error, checkpoint)
+                continue
+
+            date_str, zone_values = result
+            results.set_date(slot, date_str, zone_values)
+            block_paths[slot] = raster_path
+            slot += 1
+
+            if manifest:
+                manifest.record(raster_path, [date_str])
+
+            # Append every finished block of rasters to the output
+            if slot == block_size:
+                flush_results(sink, results, attributes, slot, block_paths, checkpoint)
+                slot = 0
+
+        if slot:
+            flush_results(sink, results, attributes, slot, block_paths, checkpoint)
+
+    except BaseException:
+        # The partial output of a failed run never replaces the previous output
+        sink.abort()
+        raise
+
+    sink.close()
+
+    if manifest:
+        manifest.save()
+
+    if checkpoint:
+        checkpoint.close()
+
+    if report_io:
+        print(read_stats.report())
 
-    df = pd.DataFrame(data_list)
-    df[predictor_name] = df[predictor_name].round(3)
-    df.to_csv(output_csv_path, index=False)
+    return output_csv_path
@@ -0,0 +1,154 @@
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from ..utils import loadTiff
+from .aggregate_process import conAggregate
+from .executors import EXECUTORS
+from .parallel_clip_aggregate import parallelAggregate
+
+
+# Pixel size in degrees of the synthetic rasters
+SYNTHETIC_RESOLUTION = 0.01
+
+
+def syntheticArchive(directory, n_rasters=48, width=1024, height=1024, n_zones=64,
+                     block_size=256, seed=0):
+    """
+    Writes a synthetic archive of daily tiled GeoTIFFs with a mask and a grid of zones.
+
+    Args:
+        directory (str): Directory where the archive is written.
+        n_rasters (int): Number of daily rasters, from 2020-01-01.
+        width (int): Width of the rasters in pixels.
+        height (int): Height of the rasters in pixels.
+        n_zones (int): Number of square zones covering the rasters.
+        block_size (int): Tile size of the GeoTIFFs, a multiple of 16.
+        seed (int): Seed of the random values.
+
+    Returns:
+        tuple: The raster directory, the shapefile path and the mask path.
+    """
+    rng = np.random.default_rng(seed)
+    raster_dir = os.path.join(directory, "rasters")
+    os.makedirs(raster_dir, exist_ok=True)
+
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 1,
+        "dtype": "float32",
+        "crs": "EPSG:4326",
+        "transform": from_origin(
+            0, height * SYNTHETIC_RESOLUTION, SYNTHETIC_RESOLUTION, SYNTHETIC_RESOLUTION),
+        "nodata": -9999,
+        "tiled": True,
+        "blockxsize": block_size,
+        "blockysize": block_size,
+        "compress": "lzw"
+    }
+
+    first_day = date(2020, 1, 1)
+    for day in range(n_rasters):
+        file_name = f"synthetic_{first_day + timedelta(days=day):%Y%m%d}.tif"
+        with rasterio.open(os.path.join(raster_dir, file_name), "w", **profile) as dst:
+            dst.write(rng.random((height, width), dtype="float32") * 100, 1)
+
+    mask_path = os.path.join(directory, "mask.tif")
+    with rasterio.open(mask_path, "w", **profile) as dst:
+        dst.write(rng.random((height, width), dtype="float32"), 1)
+
+    # Square zones in rows and columns covering the rasters
+    side = int(np.ceil(np.sqrt(n_zones)))
+    zone_width = width * SYNTHETIC_RESOLUTION / side
+    zone_height = height * SYNTHETIC_RESOLUTION / side
+    zones = [
+        box(col * zone_width, row * zone_height,
+            (col + 1) * zone_width, (row + 1) * zone_height)
+        for row in range(side) for col in range(side)][:n_zones]
+
+    shapefile_path = os.path.join(directory, "zones.shp")
+    gpd.GeoDataFrame(
+        {"NAME": [f"zone_{index}" for index in range(len(zones))]},
+        geometry=zones, crs="EPSG:4326").to_file(shapefile_path)
+
+    return raster_dir, shapefile_path, mask_path
+
+
+def benchmarkExecutors(directory=None, executors=("serial", "thread", "process"),
+                       max_workers=None, repeat=1, use_mask=True, engine="zone_index",
+                       **archive_options):
+    """
+    Times the aggregation of a synthetic archive serially and with every executor.
+
+    The same archive is aggregated with `conAggregate` for 'serial' and with
+    `parallelAggregate` for the executors, to compare them on the disk, cores and
+    raster sizes of the machine.
+
+    Args:
+        directory (str, optional): Directory where the archive is written and kept. A temporary
+            directory, deleted afterwards, by default.
+        executors (tuple of str): 'serial' and the executors to time, 'process', 'thread' or 'dask'.
+        max_workers (int, optional): Number of workers, defaults to all cores but one.
+        repeat (int): Number of runs of every executor, the fastest is kept.
+        use_mask (bool): Aggregate with the mask in 'weighted_mean' mode, else 'overall_mean'.
+        engine (str): 'zone_index' or 'mask'.
+        **archive_options: Options of the archive, see `syntheticArchive`.
+
+    Raises:
+        ValueError: If an executor is not one of the options.
+
+    Returns:
+        DataFrame: The executor, its time in seconds and rasters per second, fastest first.
+    """
+    for executor in executors:
+        if executor != "serial" and executor not in EXECUTORS:
+            raise ValueError(
+                f"Invalid executor: {executor}. Options are 'serial', 'process', 'thread', 'dask'.")
+
+    temporary = None if directory else tempfile.TemporaryDirectory(prefix="earthstat_benchmark_")
+    directory = directory if directory else temporary.name
+    calculation_mode = "weighted_mean" if use_mask else "overall_mean"
+
+    try:
+        raster_dir, shapefile_path, mask_path = syntheticArchive(directory, **archive_options)
+        n_rasters = len(loadTiff(raster_dir))
+        rows = []
+
+        for executor in executors:
+            output_path = os.path.join(directory, f"benchmark_{executor}.csv")
+            seconds = []
+
+            for _ in range(repeat):
+                start = time.perf_counter()
+
+                if executor == "serial":
+                    conAggregate(
+                        raster_dir, shapefile_path, output_path, mask_path, use_mask,
+                        calculation_mode=calculation_mode, engine=engine)
+                else:
+                    parallelAggregate(
+                        raster_dir, shapefile_path, output_path, mask_path, use_mask,
+                        calculation_mode=calculation_mode, max_workers=max_workers,
+                        engine=engine, executor=executor)
+
+                seconds.append(time.perf_counter() - start)
+                os.remove(output_path)
+
+            rows.append({"executor": executor, "seconds": min(seconds),
+                         "rasters_per_second": n_rasters / min(seconds)})
+
+    finally:
+        if temporary:
+            temporary.cleanup()
+
+    return pd.DataFrame(rows).sort_values("seconds").reset_index(drop=True)
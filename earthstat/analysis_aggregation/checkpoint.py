@@ -0,0 +1,146 @@
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+class Checkpoint():
+    """
+    Spills the completed blocks of an aggregation run to a directory, to resume it after a crash.
+
+    Every block of rasters written to the output is also saved as a `.npz` file
+    with the raster paths, the dates and the values of the block. A resumed run
+    writes the saved blocks to its output first and skips their rasters. Rasters
+    that failed and were skipped are listed in `failed.json`.
+
+    Attributes:
+        checkpoint_dir (str): Directory of the saved blocks.
+        signature (str): Signature of the run, see `runSignature`. Blocks of a run
+            with another signature are discarded.
+        completed (set): Paths of the rasters of the saved blocks.
+        failed (dict): Error message of every failed raster, keyed by path.
+    """
+
+    def __init__(self, checkpoint_dir, signature, resume=False):
+
+        self.checkpoint_dir = checkpoint_dir
+        self.signature = signature
+        self.failed = {}
+
+        if not resume or self._saved_signature() != signature:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        with open(os.path.join(checkpoint_dir, "checkpoint.json"), "w") as f:
+            json.dump({"signature": signature}, f)
+
+        self._block_paths = sorted(
+            glob.glob(os.path.join(checkpoint_dir, "block-*.npz")))
+        self.completed = {
+            path for _, paths, _, _ in self.blocks() for path in paths}
+
+    def _saved_signature(self):
+        try:
+            with open(os.path.join(self.checkpoint_dir, "checkpoint.json")) as f:
+                return json.load(f).get("signature")
+
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def blocks(self):
+        """
+        Iterates over the saved blocks in the order they were written.
+
+        Yields:
+            tuple: The block number, the raster paths, the dates and the values of shape
+                (n_zones, n_dates, n_stats) of every block.
+        """
+        for number, block_path in enumerate(self._block_paths):
+            with np.load(block_path, allow_pickle=False) as block:
+                yield (number, [str(path) for path in block["paths"]],
+                       [str(date) for date in block["dates"]], block["values"])
+
+    def dates(self):
+        """
+        Returns the dates of the saved blocks.
+
+        Returns:
+            set: Date labels of the rows already written by the interrupted run.
+        """
+        return {date for _, _, dates, _ in self.blocks() for date in dates}
+
+    def save_block(self, results, paths, n_dates):
+        """
+        Saves the first dates of a result builder as the next block.
+
+        Args:
+            results (ResultBuilder): The builder holding the aggregated values.
+            paths (list): Path of the raster of every date slot.
+            n_dates (int): Number of date slots of the builder to save.
+        """
+        block_path = os.path.join(
+            self.checkpoint_dir, f"block-{len(self._block_paths):06d}.npz")
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=self.checkpoint_dir)
+
+        # Written to a temporary file first, so a crash never leaves a partial block
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, paths=np.array(paths[:n_dates], dtype=str),
+                     dates=np.array(results.dates[:n_dates], dtype=str),
+                     values=results.values[:, :n_dates, :])
+
+        os.replace(tmp_path, block_path)
+        self._block_paths.append(block_path)
+        self.completed.update(paths[:n_dates])
+
+    def record_failure(self, path, message):
+        """
+        Records a raster that failed and was skipped.
+
+        Args:
+            path (str): Path of the raster.
+            message (str): Error message of the last attempt.
+        """
+        self.failed[path] = message
+
+        with open(os.path.join(self.checkpoint_dir, "failed.json"), "w") as f:
+            json.dump(self.failed, f, indent=1)
+
+    def close(self):
+        """Deletes the saved blocks once the run finished, keeping the list of failed rasters."""
+        for block_path in self._block_paths:
+            os.remove(block_path)
+
+        self._block_paths = []
+
+        if not self.failed:
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+
+def retryAggregation(worker, raster_path, retries=0, skip_failed=False):
+    """
+    Calls an aggregation function on a raster, retrying it when it fails.
+
+    Args:
+        worker (callable): Function aggregating a raster path.
+        raster_path (str): Path of the raster.
+        retries (int): Number of attempts after the first failure.
+        skip_failed (bool): Return the error of the last attempt instead of raising it.
+
+    Returns:
+        tuple: The result of the worker and None, or None and the error message of the
+            last attempt once every attempt failed.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return worker(raster_path), None
+
+        except Exception as e:
+            if attempt == retries and not skip_failed:
+                raise
+            message = f"Failed to aggregate {raster_path}: {e!r}"
+
+    return None, message
@@ -0,0 +1,429 @@
+import collections
+import os
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing import Pool
+
+try:
+    from dask.distributed import Client, LocalCluster
+    from dask.distributed import as_completed as dask_as_completed
+    dask_available = True
+
+except ImportError:
+    dask_available = False
+
+
+EXECUTORS = ("process", "thread", "dask")
+
+
+class TaskFeeder():
+    """
+    Feeds tasks to a pool while at most `max_in_flight` results are not consumed yet.
+
+    The pool pulls tasks from the feeder in its task-handler thread, which blocks
+    once the limit is reached until the consumer calls `task_done`. This keeps the
+    memory of queued and finished-but-unwritten results flat, whatever the number
+    of tasks.
+
+    Attributes:
+        tasks (list): The tasks to feed.
+        max_in_flight (int): Maximum number of submitted tasks not consumed yet.
+    """
+
+    def __init__(self, tasks, max_in_flight):
+
+        self.tasks = tasks
+        self.max_in_flight = max_in_flight
+        self._slots = threading.Semaphore(max_in_flight)
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        for indexed_task in enumerate(self.tasks):
+            while not self._slots.acquire(timeout=0.1):
+                if self._closed.is_set():
+                    return
+            yield indexed_task
+
+    def task_done(self):
+        """Releases the slot of a consumed result."""
+        self._slots.release()
+
+    def close(self):
+        """Stops feeding tasks, e.g. when the consumer fails."""
+        self._closed.set()
+
+
+def adaptive_chunksize(n_tasks, max_workers, max_in_flight=None):
+    """
+    Returns a pool chunksize giving every worker about four chunks.
+
+    Args:
+        n_tasks (int): Number of tasks.
+        max_workers (int): Number of worker processes.
+        max_in_flight (int, optional): Limit of tasks in flight the chunks must fit into.
+
+    Returns:
+        int: The chunksize, between 1 and 64.
+    """
+    chunksize = min(max(n_tasks // (max_workers * 4), 1), 64)
+
+    if max_in_flight:
+        chunksize = min(chunksize, max(max_in_flight // max_workers, 1))
+
+    return chunksize
+
+
+class AggregationExecutor():
+    """
+    Base class of the backends running the aggregation tasks of a run.
+
+    The state shared by every task, e.g. the zone index and the mask, is sent to
+    every worker once through `initializer(*initargs)`, which stores it in
+    `workerState()`, and tasks only carry their own arguments, e.g. a raster path.
+    Results are consumed as an iterator while at most `max_in_flight` of them are
+    pending, so memory stays flat whatever the number of tasks.
+
+    Attributes:
+        max_workers (int): Number of workers.
+        initializer (callable, optional): Called once per worker with initargs.
+        initargs (tuple): Arguments of the initializer.
+    """
+
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+
+        self.max_workers = max_workers if max_workers else default_workers()
+        self.initializer = initializer
+        self.initargs = initargs
+        # Key of the worker state of this executor, shared workers hold one per executor
+        self._token = uuid.uuid4().hex
+
+    def imap(self, function, tasks, ordered=True, max_in_flight=None, chunksize=None):
+        """
+        Runs a function on every task.
+
+        Args:
+            function (callable): Function of one task, picklable for the process and dask backends.
+            tasks (list): The tasks.
+            ordered (bool): Yield the results in task order, else in completion order.
+            max_in_flight (int, optional): Maximum number of tasks submitted but not consumed,
+                two per worker by default.
+            chunksize (int, optional): Tasks sent to a worker process at once.
+
+        Yields:
+            tuple: The position of the task and its result.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases the workers."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ProcessExecutor(AggregationExecutor):
+    """Runs the tasks in the worker processes of a local multiprocessing pool."""
+
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+
+        super().__init__(max_workers, initializer, initargs)
+        self._pool = Pool(processes=self.max_workers, initializer=_initialize,
+                          initargs=(self._token, initializer, initargs))
+        # Feeders of the running imap calls, closed before the pool is terminated
+        self._feeders = set()
+
+    def imap(self, function, tasks, ordered=True, max_in_flight=None, chunksize=None):
+        if not chunksize:
+            chunksize = adaptive_chunksize(len(tasks), self.max_workers, max_in_flight)
+
+        if not max_in_flight:
+            max_in_flight = 2 * self.max_workers * chunksize
+
+        # A chunk is only dispatched once all its tasks got a slot
+        feeder = TaskFeeder(tasks, max(max_in_flight, chunksize))
+        imap = self._pool.imap if ordered else self._pool.imap_unordered
+        self._feeders.add(feeder)
+
+        try:
+            for result in imap(_IndexedCall(function, self._token), feeder,
+                               chunksize=chunksize):
+                yield result
+                feeder.task_done()
+
+        finally:
+            feeder.close()
+            self._feeders.discard(feeder)
+
+    def close(self):
+        # The consumer may stop before the end of an imap, e.g. on a failed task, while
+        # the task handler waits for a slot: terminate joins it, so it is released first
+        for feeder in self._feeders:
+            feeder.close()
+
+        self._pool.terminate()
+        self._pool.join()
+
+
+class ThreadExecutor(AggregationExecutor):
+    """
+    Runs the tasks in threads of the current process.
+
+    The initializer is called once, its state is shared by every thread. Reads
+    and the NumPy reductions release the GIL, so threads avoid the start-up and
+    pickling costs of processes when the work is I/O bound.
+    """
+
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+
+        super().__init__(max_workers, initializer, initargs)
+        _initialize(self._token, initializer, initargs)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def imap(self, function, tasks, ordered=True, max_in_flight=None, chunksize=None):
+        max_in_flight = max_in_flight if max_in_flight else 2 * self.max_workers
+        indexed_tasks = iter(enumerate(tasks))
+        pending = collections.deque()
+
+        try:
+            for index, task in indexed_tasks:
+                pending.append(self._executor.submit(
+                    _call_indexed, self._token, function, index, task))
+                if len(pending) >= max_in_flight:
+                    break
+
+            while pending:
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    future = done.pop()
+                    pending.remove(future)
+
+                yield future.result()
+
+                # Every consumed result lets one more task in
+                next_task = next(indexed_tasks, None)
+                if next_task is not None:
+                    pending.append(self._executor.submit(
+                        _call_indexed, self._token, function, *next_task))
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        _drop_state(self._token)
+
+
+class DaskExecutor(AggregationExecutor):
+    """
+    Runs the tasks on the workers of a dask.distributed cluster, possibly across nodes.
+
+    The initializer arguments and the task function are scattered to every worker
+    once, and every worker calls the initializer before its first task of the
+    executor. Executors sharing a cluster keep their own worker state. The files
+    read by the tasks must be reachable by every worker at the same paths, e.g. on
+    a shared file system.
+
+    Attributes:
+        client (Client): The dask.distributed client.
+    """
+
+    def __init__(self, max_workers=None, initializer=None, initargs=(), client=None):
+
+        if not dask_available:
+            raise ImportError(
+                "The 'dask' executor requires dask.distributed. "
+                "Install it using 'pip install dask[distributed]'.")
+
+        super().__init__(max_workers, initializer, initargs)
+
+        # Without a client or scheduler address, a local cluster is started without network
+        if client is None:
+            self._cluster = LocalCluster(
+                n_workers=self.max_workers, threads_per_worker=1, processes=True,
+                dashboard_address=None)
+            self.client = Client(self._cluster)
+            self._own_client = True
+
+        elif isinstance(client, str):
+            self._cluster = None
+            self.client = Client(client)
+            self._own_client = True
+
+        else:
+            self._cluster = None
+            self.client = client
+            self._own_client = False
+
+        self._initargs = self.client.scatter(initargs, broadcast=True) if initargs else ()
+
+    def imap(self, function, tasks, ordered=True, max_in_flight=None, chunksize=None):
+        workers = len(self.client.scheduler_info().get("workers", {})) or self.max_workers
+        max_in_flight = max_in_flight if max_in_flight else 2 * workers
+        function = self.client.scatter(function, broadcast=True, hash=False)
+        indexed_tasks = iter(enumerate(tasks))
+        pending = collections.deque()
+        completed = dask_as_completed()
+
+        try:
+            for index, task in indexed_tasks:
+                self._submit(function, index, task, pending, completed)
+                if len(pending) >= max_in_flight:
+                    break
+
+            while pending:
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    future = next(completed)
+                    pending.remove(future)
+
+                yield future.result()
+
+                # Every consumed result lets one more task in
+                next_task = next(indexed_tasks, None)
+                if next_task is not None:
+                    self._submit(function, *next_task, pending, completed)
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _submit(self, function, index, task, pending, completed):
+        future = self.client.submit(
+            _dask_call, self._token, self.initializer, self._initargs,
+            function, index, task, pure=False)
+        pending.append(future)
+        completed.add(future)
+
+    def close(self):
+        # The workers of a cluster outliving the executor forget its state
+        if self.initializer and self._cluster is None:
+            self.client.run(_drop_state, self._token)
+
+        if self._own_client:
+            self.client.close()
+
+        if self._cluster is not None:
+            self._cluster.close()
+
+
+def getExecutor(executor="process", max_workers=None, initializer=None, initargs=(),
+                client=None):
+    """
+    Returns the aggregation executor of a backend.
+
+    Args:
+        executor (str): 'process' for a local process pool, 'thread' for a thread pool, or
+            'dask' for a dask.distributed cluster.
+        max_workers (int, optional): Number of workers, all cores but one by default. For
+            'dask', the number of workers of the local cluster started without client.
+        initializer (callable, optional): Called once per worker with initargs.
+        initargs (tuple): Arguments of the initializer, sent once per worker.
+        client (Client or str, optional): For 'dask', the client or the scheduler address of
+            the cluster. A LocalCluster is started by default.
+
+    Raises:
+        ValueError: If executor is not one of the options.
+
+    Returns:
+        AggregationExecutor: The executor, to close after use.
+    """
+    if executor == "process":
+        return ProcessExecutor(max_workers, initializer, initargs)
+
+    if executor == "thread":
+        return ThreadExecutor(max_workers, initializer, initargs)
+
+    if executor == "dask":
+        return DaskExecutor(max_workers, initializer, initargs, client=client)
+
+    raise ValueError(
+        f"Invalid executor: {executor}. Options are 'process', 'thread', 'dask'.")
+
+
+def default_workers():
+    """Returns all cores but one."""
+    return os.cpu_count() - 1 if os.cpu_count() > 1 else 1
+
+
+def workerState():
+    """
+    Returns the state of the executor running the current task.
+
+    Initializers store the options shared by the tasks in this dict, and task
+    functions read them back. Every executor has its own state, so the runs of
+    executors sharing worker processes, e.g. on a dask cluster, do not overwrite
+    each other's.
+
+    Returns:
+        dict: The worker state of the executor, or of the caller outside executors.
+    """
+    return _worker_states.setdefault(getattr(_current_run, "token", None), {})
+
+
+# Worker state of every executor in this process, by executor token
+_worker_states = {}
+_state_lock = threading.Lock()
+
+# Token of the executor of the task running in this thread
+_current_run = threading.local()
+
+
+class _IndexedCall():
+    """Picklable call of a task function returning the position of the task with the result."""
+
+    def __init__(self, function, token=None):
+
+        self.function = function
+        self.token = token
+
+    def __call__(self, indexed_task):
+        return _call_indexed(self.token, self.function, *indexed_task)
+
+
+def _call_indexed(token, function, index, task):
+    _current_run.token = token
+    return index, function(task)
+
+
+def _initialize(token, initializer, initargs):
+    """Calls the initializer of an executor once per process, in its worker state."""
+    with _state_lock:
+        if token in _worker_states:
+            return
+
+        previous = getattr(_current_run, "token", None)
+        _current_run.token = token
+
+        try:
+            if initializer:
+                initializer(*initargs)
+            _worker_states.setdefault(token, {})
+
+        except BaseException:
+            _worker_states.pop(token, None)
+            raise
+
+        finally:
+            _current_run.token = previous
+
+
+def _drop_state(token):
+    _worker_states.pop(token, None)
+
+
+def _dask_call(token, initializer, initargs, function, index, task):
+
+    # Tasks of several executors may run in the threads of a worker at once
+    if initializer and token not in _worker_states:
+        _initialize(token, initializer, initargs)
+
+    return _call_indexed(token, function, index, task)
@@ -0,0 +1,203 @@
+import json
+import os
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
+
+from .raster_io import pixel_window, read_window
+from .zone_index import zonal_sum
+
+
+class MaskCache():
+    """
+    A crop mask loaded once per aggregation run.
+
+    The mask never changes over the time series, so it is read once over the window
+    of the zones and reused for every raster. With a zone index, the valid-pixel
+    selector and the weight vector of every zone are precomputed as well. A cache
+    can be saved as `.npy` files and opened memory-mapped, so worker processes
+    share it read-only instead of reopening the GeoTIFF.
+
+    Attributes:
+        data (ndarray): Mask values over `window`.
+        window (Window): Window of the mask grid covered by `data`.
+        transform (Affine): Affine transform of the full mask grid.
+        shape (tuple): Height and width of the full mask grid.
+        nodata (float): Nodata value of the mask, or None.
+        valid (ndarray): Per-pixel valid selector aligned with the zone index, or None.
+        weights (ndarray): Per-pixel weights aligned with the zone index, 0 where invalid,
+            multiplied by the coverage fractions of the zone index if any.
+        weight_sum (ndarray): Sum of the weights of every zone.
+    """
+
+    _arrays = ("data", "valid", "weights", "weight_sum")
+
+    def __init__(self, data, window, transform, shape, nodata=None,
+                 valid=None, weights=None, weight_sum=None):
+
+        self.data = data
+        self.window = window
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.nodata = nodata
+        self.valid = valid
+        self.weights = weights
+        self.weight_sum = weight_sum
+
+    @classmethod
+    def from_raster(cls, mask_path, zone_index=None, shape_file=None, read_stats=None):
+        """
+        Reads a crop mask once and precomputes the zone selectors and weights.
+
+        Args:
+            mask_path (str): Path to the mask raster.
+            zone_index (ZoneIndex, optional): Zone index on the mask grid. The mask is
+                read over the zone index window and per-zone weights are precomputed.
+            shape_file (GeoDataFrame, optional): Without a zone index, the mask is read
+                over the union window of these geometries instead of entirely.
+            read_stats (ReadStats, optional): Counter recording the mask read.
+
+        Returns:
+            MaskCache: The loaded mask.
+        """
+        with rasterio.open(mask_path) as mask_src:
+
+            if zone_index is not None:
+                zone_index.check_grid(mask_src)
+                window = zone_index.window
+            elif shape_file is not None:
+                window = geometry_window(mask_src, list(shape_file.geometry))
+            else:
+                window = Window(0, 0, mask_src.width, mask_src.height)
+
+            data = read_window(mask_src, window, read_stats, indexes=1)
+            cache = cls(data, window, mask_src.transform,
+                        mask_src.shape, mask_src.nodata)
+
+        if zone_index is not None:
+            cache._compute_zone_weights(zone_index)
+
+        return cache
+
+    def _compute_zone_weights(self, zone_index):
+
+        zone_mask = zone_index.gather(self.data)
+        self.valid = zone_mask != self.nodata
+        self.weights = np.where(self.valid, zone_mask, 0).astype('float64')
+        self.weights[np.isnan(self.weights)] = 0
+
+        # Border pixels only weigh the fraction covered by their zone
+        if zone_index.coverage is not None:
+            self.weights *= zone_index.coverage
+
+        self.weight_sum = zonal_sum(self.weights, zone_index)
+
+    def crop(self, geom, all_touched=False):
+        """
+        Returns the mask pixels of a geometry, like `mask(mask_src, [geom], crop=True)`.
+
+        Args:
+            geom (dict): GeoJSON-like geometry.
+            all_touched (bool): Consider all pixels that touch geometry for masking.
+
+        Returns:
+            ndarray: Array of shape (1, height, width) of the geometry window.
+        """
+        window = pixel_window(geom, self.transform, self.shape)
+
+        if window is None:
+            raise ValueError('Input shapes do not overlap raster.')
+
+        row = int(window.row_off - self.window.row_off)
+        col = int(window.col_off - self.window.col_off)
+
+        if (row < 0 or col < 0 or row + window.height > self.window.height
+                or col + window.width > self.window.width):
+            raise ValueError("Geometry is outside of the cached mask window.")
+
+        out_image = self.data[row:row + window.height,
+                              col:col + window.width][np.newaxis].copy()
+        shape_mask = geometry_mask(
+            [geom], transform=rasterio.windows.transform(window, self.transform),
+            out_shape=(window.height, window.width), all_touched=all_touched)
+
+        out_image[:, shape_mask] = self.nodata if self.nodata is not None else 0
+
+        return out_image
+
+    def save(self, directory):
+        """
+        Saves the cache as `.npy` files that can be opened memory-mapped.
+
+        Args:
+            directory (str): Directory to write the cache into.
+
+        Returns:
+            str: The cache directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        for name in self._arrays:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(directory, f"{name}.npy"), array)
+
+        meta = {
+            "window": [int(self.window.col_off), int(self.window.row_off),
+                       int(self.window.width), int(self.window.height)],
+            "transform": list(self.transform)[:6],
+            "shape": list(self.shape),
+            "nodata": self.nodata,
+        }
+
+        with open(os.path.join(directory, "mask_cache.json"), "w") as f:
+            json.dump(meta, f)
+
+        return directory
+
+    @classmethod
+    def open(cls, directory, mmap_mode="r"):
+        """
+        Opens a cache saved with `save`, memory-mapped and read-only by default.
+
+        Args:
+            directory (str): Directory the cache was saved into.
+            mmap_mode (str, optional): Memory-map mode passed to `numpy.load`.
+
+        Returns:
+            MaskCache: The opened mask cache.
+        """
+        with open(os.path.join(directory, "mask_cache.json")) as f:
+            meta = json.load(f)
+
+        arrays = {}
+        for name in cls._arrays:
+            path = os.path.join(directory, f"{name}.npy")
+            arrays[name] = np.load(path, mmap_mode=mmap_mode) if os.path.exists(path) else None
+
+        return cls(
+            arrays["data"], Window(*meta["window"]), Affine(*meta["transform"]),
+            meta["shape"], meta["nodata"], arrays["valid"], arrays["weights"],
+            arrays["weight_sum"])
+
+
+_opened_caches = {}
+
+
+def open_mask_cache(directory):
+    """
+    Opens a saved mask cache once per process and reuses it for later tasks.
+
+    Args:
+        directory (str): Directory the cache was saved into.
+
+    Returns:
+        MaskCache: The memory-mapped mask cache.
+    """
+    if directory not in _opened_caches:
+        _opened_caches[directory] = MaskCache.open(directory)
+
+    return _opened_caches[directory]
@@ -0,0 +1,313 @@
+import os
+import glob
+import shutil
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    arrow_available = True
+
+except ImportError:
+    arrow_available = False
+
+
+OUTPUT_EXTENSIONS = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "feather": ".feather",
+}
+
+PARTITION_COLUMNS = ("year", "variable")
+
+
+class OutputSink():
+    """
+    Base class of the aggregation output writers.
+
+    A sink receives the output DataFrame block by block, as rasters or variables
+    finish, and appends every block to the output instead of building the full
+    DataFrame in memory first.
+
+    Rows are written to '{path}.partial', which only replaces the output at
+    `close`. A run failing or interrupted midway leaves the previous output
+    untouched, and a rewritten Parquet dataset keeps no partition of the previous one.
+
+    Attributes:
+        path (str): Path of the output file, or directory for Parquet.
+        rows_written (int): Number of rows written so far.
+        write_path (str): Path of the partial output the rows are written to.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.rows_written = 0
+        self.write_path = path.rstrip(os.sep) + ".partial"
+
+        # Leftovers of an interrupted run
+        _remove_output(self.write_path)
+
+    def write(self, frame):
+        """
+        Appends a block of rows to the output.
+
+        Args:
+            frame (DataFrame): The rows to append, with the same columns for every block.
+        """
+        if len(frame):
+            self._write(frame)
+            self.rows_written += len(frame)
+
+    def _write(self, frame):
+        raise NotImplementedError
+
+    def close(self):
+        """Finishes the partial output and replaces the previous output with it."""
+        self._close()
+
+        if os.path.exists(self.write_path):
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            os.replace(self.write_path, self.path)
+
+    def abort(self):
+        """Discards the partial output of a failed run, keeping the previous output."""
+        self._close()
+        _remove_output(self.write_path)
+
+    def _close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class CSVSink(OutputSink):
+    """
+    Writes the output as a CSV file, appending every block below the header.
+
+    Attributes:
+        append (bool): Append to an existing file, below its header, instead of replacing it.
+    """
+
+    def __init__(self, path, append=False):
+
+        super().__init__(path)
+        self.append = append and os.path.exists(path)
+
+        # The new rows are appended to a copy, the file is only replaced at close
+        if self.append:
+            shutil.copyfile(path, self.write_path)
+
+    def _write(self, frame):
+        started = self.rows_written or self.append
+        frame.to_csv(self.write_path, mode="a" if started else "w",
+                     header=not started, index=False)
+
+
+class FeatherSink(OutputSink):
+    """Writes the output as a Feather (Arrow IPC) file, one record batch per block."""
+
+    def __init__(self, path):
+
+        super().__init__(path)
+        self._writer = None
+        self._schema = None
+
+    def _write(self, frame):
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = pa.ipc.new_file(self.write_path, self._schema)
+
+        self._writer.write_table(table.cast(self._schema))
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class ParquetSink(OutputSink):
+    """
+    Writes the output as a Parquet dataset partitioned by year and variable.
+
+    Every block becomes one row group of the file of its partition, e.g.
+    ``output.parquet/year=2020/variable=fpar/part-0.parquet``. The year is taken
+    from the first four characters of the 'date' column.
+
+    Attributes:
+        variable (str): Value of the variable partition, or None to partition by year only.
+    """
+
+    def __init__(self, path, variable=None):
+
+        super().__init__(path)
+        self.variable = variable
+        self._writers = {}
+
+    def _write(self, frame):
+        years = frame['date'].astype(str).str[:4]
+
+        for year, block in frame.groupby(years.values, sort=False):
+            partition = [f"year={year}"]
+            if self.variable is not None:
+                partition.append(f"variable={self.variable}")
+
+            table = pa.Table.from_pandas(block, preserve_index=False)
+            key = tuple(partition)
+
+            if key not in self._writers:
+                directory = os.path.join(self.write_path, *partition)
+                os.makedirs(directory, exist_ok=True)
+                self._writers[key] = pq.ParquetWriter(
+                    os.path.join(directory, "part-0.parquet"), table.schema)
+
+            writer = self._writers[key]
+            writer.write_table(table.cast(writer.schema))
+
+    def _close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+def getOutputSink(output_path, output_format="csv", variable=None, append=False):
+    """
+    Returns the output sink of a format.
+
+    Args:
+        output_path (str): Path of the output file, or directory for Parquet.
+        output_format (str): 'csv', 'parquet' or 'feather'.
+        variable (str, optional): Variable name used as Parquet partition.
+        append (bool): Append to an existing CSV file instead of replacing it.
+
+    Raises:
+        ValueError: If append is set for another format than 'csv'.
+
+    Returns:
+        OutputSink: The sink writing to output_path.
+    """
+    _check_output_format(output_format)
+
+    if append and output_format != "csv":
+        raise ValueError("append is only supported for the 'csv' output format.")
+
+    if output_format == "csv":
+        return CSVSink(output_path, append=append)
+
+    if output_format == "feather":
+        return FeatherSink(output_path)
+
+    return ParquetSink(output_path, variable=variable)
+
+
+def outputPath(path, output_format="csv"):
+    """
+    Replaces the extension of an output path with the one of an output format.
+
+    Args:
+        path (str): Output path, with or without extension.
+        output_format (str): 'csv', 'parquet' or 'feather'.
+
+    Returns:
+        str: The output path with the extension of the format.
+    """
+    _check_output_format(output_format)
+    root, extension = os.path.splitext(path)
+
+    if extension not in OUTPUT_EXTENSIONS.values():
+        root = path
+
+    return root + OUTPUT_EXTENSIONS[output_format]
+
+
+def readOutput(path, output_format=None):
+    """
+    Reads an output written by a sink back into a DataFrame.
+
+    Args:
+        path (str): Path of the output file or Parquet directory.
+        output_format (str, optional): Output format, inferred from the extension by default.
+
+    Returns:
+        DataFrame: The output rows, without the Parquet partition columns.
+    """
+    if output_format is None:
+        output_format = outputFormat(path)
+
+    if output_format == "csv":
+        return pd.read_csv(path)
+
+    _check_output_format(output_format)
+
+    if output_format == "feather":
+        return pd.read_feather(path)
+
+    frame = pd.read_parquet(path)
+    return frame.drop(columns=[col for col in PARTITION_COLUMNS if col in frame.columns])
+
+
+def outputFormat(path):
+    """
+    Infers the output format of a path from its extension.
+
+    Args:
+        path (str): Output path.
+
+    Returns:
+        str: 'csv', 'parquet' or 'feather'.
+    """
+    extension = os.path.splitext(path.rstrip(os.sep))[1]
+
+    for output_format, format_extension in OUTPUT_EXTENSIONS.items():
+        if extension == format_extension:
+            return output_format
+
+    raise ValueError(f"Unknown output format of {path}.")
+
+
+def globOutputs(directory):
+    """
+    Lists the outputs of every format in a directory.
+
+    Args:
+        directory (str): Directory to search.
+
+    Returns:
+        list: Paths of the CSV, Feather and Parquet outputs found.
+    """
+    return sorted(
+        path for extension in OUTPUT_EXTENSIONS.values()
+        for path in glob.glob(f'{directory}/*{extension}'))
+
+
+def _remove_output(path):
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _check_output_format(output_format):
+
+    if output_format not in OUTPUT_EXTENSIONS:
+        raise ValueError(
+            f"Invalid output_format: {output_format}. "
+            "Options are 'csv', 'parquet', 'feather'.")
+
+    if output_format != "csv" and not arrow_available:
+        raise ImportError(
+            f"Writing {output_format} output requires pyarrow. "
+            "Install it using 'pip install pyarrow'.")
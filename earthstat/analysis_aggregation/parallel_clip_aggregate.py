@@ -1,102 +1,179 @@
 import os
-import geopandas as gpd
-import rasterio
-from rasterio.mask import mask
-import pandas as pd
-import numpy as np
+import tempfile
+from functools import partial
 from tqdm import tqdm
-# from concurrent.futures import ProcessPoolExecutor, as_completed
-from shapely.geometry import mapping
-from multiprocessing import Pool
-
-from ..utils import extractDateFromFilename, loadTiff
 
+from ..utils import extractDateFromFilename
+from .aggregate_process import (
+    RasterBatch, aggregate_raster_geometries, batchSize, count_columns, flush_results,
+    prepare_run, process_and_aggregate_batch, process_and_aggregate_zones, skip_raster,
+    stat_columns, write_checkpoint)
+from .checkpoint import retryAggregation
+from .executors import EXECUTORS, default_workers, getExecutor, workerState
+from .mask_cache import MaskCache, open_mask_cache
+from .raster_cube import load_cube
+from .raster_io import ReadStats
+from .result_builder import ResultBuilder, zone_attributes
+from .tile_scheduler import (
+    TILE_SIZE, TIME_BATCH, TilePlan, TileTask, ZonePartials, aggregate_tile,
+    check_mergeable, raster_block_shape, time_batches)
+from .zone_index import buildZoneIndex
+
+
+def init_worker(options, mask_cache=None, keywords=None, retries=0):
+    """
+    Worker initializer receiving the options shared by every task once per worker.
 
-def process_and_aggregate_raster(
+    The geometries or the zone index and the mask cache are sent to every worker
+    once instead of being pickled into every task, so tasks only carry a raster
+    path. They are kept in the worker state of the executor.
 
-        raster_path,
-        shape_file,
-        invalid_values=None,
-        use_mask=False,
-        mask_path=None,
-        calculation_mode="overall_mean",
-        predictor_name="Value",
-        all_touched=False
-):
+    Args:
+        options (tuple): Arguments of the aggregation function following the raster path.
+        mask_cache (MaskCache or str, optional): The mask cache, or the directory of a saved
+            MaskCache opened memory-mapped.
+        keywords (dict, optional): Keyword arguments of the aggregation function.
+        retries (int): Number of times a raster failing to aggregate is attempted again.
     """
-    Processes a single raster for aggregation into shapefile geometries.
+    state = workerState()
+    state["options"] = options
+    state["keywords"] = keywords or {}
+    state["retries"] = retries
+    state["mask_cache"] = (
+        open_mask_cache(mask_cache) if isinstance(mask_cache, str) else mask_cache)
+
+
+def process_wrapper(raster_path):
+    state = workerState()
+    read_stats = ReadStats()
+    result = aggregate_raster_geometries(
+        raster_path, *state["options"], read_stats=read_stats,
+        mask_cache=state["mask_cache"], **state["keywords"])
+    return result, read_stats
+
+
+def zones_wrapper(raster_path):
+    state = workerState()
+    read_stats = ReadStats()
+    result = process_and_aggregate_zones(
+        raster_path, *state["options"], read_stats=read_stats,
+        mask_cache=state["mask_cache"], **state["keywords"])
+    return result, read_stats
+
+
+def batch_wrapper(task):
+    state = workerState()
+    read_stats = ReadStats()
+    result = process_and_aggregate_batch(
+        task.raster_paths, *state["options"], read_stats=read_stats,
+        mask_cache=state["mask_cache"], **state["keywords"])
+    return result, read_stats
+
+
+def batch_results(tasks, batches):
+    """
+    Splits the results of batched tasks into the results of their rasters.
 
     Args:
-        raster_path (str): Path to the raster file.
-        shape_file (GeoDataFrame): Loaded shapefile for geometries.
-        invalid_values (list, optional): Values to consider as invalid in raster.
-        use_mask (bool): If True, uses an additional mask for calculations.
-        mask_path (str, optional): Path to the mask file, required if use_mask is True.
-        calculation_mode (str): Mode of calculation ('overall_mean', 'weighted_mean', or 'filtered_mean').
-        predictor_name (str): Column name for the output data.
-        all_touched (bool): Consider all pixels that touch geometry for masking.
+        tasks (iterator): The position and the (result, error) of every RasterBatch.
+        batches (list): The RasterBatch tasks.
 
-    Returns:
-        list: Aggregated data for each geometry in the shapefile.
+    Yields:
+        tuple: The position of a raster and its result and error, like a per-raster task.
     """
-    file_name = os.path.basename(raster_path)
-    date_str = extractDateFromFilename(file_name)
-    aggregated_data = []
+    for batch, (result, error) in tasks:
+        positions = batches[batch].positions
+
+        if error:
+            for index in positions:
+                yield index, (None, error)
+            continue
+
+        zone_results, read_stats = result
 
-    with rasterio.open(raster_path) as src:
-        no_data_value = src.nodata
-        geoms = [mapping(shape) for shape in shape_file.geometry]
+        # The reads of the batch are reported with its first raster
+        for position, (index, zone_result) in enumerate(zip(positions, zone_results)):
+            yield index, ((zone_result, read_stats if position == 0 else ReadStats()), None)
 
-        mask_no_data_value = None
-        mask_src = None
 
-        if use_mask and mask_path:
-            mask_src = rasterio.open(mask_path)
-            mask_no_data_value = mask_src.nodata
+def tile_wrapper(task):
+    state = workerState()
+    plan = state["options"][0]
+    read_stats = ReadStats()
+    partials = aggregate_tile(
+        task.raster_paths, plan.tiles[task.tile_number], *state["options"],
+        mask_cache=state["mask_cache"], read_stats=read_stats)
+    return partials, read_stats
+
+
+def tiled_results(tasks, plan, batches, predictor_paths, calculation_mode="overall_mean",
+                  weight_sum=None, stats=None, coverage=False):
+    """
+    Merges the tile partials of every time batch into the results of its rasters.
+
+    Args:
+        tasks (iterator): The position and the (result, error) of every work unit, the units
+            being the tiles of the first batch, then of the second batch, and so on.
+        plan (TilePlan): The tiles of the run.
+        batches (list): Ranges of raster positions of every time batch.
+        predictor_paths (list): Paths of the rasters.
+        calculation_mode (str): 'overall_mean', 'weighted_mean' or 'filtered_mean'.
+        weight_sum (ndarray, optional): Sum of the mask weights of every zone, with the mask.
+        stats (list of str, optional): Statistics of the run.
+        coverage (bool): Whether the zone index has coverage fractions.
+
+    Yields:
+        tuple: The position of a raster and its result and error, like a per-raster task,
+            once every tile of its batch is merged.
+    """
+    remaining = [len(plan)] * len(batches)
+    partials = {}
+    errors = {}
+    read_stats = {}
+
+    for unit, (result, error) in tasks:
+        batch, tile_number = divmod(unit, len(plan))
 
-        for index, geom in enumerate(geoms):
-            geom_mask, geom_transform = mask(
-                src, [geom], crop=True, all_touched=all_touched)
-            geom_mask = geom_mask.astype('float32')
-            geom_mask[geom_mask == no_data_value] = np.nan
+        if batch not in partials:
+            partials[batch] = ZonePartials(len(batches[batch]), plan.n_zones)
+            read_stats[batch] = ReadStats()
 
-            if invalid_values:
-                for invalid_value in invalid_values:
-                    geom_mask[geom_mask == invalid_value] = np.nan
+        if error:
+            errors.setdefault(batch, error)
+        else:
+            tile_partials, unit_stats = result
+            partials[batch].add(plan.tiles[tile_number].zones, tile_partials)
+            read_stats[batch].update(unit_stats)
 
-            if use_mask and mask_path and mask_src:
-                crop_mask, _ = mask(
-                    mask_src, [geom], crop=True, all_touched=all_touched)
+        remaining[batch] -= 1
+        if remaining[batch]:
+            continue
 
-                if calculation_mode == "weighted_mean":
-                    valid_mask = (crop_mask[0] != mask_no_data_value)
-                    valid_data = geom_mask[0][valid_mask]
-                    valid_weights = crop_mask[0][valid_mask]
-                    mean_value = np.nansum(valid_data * valid_weights) / np.nansum(
-                        valid_weights) if np.nansum(valid_weights) > 0 else np.nan
+        merged, batch_stats = partials.pop(batch), read_stats.pop(batch)
+        zone_values = merged.mean(calculation_mode, weight_sum)
 
-                elif calculation_mode == "filtered_mean":
-                    valid_mask = (crop_mask[0] != mask_no_data_value)
-                    masked_data = geom_mask[0][valid_mask]
-                    mean_value = np.nanmean(masked_data) if np.nansum(
-                        masked_data) > 0 else np.nan
+        if stats:
+            zone_values = merged.statistics(stats, zone_values, coverage)
 
-            elif calculation_mode == "overall_mean" or not use_mask:
-                mean_value = np.nanmean(geom_mask)
+        # The reads of the batch are reported with its first raster
+        for position, index in enumerate(batches[batch]):
+            if batch in errors:
+                yield index, (None, errors[batch])
+                continue
 
-            new_row = {col: shape_file.iloc[index][col]
-                       for col in shape_file.columns if col != 'geometry'}
-            new_row.update({'date': date_str, predictor_name: mean_value})
-            aggregated_data.append(new_row)
+            date_str = extractDateFromFilename(os.path.basename(predictor_paths[index]))
+            yield index, (((date_str, zone_values[position]),
+                           batch_stats if position == 0 else ReadStats()), None)
 
-        if mask_src:
-            mask_src.close()
+        errors.pop(batch, None)
 
-    return aggregated_data
 
+def task_wrapper(worker, raster_path):
 
-def process_wrapper(arg):
-    return process_and_aggregate_raster(*arg)
+    # Errors are returned as messages instead of raised: some GDAL errors cannot be
+    # unpickled, which would stall the pool
+    return retryAggregation(
+        worker, raster_path, retries=workerState().get("retries", 0), skip_failed=True)
 
 
 def parallelAggregate(
@@ -109,7 +186,31 @@ def parallelAggregate(
     calculation_mode="overall_mean",
     predictor_name="Value",
     all_touched=False,
-    max_workers=None
+    max_workers=None,
+    engine="zone_index",
+    io_mode="geometry",
+    report_io=False,
+    output_format="csv",
+    write_every=100,
+    streaming=False,
+    max_in_flight=None,
+    chunksize=None,
+    zone_cache_dir=None,
+    coverage=False,
+    stats=None,
+    incremental=False,
+    manifest_path=None,
+    checkpoint_dir=None,
+    resume=False,
+    retries=0,
+    skip_failed=False,
+    executor="process",
+    client=None,
+    tile_size=TILE_SIZE,
+    time_batch=TIME_BATCH,
+    batch_size=1,
+    memory_budget=None,
+    cube_dir=None
 ):
     """
     Aggregates raster data from a directory in parallel into shapefile geometries, optionally using a mask.
@@ -124,50 +225,257 @@ def parallelAggregate(
         calculation_mode (str): Determines how values are aggregated ('overall_mean', 'weighted_mean', or 'filtered_mean').
         predictor_name (str): Name for the output predictor column.
         all_touched (bool): Include all pixels touching geometry in the aggregation.
+        max_workers (int, optional): Number of workers, defaults to all cores but one.
+        engine (str): 'zone_index' rasterizes the shapefile once and reduces all zones per raster
+            in one pass, 'mask' masks every geometry of every raster separately. 'tiled' splits the
+            zone index into tiles aligned to the GeoTIFF blocks and runs every tile of a batch of
+            rasters as one task, merging the partial sums and counts of the zones across tiles.
+        io_mode (str): For the 'mask' engine, 'geometry' reads every geometry window separately,
+            'window' reads the union window of all geometries once per raster.
+        report_io (bool): Print the number of raster reads and bytes read at the end of the run.
+        output_format (str): 'csv', 'parquet' (partitioned by year and variable) or 'feather'.
+        write_every (int): Number of rasters aggregated before their rows are appended to the output.
+        streaming (bool): Consume the results in completion order with imap_unordered. Rows are
+            written in the order the rasters finish instead of the order of the rasters.
+        max_in_flight (int, optional): Maximum number of rasters submitted but not written yet,
+            defaults to two chunks per worker. Bounds memory whatever the number of rasters.
+        chunksize (int, optional): Rasters sent to a worker at once, adapted to the number of
+            rasters and workers by default.
+        zone_cache_dir (str, optional): Directory of a persistent zone index cache, so runs with the
+            same shapefile and grid skip the rasterization. Disabled by default.
+        coverage (bool): With the 'zone_index' engine, weight every pixel by the exact fraction of its
+            area covered by the geometry, computed once per zone. In 'weighted_mean' mode the
+            fractions multiply the mask weights.
+        stats (list of str, optional): With the 'zone_index' engine, statistics computed in one pass
+            over every raster, e.g. ['mean', 'min', 'max', 'std', 'count', 'p90'], written as one
+            '{predictor_name}_{stat}' column each. 'mean' follows calculation_mode.
+        incremental (bool): Only aggregate the rasters that are new or changed since the last
+            incremental run into the same output, and merge their rows into it. The rasters are
+            tracked in a run manifest, and every raster is aggregated again when the shapefile,
+            the mask or an option changes.
+        manifest_path (str, optional): Path of the run manifest, '{output_csv_path}.manifest.json'
+            by default.
+        checkpoint_dir (str, optional): Directory where every block of write_every rasters is
+            saved once aggregated, so an interrupted run can be resumed. Deleted once the run
+            finishes.
+        resume (bool): Resume the interrupted run of the same options from checkpoint_dir: its
+            saved blocks are written to the output and their rasters are skipped.
+        retries (int): Number of times a raster failing to aggregate is attempted again by its
+            worker.
+        skip_failed (bool): Skip the rasters that still fail after the retries instead of
+            stopping the run. They are listed in '{checkpoint_dir}/failed.json' with a checkpoint.
+        executor (str): Backend running the rasters: 'process' for local worker processes,
+            'thread' for threads of the current process, or 'dask' for a dask.distributed
+            cluster. The zone index and the mask are sent once to every worker.
+        client (dask.distributed.Client or str, optional): With the 'dask' executor, the client or
+            scheduler address of the cluster, whose workers must reach the rasters at the same
+            paths. A LocalCluster of max_workers processes is started by default.
+        tile_size (int): With the 'tiled' engine, side of the tiles in pixels, rounded up to whole
+            blocks of the rasters.
+        time_batch (int): With the 'tiled' engine, number of rasters read per tile by one task.
+        batch_size (int or str): With the 'zone_index' engine, number of consecutive rasters stacked
+            and reduced together by one task, or 'auto' to fit memory_budget.
+        memory_budget (int, optional): With batch_size='auto', bytes of raster data a task may
+            stack, 256 MB by default.
+        cube_dir (str, optional): With the 'zone_index' engine, directory of a cube built from
+            predictor_dir with `buildCube`, read memory-mapped instead of the GeoTIFFs. Worker
+            processes open it once and share its pages through the page cache.
 
     Raises:
-        ValueError: If use_mask is True and mask_path is not provided.
+        ValueError: If use_mask is True and mask_path is not provided, or an option is invalid.
 
     Returns a CSV with aggregated data per shapefile geometry. Utilizes multiprocessing for efficiency.
     """
     if not max_workers:
-        max_workers = os.cpu_count() - 1 if os.cpu_count() > 1 else 1
-
-    predictor_paths = loadTiff(predictor_dir)
-    data_list = []
-
-    shape_file = gpd.read_file(shapefile_path)
-
-    if use_mask and not mask_path:
-        raise ValueError("Mask path must be provided if use_mask is True.")
-
-    # Prepare arguments for starmap
-    task_args = [
-        (
-            raster_path,
-            shape_file,
-            invalid_values,
-            use_mask,
-            mask_path,
-            calculation_mode,
-            predictor_name,
-            all_touched
-        ) for raster_path in predictor_paths
-    ]
-
-    # with multiprocessing.Pool(processes=max_workers) as pool:
-    with Pool(processes=max_workers) as pool:
-        results = []
-        # Wrap pool.imap or pool.imap_unordered for a real-time tqdm progress bar
-        # results = list(tqdm(pool.starmap(process_and_aggregate_raster, task_args), total=len(
-        #     task_args), desc="Processing rasters", unit="raster"))
-
-        # for result in results:
-        #     data_list.extend(result)
-        for result in tqdm(pool.imap(process_wrapper, task_args, chunksize=1), total=len(task_args), desc="Processing rasters", unit="raster"):
-            results.append(result)
-            data_list.extend(result)
-
-    df = pd.DataFrame(data_list)
-    df[predictor_name] = df[predictor_name].round(3)
-    df.to_csv(output_csv_path, index=False)
+        max_workers = default_workers()
+
+    read_stats = ReadStats()
+
+    if engine == "tiled":
+        check_mergeable(stats)
+
+    if batch_size != 1 and engine != "zone_index":
+        raise ValueError("batch_size requires the 'zone_index' engine.")
+
+    if batch_size != "auto" and (not isinstance(batch_size, int) or batch_size < 1):
+        raise ValueError(
+            f"Invalid batch_size: {batch_size}. Options are a positive integer or 'auto'.")
+
+    if executor not in EXECUTORS:
+        raise ValueError(
+            f"Invalid executor: {executor}. Options are 'process', 'thread', 'dask'.")
+
+    shape_file, predictor_paths, sink, manifest, checkpoint = prepare_run(
+        predictor_dir, shapefile_path, output_csv_path, ("zone_index", "mask", "tiled"),
+        mask_path=mask_path, use_mask=use_mask, invalid_values=invalid_values,
+        calculation_mode=calculation_mode, predictor_name=predictor_name,
+        all_touched=all_touched, engine=engine, output_format=output_format,
+        coverage=coverage, stats=stats, incremental=incremental,
+        manifest_path=manifest_path, checkpoint_dir=checkpoint_dir, resume=resume,
+        cube_dir=cube_dir)
+
+    if sink is None:
+        print("Every raster is up to date, nothing to aggregate.")
+        return output_csv_path
+
+    # The mask is loaded once and shared with local worker processes as memory-mapped
+    # .npy files, threads share it in memory and dask workers receive it once
+    cache_dir = tempfile.TemporaryDirectory(prefix="earthstat_mask_")
+
+    try:
+        attributes = zone_attributes(shape_file)
+        stat_names = stat_columns(predictor_name, stats)
+        integer_columns = count_columns(predictor_name, stats)
+
+        if checkpoint:
+            write_checkpoint(
+                checkpoint, sink, attributes, stat_names, manifest, integer_columns)
+            predictor_paths = [
+                path for path in predictor_paths if path not in checkpoint.completed]
+
+        mask_cache = None
+        keywords = {}
+        tasks = predictor_paths
+
+        # Nothing is left to aggregate when the checkpoint holds every raster
+        if not predictor_paths:
+            worker, options = None, ()
+
+        elif engine in ("zone_index", "tiled"):
+            zone_index = buildZoneIndex(
+                predictor_paths[0], shape_file, all_touched=all_touched,
+                cache_dir=zone_cache_dir, coverage=coverage)
+
+            if use_mask:
+                mask_cache = MaskCache.from_raster(
+                    mask_path, zone_index, read_stats=read_stats)
+
+            worker = zones_wrapper
+            keywords = {"stats": stats}
+
+            # Pickled as its directory, every worker memory-maps the cube once
+            if cube_dir:
+                keywords["cube"] = load_cube(cube_dir, zone_index, predictor_paths)
+            options = (
+                zone_index,
+                invalid_values,
+                use_mask,
+                mask_path,
+                calculation_mode
+            )
+
+            if batch_size != 1:
+                if batch_size == "auto":
+                    batch_size = batchSize(zone_index, len(predictor_paths),
+                                           max_workers, memory_budget)
+
+                # Every task stacks consecutive rasters and reduces them at once
+                batches = [RasterBatch(batch, [predictor_paths[index] for index in batch])
+                           for batch in time_batches(len(predictor_paths), batch_size)]
+                tasks = batches
+                worker = batch_wrapper
+
+            if engine == "tiled":
+                plan = TilePlan.from_zone_index(
+                    zone_index, raster_block_shape(predictor_paths[0]), tile_size)
+                batches = time_batches(len(predictor_paths), time_batch)
+
+                # Work units are the tiles of every time batch, batch after batch
+                tasks = [TileTask(tile_number, [predictor_paths[index] for index in batch])
+                         for batch in batches for tile_number in range(len(plan))]
+                worker = tile_wrapper
+                keywords = {}
+                options = (plan, invalid_values, use_mask, calculation_mode)
+                weight_sum = mask_cache.weight_sum if use_mask else None
+
+        else:
+            if use_mask:
+                mask_cache = MaskCache.from_raster(
+                    mask_path, shape_file=shape_file, read_stats=read_stats)
+
+            worker = process_wrapper
+            options = (
+                shape_file.geometry,
+                invalid_values,
+                use_mask,
+                mask_path,
+                calculation_mode,
+                all_touched,
+                io_mode
+            )
+
+        if mask_cache is not None and executor == "process":
+            mask_cache = mask_cache.save(cache_dir.name)
+
+        block_size = max(min(write_every, len(predictor_paths)), 1)
+        results = ResultBuilder(len(shape_file), block_size, stat_names,
+                                integer_columns=integer_columns)
+        block_paths = [None] * block_size
+
+        slot = 0
+
+        # Shared options are sent once per worker, tasks only carry a raster path
+        with getExecutor(executor, max_workers, init_worker,
+                         (options, mask_cache, keywords, retries), client=client) as pool:
+            tasks = pool.imap(partial(task_wrapper, worker), tasks,
+                              ordered=not streaming, max_in_flight=max_in_flight,
+                              chunksize=chunksize)
+
+            if worker is batch_wrapper:
+                tasks = batch_results(tasks, batches)
+
+            if worker is tile_wrapper:
+                tasks = tiled_results(
+                    tasks, plan, batches, predictor_paths, calculation_mode,
+                    weight_sum=weight_sum, stats=stats, coverage=coverage)
+
+            # Rows are kept in arrival order, which is the raster order unless streaming
+            for index, (result, error) in tqdm(
+                    tasks, total=len(predictor_paths), desc="Processing rasters",
+                    unit="raster"):
+                raster_path = predictor_paths[index]
+
+                if error and not skip_failed:
+                    raise RuntimeError(error)
+
+                if error:
+                    skip_raster(raster_path, error, checkpoint)
+
+                else:
+                    (date_str, zone_values), task_stats = result
+                    results.set_date(slot, date_str, zone_values)
+                    read_stats.update(task_stats)
+                    block_paths[slot] = raster_path
+                    slot += 1
+
+                    if manifest:
+                        manifest.record(raster_path, [date_str])
+
+                    # Append every finished block of rasters to the output
+                    if slot == block_size:
+                        flush_results(sink, results, attributes, slot, block_paths, checkpoint)
+                        slot = 0
+
+            if slot:
+                flush_results(sink, results, attributes, slot, block_paths, checkpoint)
+
+    except BaseException:
+        # The partial output of a failed run never replaces the previous output
+        sink.abort()
+        raise
+
+    finally:
+        cache_dir.cleanup()
+
+    sink.close()
+
+    if manifest:
+        manifest.save()
+
+    if checkpoint:
+        checkpoint.close()
+
+    if report_io:
+        print(read_stats.report())
+
+    return output_csv_path
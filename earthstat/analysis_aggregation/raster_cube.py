@@ -0,0 +1,245 @@
+import json
+import os
+
+import numpy as np
+import rasterio
+from affine import Affine
+from tqdm.auto import tqdm
+
+from ..utils import extractDateFromFilename, loadTiff
+
+
+class RasterCube():
+    """
+    A directory of single-band rasters stored as one memory-mappable array.
+
+    The rasters are decoded once by `buildCube` into an uncompressed float32
+    `data.npy` of shape (dates, height, width), with NaN for nodata, next to a
+    `cube.json` index of their paths and dates. Later runs memory-map the array and
+    copy zone windows straight from the page cache instead of opening and
+    decompressing every GeoTIFF again. Pickling a cube only sends its directory, so
+    worker processes reopen it memory-mapped.
+
+    Attributes:
+        directory (str): Directory of the cube.
+        data (ndarray): Memory-mapped array of shape (dates, height, width).
+        paths (list): Absolute path of the raster of every date.
+        dates (list): Date of every raster.
+        fingerprints (list): Modification time and size of every raster when the cube was built.
+        transform (Affine): Affine transform of the grid.
+        crs (str): Coordinate reference system of the grid.
+    """
+
+    def __init__(self, directory, data, paths, dates, fingerprints, transform, crs=None):
+
+        self.directory = directory
+        self.data = data
+        self.paths = list(paths)
+        self.dates = list(dates)
+        self.fingerprints = [tuple(fingerprint) for fingerprint in fingerprints]
+        self.transform = transform
+        self.crs = crs
+        self._positions = {path: position for position, path in enumerate(self.paths)}
+
+    @property
+    def name(self):
+        """Directory of the cube, named in grid errors like a raster path."""
+        return self.directory
+
+    @property
+    def shape(self):
+        """Height and width of the grid."""
+        return tuple(self.data.shape[1:])
+
+    @classmethod
+    def open(cls, directory, mmap_mode="r"):
+        """
+        Opens a cube built with `buildCube`, memory-mapped and read-only by default.
+
+        Args:
+            directory (str): Directory of the cube.
+            mmap_mode (str, optional): Memory-map mode passed to `numpy.load`.
+
+        Returns:
+            RasterCube: The opened cube.
+        """
+        with open(os.path.join(directory, "cube.json")) as f:
+            meta = json.load(f)
+
+        data = np.load(os.path.join(directory, "data.npy"), mmap_mode=mmap_mode)
+
+        return cls(directory, data, meta["paths"], meta["dates"], meta["fingerprints"],
+                   Affine(*meta["transform"]), meta["crs"])
+
+    def __reduce__(self):
+        return open_cube, (self.directory,)
+
+    def check_paths(self, raster_paths):
+        """
+        Raises a ValueError if a raster is not in the cube or changed since it was built.
+
+        Args:
+            raster_paths (list): Paths of the rasters to read from the cube.
+        """
+        for raster_path in raster_paths:
+            path = os.path.abspath(raster_path)
+            position = self._positions.get(path)
+
+            if position is None or self.fingerprints[position] != raster_fingerprint(path):
+                raise ValueError(
+                    f"Raster {raster_path} is missing from the cube at {self.directory} or "
+                    "changed since it was built. Rebuild it with buildCube.")
+
+    def read(self, raster_path, window, out, read_stats=None):
+        """
+        Copies a window of a raster of the cube into out.
+
+        Args:
+            raster_path (str): Path of the raster.
+            window (Window): Window of the grid to read.
+            out (ndarray): Array of the window shape receiving the values.
+            read_stats (ReadStats, optional): Counter recording the read.
+        """
+        position = self._positions.get(os.path.abspath(raster_path))
+
+        if position is None:
+            raise ValueError(
+                f"Raster {raster_path} is missing from the cube at {self.directory}.")
+
+        rows, cols = window.toslices()
+        out[...] = self.data[position, rows, cols]
+
+        if read_stats is not None:
+            read_stats.record(out)
+
+
+def raster_fingerprint(raster_path):
+    """Returns the modification time and size of a raster."""
+    stat = os.stat(raster_path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def buildCube(predictor_dir, cube_dir=None):
+    """
+    Converts a directory of rasters into a memory-mappable cube, once.
+
+    The rasters are sorted by date and written as one float32 array with NaN for
+    nodata, so consecutive dates are contiguous on disk. A cube that is up to date
+    with the directory is reused, a stale one is rebuilt. The array is written first
+    and the index last, so an interrupted build leaves no index pointing at a
+    partial array.
+
+    Args:
+        predictor_dir (str): Directory containing the rasters.
+        cube_dir (str, optional): Directory of the cube, '{predictor_dir}/cube' by default.
+
+    Raises:
+        ValueError: If the directory holds no raster or the rasters are not on the same grid.
+
+    Returns:
+        RasterCube: The opened cube.
+    """
+    cube_dir = cube_dir if cube_dir else os.path.join(predictor_dir, "cube")
+    raster_paths = [os.path.abspath(path) for path in loadTiff(predictor_dir)]
+
+    if not raster_paths:
+        raise ValueError(f"No raster found in {predictor_dir}.")
+
+    dates = [extractDateFromFilename(os.path.basename(path)) for path in raster_paths]
+    order = sorted(range(len(raster_paths)), key=lambda index: (dates[index], raster_paths[index]))
+    raster_paths = [raster_paths[index] for index in order]
+    dates = [dates[index] for index in order]
+    fingerprints = [raster_fingerprint(path) for path in raster_paths]
+
+    if os.path.exists(os.path.join(cube_dir, "cube.json")):
+        cube = RasterCube.open(cube_dir)
+        if cube.paths == raster_paths and cube.fingerprints == fingerprints:
+            return cube
+
+        os.remove(os.path.join(cube_dir, "cube.json"))
+
+    os.makedirs(cube_dir, exist_ok=True)
+
+    with rasterio.open(raster_paths[0]) as src:
+        shape, transform, crs = src.shape, src.transform, src.crs
+
+    partial_path = os.path.join(cube_dir, "data.partial.npy")
+    data = np.lib.format.open_memmap(
+        partial_path, mode="w+", dtype="float32", shape=(len(raster_paths),) + shape)
+
+    for position, raster_path in enumerate(
+            tqdm(raster_paths, desc="Building cube", unit="raster")):
+
+        with rasterio.open(raster_path) as src:
+            if src.shape != shape or not src.transform.almost_equals(transform):
+                raise ValueError(
+                    f"Raster {raster_path} does not match the grid of {raster_paths[0]}. "
+                    "All rasters must share the same shape and transform.")
+
+            no_data_value = src.nodata
+            data[position] = src.read(1)
+
+        band = data[position]
+        band[band == no_data_value] = np.nan
+
+    data.flush()
+    del data
+    os.replace(partial_path, os.path.join(cube_dir, "data.npy"))
+
+    meta = {
+        "paths": raster_paths,
+        "dates": dates,
+        "fingerprints": fingerprints,
+        "transform": list(transform)[:6],
+        "crs": crs.to_string() if crs else None,
+    }
+
+    with open(os.path.join(cube_dir, "cube.json.partial"), "w") as f:
+        json.dump(meta, f)
+
+    os.replace(os.path.join(cube_dir, "cube.json.partial"), os.path.join(cube_dir, "cube.json"))
+    _opened_cubes.pop(cube_dir, None)
+
+    return RasterCube.open(cube_dir)
+
+
+# Cubes opened by this process, by directory
+_opened_cubes = {}
+
+
+def open_cube(directory):
+    """
+    Opens a cube once per process and reuses it for later tasks.
+
+    Args:
+        directory (str): Directory of the cube.
+
+    Returns:
+        RasterCube: The memory-mapped cube.
+    """
+    if directory not in _opened_cubes:
+        _opened_cubes[directory] = RasterCube.open(directory)
+
+    return _opened_cubes[directory]
+
+
+def load_cube(cube_dir, zone_index, raster_paths):
+    """
+    Opens the cube of a run and checks it covers the rasters on the zone index grid.
+
+    Args:
+        cube_dir (str): Directory of the cube.
+        zone_index (ZoneIndex): Zone index of the run.
+        raster_paths (list): Paths of the rasters aggregated by the run.
+
+    Raises:
+        ValueError: If the cube is not on the zone index grid, or misses or holds stale rasters.
+
+    Returns:
+        RasterCube: The memory-mapped cube.
+    """
+    cube = open_cube(cube_dir)
+    zone_index.check_grid(cube)
+    cube.check_paths(raster_paths)
+
+    return cube
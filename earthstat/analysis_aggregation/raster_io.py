@@ -0,0 +1,178 @@
+import numpy as np
+from rasterio.errors import WindowError
+from rasterio.features import bounds as feature_bounds
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.mask import mask
+from rasterio.windows import Window
+
+
+class ReadStats():
+    """
+    Counts the raster reads issued by an aggregation run and the bytes they returned.
+
+    Attributes:
+        read_count (int): Number of read calls.
+        bytes_read (int): Number of bytes returned by the read calls.
+    """
+
+    def __init__(self):
+
+        self.read_count = 0
+        self.bytes_read = 0
+
+    def record(self, array):
+        """
+        Records one read returning the given array.
+
+        Args:
+            array (ndarray): The array returned by the read.
+        """
+        self.read_count += 1
+        self.bytes_read += array.nbytes
+
+    def update(self, other):
+        """
+        Adds the counts of another ReadStats, e.g. one returned by a worker.
+
+        Args:
+            other (ReadStats): The counts to add.
+        """
+        self.read_count += other.read_count
+        self.bytes_read += other.bytes_read
+
+    def report(self):
+        """
+        Returns a one-line summary of the recorded reads.
+
+        Returns:
+            str: The number of reads and megabytes read.
+        """
+        return (f"Raster reads: {self.read_count}, "
+                f"data read: {self.bytes_read / 1024 ** 2:.2f} MB")
+
+
+def read_window(src, window, read_stats=None, indexes=None):
+    """
+    Reads a window of an open raster, recording the read.
+
+    Args:
+        src (DatasetReader): An open rasterio dataset.
+        window (Window): The window to read.
+        read_stats (ReadStats, optional): Counter to record the read into.
+        indexes (int or list, optional): Band(s) to read, all bands by default.
+
+    Returns:
+        ndarray: The data read over the window.
+    """
+    data = src.read(indexes, window=window)
+
+    if read_stats is not None:
+        read_stats.record(data)
+
+    return data
+
+
+class GeometryReader():
+    """
+    Crops the pixels of single geometries from an open raster.
+
+    With io_mode 'geometry' every crop is a separate windowed read through
+    `rasterio.mask.mask`. With io_mode 'window' the union bounding window of all
+    geometries is read once and every crop is sliced from that in-memory block,
+    which turns thousands of small random reads into one read per raster. Both
+    modes return the same arrays.
+
+    Attributes:
+        src (DatasetReader): The open raster.
+        io_mode (str): 'geometry' or 'window'.
+        window (Window): Union bounding window read in 'window' mode.
+        block (ndarray): Data read over the union window in 'window' mode.
+    """
+
+    def __init__(self, src, geoms, io_mode="geometry", read_stats=None):
+
+        if io_mode not in ("geometry", "window"):
+            raise ValueError(
+                f"Invalid io_mode: {io_mode}. Options are 'geometry', 'window'.")
+
+        self.src = src
+        self.io_mode = io_mode
+        self.read_stats = read_stats
+        self.window = None
+        self.block = None
+
+        if io_mode == "window":
+            self.window = _geometry_window(src, geoms)
+            self.block = read_window(src, self.window, read_stats)
+
+    def crop(self, geom, all_touched=False):
+        """
+        Returns the pixels of a geometry, like `mask(src, [geom], crop=True)`.
+
+        Pixels outside the geometry are filled with the raster nodata value, or 0
+        when the raster has none.
+
+        Args:
+            geom (dict): GeoJSON-like geometry.
+            all_touched (bool): Consider all pixels that touch geometry for masking.
+
+        Returns:
+            ndarray: Array of shape (bands, height, width) of the geometry window.
+        """
+        if self.io_mode == "geometry":
+            out_image, _ = mask(
+                self.src, [geom], crop=True, all_touched=all_touched)
+
+            if self.read_stats is not None:
+                self.read_stats.record(out_image)
+
+            return out_image
+
+        window = _geometry_window(self.src, [geom])
+        row = int(window.row_off - self.window.row_off)
+        col = int(window.col_off - self.window.col_off)
+        height, width = int(window.height), int(window.width)
+
+        out_image = self.block[:, row:row + height, col:col + width].copy()
+        shape_mask = geometry_mask(
+            [geom], transform=self.src.window_transform(window),
+            out_shape=(height, width), all_touched=all_touched)
+
+        no_data_value = self.src.nodata if self.src.nodata is not None else 0
+        out_image[:, shape_mask] = no_data_value
+
+        return out_image
+
+
+def _geometry_window(src, geoms):
+    """Returns the window of geometries on a raster, as rasterio.mask computes it."""
+    try:
+        return geometry_window(src, geoms)
+
+    except WindowError:
+        raise ValueError('Input shapes do not overlap raster.')
+
+
+def pixel_window(geom, transform, shape):
+    """
+    Returns the pixel window of a geometry on a grid, as rasterio.mask crops it.
+
+    Args:
+        geom (dict or geometry): GeoJSON-like or shapely geometry.
+        transform (Affine): Affine transform of the grid.
+        shape (tuple): Height and width of the grid.
+
+    Returns:
+        Window: The window of the geometry, or None if it does not overlap the grid.
+    """
+    height, width = shape
+    left, bottom, right, top = feature_bounds(geom, transform=~transform)
+    row_start = max(int(np.floor(min(top, bottom))), 0)
+    col_start = max(int(np.floor(min(left, right))), 0)
+    row_stop = min(int(np.ceil(max(top, bottom))), height)
+    col_stop = min(int(np.ceil(max(left, right))), width)
+
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
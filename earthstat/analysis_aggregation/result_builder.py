@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+
+class ResultBuilder():
+    """
+    Accumulates aggregation results in a preallocated zones x dates x statistics array.
+
+    Results are written column-wise as whole zone vectors or time series, and the
+    attribute columns of the shapefile are joined once, through the zone id, when
+    the output DataFrame is built. Peak memory is roughly the size of the result
+    array instead of one dict per (zone, date).
+
+    Attributes:
+        values (ndarray): Results of shape (n_zones, n_dates, n_stats), NaN until set.
+        dates (ndarray): Date label of every date slot.
+        stat_names (list of str): Output column name of every statistic.
+        integer_columns (list of str): Columns of the statistics holding whole numbers,
+            e.g. pixel counts, output as integers.
+    """
+
+    def __init__(self, n_zones, n_dates, stat_names, dtype='float64',
+                 integer_columns=()):
+
+        self.values = np.full(
+            (n_zones, n_dates, len(stat_names)), np.nan, dtype=dtype)
+        self.dates = np.full(n_dates, None, dtype=object)
+        self.stat_names = list(stat_names)
+        self.integer_columns = list(integer_columns)
+
+    @property
+    def n_zones(self):
+        return self.values.shape[0]
+
+    @property
+    def n_dates(self):
+        return self.values.shape[1]
+
+    def set_date(self, date_index, date, zone_values):
+        """
+        Stores the results of every zone for one date.
+
+        Args:
+            date_index (int): Position of the date in the output.
+            date (str): Date label.
+            zone_values (ndarray): Array of shape (n_zones,) or (n_zones, n_stats).
+        """
+        self.dates[date_index] = date
+        self.values[:, date_index, :] = np.reshape(
+            zone_values, (self.n_zones, -1))
+
+    def set_dates(self, dates):
+        """
+        Sets the labels of all date slots at once.
+
+        Args:
+            dates (list): One label per date slot.
+        """
+        self.dates[:] = list(dates)
+
+    def set_zone(self, zone_id, series, dates=None):
+        """
+        Stores the time series of one zone.
+
+        Args:
+            zone_id (int): Position of the zone in the shapefile.
+            series (ndarray): Array of shape (n_dates,) or (n_dates, n_stats).
+            dates (slice, optional): Date slots of the series, all by default.
+        """
+        dates = dates if dates is not None else slice(None)
+        values = self.values[zone_id, dates, :]
+        values[:] = np.reshape(series, (values.shape[0], -1))
+
+    def clear(self):
+        """Resets every slot, to reuse the builder for the next block of dates."""
+        self.values[:] = np.nan
+        self.dates[:] = None
+
+    def to_frame(self, attributes, order="date", dates=None):
+        """
+        Builds the output DataFrame, joining the attribute columns by zone id.
+
+        Args:
+            attributes (DataFrame): Attribute columns with one row per zone, in zone order.
+            order (str): 'date' lists every zone of a date before the next date,
+                'zone' lists every date of a zone before the next zone.
+            dates (slice or ndarray, optional): Date slots to include, all by default.
+
+        Returns:
+            DataFrame: The attribute columns, 'date', and one column per statistic.
+        """
+        date_ids = np.arange(self.n_dates)[dates if dates is not None else slice(None)]
+        zone_ids = np.arange(self.n_zones)
+
+        if order == "date":
+            row_zones = np.tile(zone_ids, len(date_ids))
+            row_dates = np.repeat(date_ids, len(zone_ids))
+        elif order == "zone":
+            row_zones = np.repeat(zone_ids, len(date_ids))
+            row_dates = np.tile(date_ids, len(zone_ids))
+        else:
+            raise ValueError(
+                f"Invalid order: {order}. Options are 'date', 'zone'.")
+
+        frame = attributes.take(row_zones).reset_index(drop=True)
+        frame['date'] = self.dates[row_dates]
+
+        row_values = self.values[row_zones, row_dates, :]
+        for position, name in enumerate(self.stat_names):
+            frame[name] = row_values[:, position]
+
+            # Nullable integers, so the slots never set stay missing
+            if name in self.integer_columns:
+                frame[name] = frame[name].round().astype('Int64')
+
+        return frame
+
+
+def zone_attributes(shape_file):
+    """
+    Returns the attribute columns of a shapefile, one row per zone in zone order.
+
+    Args:
+        shape_file (GeoDataFrame): Loaded shapefile.
+
+    Returns:
+        DataFrame: The non-geometry columns, indexed by zone id.
+    """
+    columns = [col for col in shape_file.columns if col != 'geometry']
+    return pd.DataFrame(shape_file[columns]).reset_index(drop=True)
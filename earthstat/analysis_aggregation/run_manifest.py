@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import shapely
+
+from .output_sink import getOutputSink, readOutput
+
+
+# Bumped whenever the aggregation output of unchanged inputs changes
+MANIFEST_VERSION = 1
+
+
+def fileHash(path, chunk_size=1024 ** 2):
+    """
+    Returns the SHA-256 of a file's content, read in chunks.
+
+    Args:
+        path (str): Path of the file.
+        chunk_size (int): Number of bytes read at once.
+
+    Returns:
+        str: Hexadecimal SHA-256 of the file.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def fileFingerprint(path, previous=None):
+    """
+    Returns the modification time, size and content hash of a file.
+
+    The content is only hashed when the modification time or the size differ
+    from the previous fingerprint, so unchanged files are checked with a stat.
+
+    Args:
+        path (str): Path of the file.
+        previous (dict, optional): Fingerprint of the file from a previous run.
+
+    Returns:
+        dict: 'mtime', 'size' and 'sha256' of the file.
+    """
+    stat = os.stat(path)
+
+    if previous and previous.get("mtime") == stat.st_mtime and previous.get("size") == stat.st_size:
+        return {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": previous["sha256"]}
+
+    return {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": fileHash(path)}
+
+
+def runSignature(shape_file=None, mask_path=None, **options):
+    """
+    Returns the signature of everything besides the rasters that the output depends on.
+
+    Args:
+        shape_file (GeoDataFrame, optional): The zones, geometries and attribute columns.
+        mask_path (str, optional): Path of the mask file used by the run.
+        **options: Aggregation options, e.g. calculation_mode or all_touched.
+
+    Returns:
+        str: Hexadecimal SHA-256 of the zones, the mask content and the options.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"v{MANIFEST_VERSION}|".encode())
+    digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+
+    if shape_file is not None:
+        for wkb in shapely.to_wkb(np.asarray(shape_file.geometry, dtype=object)):
+            digest.update(wkb if wkb is not None else b"")
+            digest.update(b"|")
+
+        columns = [col for col in shape_file.columns if col != 'geometry']
+        digest.update(shape_file[columns].to_csv(index=False).encode())
+
+    if mask_path:
+        digest.update(fileHash(mask_path).encode())
+
+    return digest.hexdigest()
+
+
+def manifestPath(output_path):
+    """
+    Returns the default manifest path of an output, next to it.
+
+    Args:
+        output_path (str): Path of the output file, or directory for Parquet.
+
+    Returns:
+        str: The output path followed by '.manifest.json'.
+    """
+    return output_path.rstrip(os.sep) + ".manifest.json"
+
+
+class RunManifest():
+    """
+    Records the input files aggregated into an output, to only aggregate new or changed files.
+
+    Every file is recorded with its modification time, size, content hash and the
+    dates of its output rows. The manifest also stores the signature of the zones,
+    mask and options of the run: when the signature of a new run differs, every
+    file is aggregated again.
+
+    Attributes:
+        path (str): Path of the manifest JSON file.
+        signature (str): Signature of the run, see `runSignature`.
+        files (dict): Record of every aggregated file, keyed by absolute path.
+    """
+
+    def __init__(self, path, signature, files=None):
+
+        self.path = path
+        self.signature = signature
+        self.files = files if files else {}
+        self._fingerprints = {}
+
+    @classmethod
+    def load(cls, path, signature):
+        """
+        Loads the manifest of a previous run, or starts an empty one.
+
+        Args:
+            path (str): Path of the manifest JSON file.
+            signature (str): Signature of the new run.
+
+        Returns:
+            RunManifest: The previous records if the signatures match, else an empty manifest.
+        """
+        try:
+            with open(path) as f:
+                content = json.load(f)
+
+        except (FileNotFoundError, ValueError):
+            return cls(path, signature)
+
+        if content.get("version") != MANIFEST_VERSION or content.get("signature") != signature:
+            return cls(path, signature)
+
+        return cls(path, signature, content.get("files"))
+
+    def pending(self, paths):
+        """
+        Returns the files that are new or changed since the run that wrote the manifest.
+
+        Args:
+            paths (list): Paths of the input files of the run.
+
+        Returns:
+            list: The paths to aggregate, in input order.
+        """
+        pending = []
+
+        for path in paths:
+            previous = self.files.get(os.path.abspath(path))
+            fingerprint = fileFingerprint(path, previous)
+            self._fingerprints[os.path.abspath(path)] = fingerprint
+
+            if previous is None or previous["sha256"] != fingerprint["sha256"]:
+                pending.append(path)
+
+            # Touched but unchanged files only get their new modification time
+            elif previous["mtime"] != fingerprint["mtime"]:
+                previous["mtime"] = fingerprint["mtime"]
+
+        return pending
+
+    def removed(self, paths):
+        """
+        Returns the recorded files that are no longer inputs of the run.
+
+        Args:
+            paths (list): Paths of the input files of the run.
+
+        Returns:
+            list: The absolute paths of the recorded files missing from paths.
+        """
+        paths = {os.path.abspath(path) for path in paths}
+
+        return [path for path in self.files if path not in paths]
+
+    def forget(self, paths):
+        """
+        Drops the records of files, e.g. removed from the inputs.
+
+        Args:
+            paths (list): Paths of the files.
+        """
+        for path in paths:
+            self.files.pop(os.path.abspath(path), None)
+
+    def stale_dates(self, paths):
+        """
+        Returns the dates of the output rows written for previous versions of files.
+
+        Args:
+            paths (list): Paths of the files aggregated again.
+
+        Returns:
+            set: Date labels of the rows to replace.
+        """
+        return {
+            date for path in paths
+            for date in self.files.get(os.path.abspath(path), {}).get("dates", [])}
+
+    def record(self, path, dates):
+        """
+        Records an aggregated file with the dates of its output rows.
+
+        Args:
+            path (str): Path of the file.
+            dates (list): Date labels of the rows written for the file.
+        """
+        path = os.path.abspath(path)
+        fingerprint = self._fingerprints.get(path) or fileFingerprint(path)
+        self.files[path] = dict(fingerprint, dates=[str(date) for date in dates])
+
+    def save(self):
+        """Writes the manifest, atomically so an interrupted run keeps the previous one."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(suffix=".json", dir=directory)
+
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "signature": self.signature,
+                       "files": self.files}, f, indent=1)
+
+        os.replace(tmp_path, self.path)
+
+
+def mergeOutput(output_path, output_format="csv", variable=None, stale_dates=()):
+    """
+    Opens a sink continuing an existing output, without the rows of stale dates.
+
+    New CSV rows are appended to a copy of the file. Otherwise, the rows of the
+    previous output that are kept are written first. Either way the previous output
+    is only replaced when the sink is closed.
+
+    Args:
+        output_path (str): Path of the output file, or directory for Parquet.
+        output_format (str): 'csv', 'parquet' or 'feather'.
+        variable (str, optional): Variable name used as Parquet partition.
+        stale_dates (set): Date labels of the previous rows to drop.
+
+    Returns:
+        OutputSink: The sink writing the new rows to output_path.
+    """
+    if not os.path.exists(output_path):
+        return getOutputSink(output_path, output_format, variable=variable)
+
+    if output_format == "csv" and not stale_dates:
+        return getOutputSink(output_path, output_format, variable=variable, append=True)
+
+    previous = readOutput(output_path, output_format)
+    previous = previous[~previous['date'].astype(str).isin(stale_dates)]
+
+    sink = getOutputSink(output_path, output_format, variable=variable)
+    sink.write(previous)
+
+    return sink
+
+
+def incrementalRun(raster_paths, output_path, output_format="csv", variable=None,
+                   manifest_path=None, shape_file=None, mask_path=None, stale_dates=(),
+                   **options):
+    """
+    Starts an incremental run, aggregating only the rasters new or changed since the last run.
+
+    The rows of the rasters that changed or were removed since the last run are
+    dropped from the output.
+
+    Args:
+        raster_paths (list): Paths of all the rasters of the run.
+        output_path (str): Path of the output file, or directory for Parquet.
+        output_format (str): 'csv', 'parquet' or 'feather'.
+        variable (str, optional): Variable name used as Parquet partition.
+        manifest_path (str, optional): Path of the manifest, next to the output by default.
+        shape_file (GeoDataFrame, optional): The zones of the run.
+        mask_path (str, optional): Path of the mask file used by the run.
+        stale_dates (set): Dates of previous rows to drop besides the ones of changed rasters,
+            e.g. the rows appended by an interrupted run.
+        **options: Aggregation options that change the output, part of the signature.
+
+    Returns:
+        tuple: The RunManifest, the raster paths to aggregate, and the sink of their rows,
+            None when every raster is up to date and none was removed.
+    """
+    signature = runSignature(shape_file, mask_path, output_format=output_format,
+                             variable=variable, **options)
+    manifest = RunManifest.load(
+        manifest_path if manifest_path else manifestPath(output_path), signature)
+
+    # A new signature starts from an empty manifest, so the output is rewritten
+    if not manifest.files and os.path.exists(output_path):
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        else:
+            os.remove(output_path)
+
+    pending = manifest.pending(raster_paths)
+    removed = manifest.removed(raster_paths)
+
+    if not pending and not removed:
+        return manifest, pending, None
+
+    # The rows of removed rasters are dropped like the ones of changed rasters
+    stale_dates = manifest.stale_dates(pending + removed) | set(stale_dates)
+    manifest.forget(removed)
+
+    sink = mergeOutput(output_path, output_format, variable, stale_dates)
+
+    return manifest, pending, sink
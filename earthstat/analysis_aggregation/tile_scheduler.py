@@ -0,0 +1,398 @@
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from .raster_io import read_window
+from .zone_index import parse_statistic
+
+
+# Default side in pixels of the tiles, rounded up to whole GeoTIFF blocks
+TILE_SIZE = 1024
+
+# Default number of dates read per tile by one work unit
+TIME_BATCH = 16
+
+# Statistics whose per-tile partials can be merged exactly
+MERGEABLE_STATISTICS = ('mean', 'sum', 'count', 'min', 'max', 'std')
+
+
+class Tile():
+    """
+    The pixels of a zone index falling in one block-aligned window of the grid.
+
+    Attributes:
+        window (Window): Window of the tile on the raster grid, aligned to the raster blocks.
+        zones (ndarray): Ids of the zones with pixels in the tile, in zone order.
+        indptr (ndarray): Offsets of each zone of `zones` in `entries`.
+        entries (ndarray): Positions in the zone index `indices` of the pixels of the tile.
+        local_indices (ndarray): Flat positions of the same pixels inside `window`.
+        coverage (ndarray): Covered fraction of the same pixels, or None.
+    """
+
+    def __init__(self, window, zones, indptr, entries, local_indices, coverage=None):
+
+        self.window = window
+        self.zones = zones
+        self.indptr = indptr
+        self.entries = entries
+        self.local_indices = local_indices
+        self.coverage = coverage
+
+
+class TileTask():
+    """
+    A work unit reading one tile of a batch of rasters.
+
+    Attributes:
+        tile_number (int): Position of the tile in its TilePlan.
+        raster_paths (list): Paths of the rasters of the batch.
+    """
+
+    def __init__(self, tile_number, raster_paths):
+
+        self.tile_number = tile_number
+        self.raster_paths = raster_paths
+
+    def __str__(self):
+        return (f"tile {self.tile_number} of {len(self.raster_paths)} rasters "
+                f"from {self.raster_paths[0]}")
+
+
+class TilePlan():
+    """
+    Splits the pixels of a zone index into spatial tiles aligned to the GeoTIFF blocks.
+
+    Every tile covers whole internal blocks of the rasters, so it is decoded once
+    and its pixels stay in the CPU caches while all its zones are reduced. A zone
+    spanning several tiles gets partial sums and counts from each of them, merged
+    by `ZonePartials`.
+
+    Attributes:
+        tiles (list): The Tile of every window holding zone pixels, row by row.
+        n_zones (int): Number of zones of the zone index.
+        shape (tuple): Height and width of the raster grid.
+        transform (Affine): Affine transform of the raster grid.
+    """
+
+    def __init__(self, tiles, n_zones, shape, transform):
+
+        self.tiles = tiles
+        self.n_zones = n_zones
+        self.shape = tuple(shape)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.tiles)
+
+    @classmethod
+    def from_zone_index(cls, zone_index, block_shape, tile_size=TILE_SIZE):
+        """
+        Groups the pixels of a zone index by tile.
+
+        Args:
+            zone_index (ZoneIndex): The zone index to split.
+            block_shape (tuple): Height and width of the internal blocks of the rasters.
+            tile_size (int): Side of the tiles in pixels, rounded up to whole blocks.
+
+        Returns:
+            TilePlan: The tiles holding at least one zone pixel.
+        """
+        block_height, block_width = block_shape
+        tile_height = block_height * max(-(-tile_size // block_height), 1)
+        tile_width = block_width * max(-(-tile_size // block_width), 1)
+        height, width = zone_index.shape
+
+        window = zone_index.window
+        rows = window.row_off + zone_index.indices // max(window.width, 1)
+        cols = window.col_off + zone_index.indices % max(window.width, 1)
+        labels = zone_index.labels
+
+        # The stable sort keeps the pixels of every tile in zone order
+        tile_ids = (rows // tile_height) * (-(-width // tile_width)) + cols // tile_width
+        order = np.argsort(tile_ids, kind='stable')
+        boundaries = np.flatnonzero(np.diff(tile_ids[order])) + 1
+
+        tiles = []
+        for entries in np.split(order, boundaries) if order.size else []:
+            tile_rows, tile_cols = rows[entries], cols[entries]
+
+            # Only the blocks of the tile holding zone pixels are read
+            row_off = tile_rows.min() // block_height * block_height
+            col_off = tile_cols.min() // block_width * block_width
+            row_end = min(-(-(tile_rows.max() + 1) // block_height) * block_height, height)
+            col_end = min(-(-(tile_cols.max() + 1) // block_width) * block_width, width)
+            tile_window = Window(int(col_off), int(row_off),
+                                 int(col_end - col_off), int(row_end - row_off))
+
+            zones, starts = np.unique(labels[entries], return_index=True)
+            tiles.append(Tile(
+                tile_window, zones, np.append(starts, entries.size), entries,
+                (tile_rows - row_off) * tile_window.width + (tile_cols - col_off),
+                None if zone_index.coverage is None else zone_index.coverage[entries]))
+
+        return cls(tiles, zone_index.n_zones, zone_index.shape, zone_index.transform)
+
+    def check_grid(self, src):
+        """
+        Raises a ValueError if an open raster is not on the grid of the plan.
+
+        Args:
+            src (DatasetReader): An open rasterio dataset.
+        """
+        if src.shape != self.shape or not src.transform.almost_equals(self.transform):
+            raise ValueError(
+                f"Raster {src.name} does not match the zone index grid. "
+                "All rasters must share the same shape and transform.")
+
+
+def raster_block_shape(raster_path):
+    """
+    Returns the internal block shape of the first band of a raster.
+
+    Args:
+        raster_path (str): Path to the raster.
+
+    Returns:
+        tuple: Height and width of the blocks, one row of full width for striped rasters.
+    """
+    with rasterio.open(raster_path) as src:
+        return src.block_shapes[0]
+
+
+def check_mergeable(stats):
+    """
+    Raises a ValueError if a statistic cannot be merged from tile partials.
+
+    Args:
+        stats (list of str, optional): The statistics of the run.
+    """
+    for stat in stats or []:
+        name, _ = parse_statistic(stat)
+
+        if name not in MERGEABLE_STATISTICS:
+            raise ValueError(
+                f"The 'tiled' engine cannot compute {stat}: medians and percentiles "
+                "need every pixel of a zone at once. Options are 'mean', 'sum', "
+                "'count', 'min', 'max', 'std'.")
+
+
+def time_batches(n_rasters, time_batch=TIME_BATCH):
+    """
+    Splits the raster positions into consecutive batches.
+
+    Args:
+        n_rasters (int): Number of rasters.
+        time_batch (int): Number of rasters per batch.
+
+    Returns:
+        list: Ranges of raster positions.
+    """
+    return [range(start, min(start + time_batch, n_rasters))
+            for start in range(0, n_rasters, time_batch)]
+
+
+def aggregate_tile(raster_paths, tile, plan, invalid_values=None, use_mask=False,
+                   calculation_mode="overall_mean", mask_cache=None, read_stats=None):
+    """
+    Reads one tile of a batch of rasters and reduces it to partial statistics per zone.
+
+    Args:
+        raster_paths (list): Paths of the rasters of the batch.
+        tile (Tile): The tile to read.
+        plan (TilePlan): The plan of the tile, to check the raster grids.
+        invalid_values (list, optional): Values to consider as invalid in the rasters.
+        use_mask (bool): If True, the mask selects or weights the pixels.
+        calculation_mode (str): 'overall_mean', 'weighted_mean' or 'filtered_mean'.
+        mask_cache (MaskCache, optional): Mask with zone weights aligned with the zone index.
+        read_stats (ReadStats, optional): Counter recording the reads.
+
+    Returns:
+        dict: Partial statistics of shape (n_rasters, n_tile_zones), see `tile_partials`.
+    """
+    values = np.empty((len(raster_paths), tile.entries.size), dtype='float64')
+
+    for position, raster_path in enumerate(raster_paths):
+        with rasterio.open(raster_path) as src:
+            plan.check_grid(src)
+            no_data_value = src.nodata
+            block = read_window(src, tile.window, read_stats, indexes=1).astype('float32')
+
+        block[block == no_data_value] = np.nan
+
+        if invalid_values:
+            for invalid_value in invalid_values:
+                block[block == invalid_value] = np.nan
+
+        values[position] = block.reshape(-1)[tile.local_indices]
+
+    masked = (use_mask and mask_cache is not None
+              and calculation_mode in ("weighted_mean", "filtered_mean"))
+
+    return tile_partials(
+        values, tile.indptr, coverage=tile.coverage,
+        valid=mask_cache.valid[tile.entries] if masked else None,
+        mask_weights=(mask_cache.weights[tile.entries]
+                      if masked and calculation_mode == "weighted_mean" else None))
+
+
+def tile_partials(values, indptr, coverage=None, valid=None, mask_weights=None):
+    """
+    Reduces the pixels of the zones of a tile to mergeable partial statistics.
+
+    Args:
+        values (ndarray): Array of shape (n_dates, n_pixels), NaN where invalid, zone by zone.
+        indptr (ndarray): Offsets of each zone in the pixels, every zone non-empty.
+        coverage (ndarray, optional): Covered fraction of every pixel.
+        valid (ndarray, optional): Mask selector of every pixel, the others are left out.
+        mask_weights (ndarray, optional): Mask weight of every pixel for 'weighted_mean'.
+
+    Returns:
+        dict: Arrays of shape (n_dates, n_zones): the 'count' of valid pixels, their
+            'weight', weighted 'total', unweighted 'plain' sum, 'm2' sum of squared
+            deviations from the tile mean, 'min' and 'max', and 'mask_total' with mask weights.
+    """
+    starts = indptr[:-1]
+
+    if mask_weights is not None:
+        mask_total = np.add.reduceat(np.nan_to_num(values * mask_weights), starts, axis=-1)
+
+    if valid is not None:
+        values = np.where(valid, values, np.nan)
+
+    is_valid = ~np.isnan(values)
+    weights = np.where(is_valid, 1.0 if coverage is None else coverage, 0.0)
+    weight = np.add.reduceat(weights, starts, axis=-1)
+    total = np.add.reduceat(np.nan_to_num(values * weights), starts, axis=-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(weight > 0, total / weight, 0.0)
+
+    deviation = np.where(is_valid, values - np.repeat(mean, np.diff(indptr), axis=-1), 0.0)
+
+    partials = {
+        "count": np.add.reduceat(is_valid.astype('int64'), starts, axis=-1),
+        "weight": weight,
+        "total": total,
+        "plain": np.add.reduceat(np.nan_to_num(values), starts, axis=-1),
+        "m2": np.add.reduceat(weights * deviation ** 2, starts, axis=-1),
+        "min": np.fmin.reduceat(values, starts, axis=-1),
+        "max": np.fmax.reduceat(values, starts, axis=-1),
+    }
+
+    if mask_weights is not None:
+        partials["mask_total"] = mask_total
+
+    return partials
+
+
+class ZonePartials():
+    """
+    Merges the partial statistics of the tiles of a batch of dates into zone statistics.
+
+    Sums and counts are added, minima and maxima combined, and the sums of
+    squared deviations merged with the parallel variance formula, so the result
+    matches a reduction over all the pixels of every zone at once.
+
+    Attributes:
+        n_dates (int): Number of dates of the batch.
+        n_zones (int): Number of zones.
+    """
+
+    def __init__(self, n_dates, n_zones):
+
+        self.n_dates = n_dates
+        self.n_zones = n_zones
+        self.count = np.zeros((n_dates, n_zones), dtype='int64')
+        self.weight = np.zeros((n_dates, n_zones))
+        self.total = np.zeros((n_dates, n_zones))
+        self.plain = np.zeros((n_dates, n_zones))
+        self.m2 = np.zeros((n_dates, n_zones))
+        self.mask_total = np.zeros((n_dates, n_zones))
+        self.min = np.full((n_dates, n_zones), np.nan)
+        self.max = np.full((n_dates, n_zones), np.nan)
+
+    def add(self, zones, partials):
+        """
+        Merges the partials of the zones of one tile.
+
+        Args:
+            zones (ndarray): Ids of the zones of the tile.
+            partials (dict): Partial statistics from `tile_partials`.
+        """
+        weight_a, weight_b = self.weight[:, zones], partials["weight"]
+        merged = weight_a + weight_b
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.where(weight_b > 0, partials["total"] / weight_b, 0.0) - np.where(
+                weight_a > 0, self.total[:, zones] / weight_a, 0.0)
+            correction = np.where(
+                (weight_a > 0) & (weight_b > 0),
+                delta ** 2 * weight_a * weight_b / merged, 0.0)
+
+        self.m2[:, zones] += partials["m2"] + correction
+        self.weight[:, zones] = merged
+        self.total[:, zones] += partials["total"]
+        self.plain[:, zones] += partials["plain"]
+        self.count[:, zones] += partials["count"]
+        self.min[:, zones] = np.fmin(self.min[:, zones], partials["min"])
+        self.max[:, zones] = np.fmax(self.max[:, zones], partials["max"])
+
+        if "mask_total" in partials:
+            self.mask_total[:, zones] += partials["mask_total"]
+
+    def mean(self, calculation_mode="overall_mean", weight_sum=None):
+        """
+        Returns the mean of every zone and date following the calculation mode.
+
+        Args:
+            calculation_mode (str): 'overall_mean', 'weighted_mean' or 'filtered_mean'.
+            weight_sum (ndarray, optional): Sum of the mask weights of every zone, with the
+                mask in 'weighted_mean' mode.
+
+        Returns:
+            ndarray: Array of shape (n_dates, n_zones), NaN for zones without valid pixels.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if weight_sum is not None and calculation_mode == "weighted_mean":
+                return np.where(weight_sum > 0, self.mask_total / weight_sum, np.nan)
+
+            mean = np.where(self.weight > 0, self.total / self.weight, np.nan)
+
+        if weight_sum is not None and calculation_mode == "filtered_mean":
+            return np.where(self.plain > 0, mean, np.nan)
+
+        return mean
+
+    def statistics(self, stats, mean, coverage=False):
+        """
+        Returns several statistics of every zone and date.
+
+        Args:
+            stats (list of str): Statistics among `MERGEABLE_STATISTICS`.
+            mean (ndarray): The mean of every zone and date, from `mean`.
+            coverage (bool): Whether the pixels were weighted by coverage fractions, which
+                also weight the sum.
+
+        Returns:
+            ndarray: Array of shape (n_dates, n_zones, len(stats)).
+        """
+        out = np.full((self.n_dates, self.n_zones, len(stats)), np.nan)
+
+        for column, stat in enumerate(stats):
+            if stat == 'mean':
+                out[..., column] = mean
+            elif stat == 'sum':
+                out[..., column] = self.total if coverage else self.plain
+            elif stat == 'count':
+                out[..., column] = self.count
+            elif stat == 'min':
+                out[..., column] = self.min
+            elif stat == 'max':
+                out[..., column] = self.max
+            else:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    out[..., column] = np.where(
+                        self.weight > 0, np.sqrt(self.m2 / self.weight), np.nan)
+
+        return out
+
@@ -0,0 +1,680 @@
+import warnings
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio import windows
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+
+from .raster_io import pixel_window
+
+
+class ZoneIndex():
+    """
+    A reusable rasterization of shapefile geometries on a raster grid.
+
+    The pixels of every zone are stored in a compressed sparse row (CSR) layout:
+    zone ``i`` covers the flat pixel positions ``indices[indptr[i]:indptr[i + 1]]``
+    of ``window``, the union bounding window of all zones. Building the index once
+    replaces rasterizing every geometry again for every raster.
+
+    Attributes:
+        indptr (ndarray): Offsets of each zone in `indices`, of length n_zones + 1.
+        indices (ndarray): Flat pixel positions inside `window`.
+        window (Window): Union bounding window of all zones on the raster grid.
+        shape (tuple): Height and width of the full raster grid.
+        transform (Affine): Affine transform of the full raster grid.
+        all_touched (bool): Whether all pixels touching a geometry were included.
+        coverage (ndarray): Fraction of every entry in `indices` covered by its zone, or
+            None when pixels are either in or out of a zone.
+    """
+
+    def __init__(self, indptr, indices, window, shape, transform, all_touched=False,
+                 coverage=None):
+
+        self.indptr = np.asarray(indptr, dtype='int64')
+        self.indices = np.asarray(indices, dtype='int64')
+        self.window = window
+        self.shape = tuple(shape)
+        self.transform = transform
+        self.all_touched = all_touched
+        self.coverage = None if coverage is None else np.asarray(coverage, dtype='float64')
+
+    @property
+    def n_zones(self):
+        return len(self.indptr) - 1
+
+    @property
+    def counts(self):
+        """Number of pixels covered by each zone."""
+        return np.diff(self.indptr)
+
+    @property
+    def labels(self):
+        """Zone id of every entry in `indices`."""
+        return np.repeat(np.arange(self.n_zones), self.counts)
+
+    @classmethod
+    def from_geometries(cls, geometries, transform, out_shape, all_touched=False,
+                        coverage=False):
+        """
+        Rasterizes geometries once against a raster grid.
+
+        Each geometry is burned only inside its own bounding window, so small
+        polygons stay cheap on large grids.
+
+        Args:
+            geometries (iterable): Shapely geometries, one per zone.
+            transform (Affine): Affine transform of the raster grid.
+            out_shape (tuple): Height and width of the raster grid.
+            all_touched (bool): Include all pixels that touch a geometry.
+            coverage (bool): Compute the exact fraction of every pixel covered by its
+                geometry. Every touched pixel is included, weighted by its fraction.
+
+        Returns:
+            ZoneIndex: The zone index of the geometries on the grid.
+        """
+        height, width = out_shape
+        zone_pixels = []
+        fractions = []
+
+        for geom in geometries:
+            rows, cols = _rasterize_geometry(
+                geom, transform, height, width, all_touched or coverage)
+
+            if coverage:
+                zone_fractions = _coverage_fractions(geom, rows, cols, transform)
+                covered = zone_fractions > 0
+                rows, cols = rows[covered], cols[covered]
+                fractions.append(zone_fractions[covered])
+
+            zone_pixels.append((rows, cols))
+
+        rows = np.concatenate([r for r, _ in zone_pixels] + [np.empty(0, 'int64')])
+        cols = np.concatenate([c for _, c in zone_pixels] + [np.empty(0, 'int64')])
+
+        if rows.size:
+            row_off, col_off = int(rows.min()), int(cols.min())
+            window = Window(col_off, row_off,
+                            int(cols.max()) - col_off + 1,
+                            int(rows.max()) - row_off + 1)
+        else:
+            window = Window(0, 0, 0, 0)
+
+        indices = (rows - window.row_off) * window.width + (cols - window.col_off)
+        indptr = np.concatenate(
+            ([0], np.cumsum([r.size for r, _ in zone_pixels], dtype='int64')))
+
+        if coverage:
+            coverage = np.concatenate(fractions + [np.empty(0, 'float64')])
+        else:
+            coverage = None
+
+        return cls(indptr, indices, window, out_shape, transform, all_touched,
+                   coverage)
+
+    def entries(self, zone_ids):
+        """
+        Positions of the pixels of some zones among the entries of the index.
+
+        Args:
+            zone_ids (array-like): Ids of the zones.
+
+        Returns:
+            ndarray: Positions in `indices`, zone after zone in the order of zone_ids.
+        """
+        zone_ids = np.asarray(zone_ids, dtype='int64')
+        counts = self.counts[zone_ids]
+        offsets = np.cumsum(counts) - counts
+
+        return np.repeat(self.indptr[zone_ids] - offsets, counts) + np.arange(counts.sum())
+
+    def subset(self, zone_ids):
+        """
+        Returns the index of some of the zones, on the same grid and window.
+
+        The values gathered with this index are restricted to the zones with
+        ``values[..., index.entries(zone_ids)]``.
+
+        Args:
+            zone_ids (array-like): Ids of the zones, in the zone order of the new index.
+
+        Returns:
+            ZoneIndex: The index of the zones.
+        """
+        entries = self.entries(zone_ids)
+        indptr = np.concatenate(([0], np.cumsum(self.counts[np.asarray(zone_ids, 'int64')])))
+        coverage = None if self.coverage is None else self.coverage[entries]
+
+        return ZoneIndex(indptr, self.indices[entries], self.window, self.shape,
+                         self.transform, self.all_touched, coverage)
+
+    def check_grid(self, src):
+        """
+        Raises a ValueError if an open raster is not on the grid of the index.
+
+        Args:
+            src (DatasetReader): An open rasterio dataset.
+        """
+        if src.shape != self.shape or not src.transform.almost_equals(self.transform):
+            raise ValueError(
+                f"Raster {src.name} does not match the zone index grid. "
+                "All rasters must share the same shape and transform.")
+
+    def gather_grid(self, array):
+        """
+        Gathers the pixels of every zone from an array covering the full grid.
+
+        Args:
+            array (ndarray): Array of shape (..., height, width) on the grid of the index.
+
+        Returns:
+            ndarray: Array of shape (..., n_pixels) ordered zone by zone.
+        """
+        rows, cols = self.window.toslices()
+        return self.gather(array[..., rows, cols])
+
+    def gather(self, block):
+        """
+        Gathers the pixels of every zone from a block read over `window`.
+
+        Args:
+            block (ndarray): Array of shape (..., window height, window width).
+
+        Returns:
+            ndarray: Array of shape (..., n_pixels) ordered zone by zone.
+        """
+        flat = block.reshape(block.shape[:-2] + (-1,))
+        return flat[..., self.indices]
+
+
+def buildZoneIndex(raster_path, shape_file, all_touched=False, cache_dir=None,
+                   coverage=False):
+    """
+    Builds a zone index of a shapefile on the grid of a raster.
+
+    Args:
+        raster_path (str): Path to a raster sharing the grid of the predictor data.
+        shape_file (GeoDataFrame): Loaded shapefile for geometries.
+        all_touched (bool): Consider all pixels that touch geometry for masking.
+        cache_dir (str, optional): Directory of a persistent zone index cache. Runs
+            with the same geometries and grid then skip the rasterization.
+        coverage (bool): Weight every pixel by the fraction of its area covered by the geometry.
+
+    Returns:
+        ZoneIndex: The zone index of the shapefile geometries.
+    """
+    with rasterio.open(raster_path) as src:
+        transform = src.transform
+        out_shape = src.shape
+
+    if cache_dir:
+        from .zone_index_cache import cachedZoneIndex
+        return cachedZoneIndex(
+            shape_file.geometry, transform, out_shape, all_touched=all_touched,
+            cache_dir=cache_dir, coverage=coverage)
+
+    return ZoneIndex.from_geometries(
+        shape_file.geometry, transform, out_shape, all_touched=all_touched,
+        coverage=coverage)
+
+
+def zonal_sum(values, zone_index):
+    """
+    Sums gathered zone values, skipping NaN, in one vectorized pass.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones), 0 for zones without valid pixels.
+    """
+    values = np.where(np.isnan(values), 0, values).astype('float64')
+    return _segment_reduce(np.add, values, zone_index.indptr, 0.0)
+
+
+def zonal_count(valid, zone_index):
+    """
+    Counts the valid gathered pixels of every zone.
+
+    Args:
+        valid (ndarray): Boolean array of shape (..., n_pixels).
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones).
+    """
+    return _segment_reduce(
+        np.add, valid.astype('int64'), zone_index.indptr, 0)
+
+
+def zonal_mean(values, zone_index, weights=None):
+    """
+    Computes the NaN-skipping, optionally weighted, mean of every zone.
+
+    With coverage fractions in the zone index, every pixel is additionally weighted
+    by its covered fraction.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+        weights (ndarray, optional): Per-pixel weights broadcastable to `values`.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones), NaN for zones without valid pixels.
+    """
+    valid = ~np.isnan(values)
+
+    if zone_index.coverage is not None:
+        weights = zone_index.coverage if weights is None else weights * zone_index.coverage
+
+    if weights is None:
+        weights = valid.astype('float64')
+    else:
+        weights = np.where(valid, weights, 0).astype('float64')
+
+    total = zonal_sum(values * weights, zone_index)
+    weight_sum = _segment_reduce(np.add, weights, zone_index.indptr, 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weight_sum > 0, total / weight_sum, np.nan)
+
+
+def zonal_min(values, zone_index):
+    """
+    Computes the NaN-skipping minimum of every zone.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones), NaN for zones without valid pixels.
+    """
+    return _segment_reduce(
+        np.fmin, values.astype('float64'), zone_index.indptr, np.nan)
+
+
+def zonal_max(values, zone_index):
+    """
+    Computes the NaN-skipping maximum of every zone.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones), NaN for zones without valid pixels.
+    """
+    return _segment_reduce(
+        np.fmax, values.astype('float64'), zone_index.indptr, np.nan)
+
+
+def zonal_median(values, zone_index, method="exact", bins=1000):
+    """
+    Computes the NaN-skipping median of every zone.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+        method (str): Percentile method, see `zonal_percentiles`.
+        bins (int): Number of histogram bins of the sketch.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones), NaN for zones without valid pixels.
+    """
+    return zonal_percentiles(values, zone_index, [50], method, bins)[..., 0]
+
+
+PERCENTILE_METHODS = ('exact', 'sketch', 'auto')
+
+# With method 'auto', zones with more pixels than this many per bin use the sketch
+SKETCH_PIXELS_PER_BIN = 100
+
+# Number of values binned at once by the sketch
+SKETCH_CHUNK_SIZE = 2 ** 22
+
+
+def zonal_percentiles(values, zone_index, q, method="exact", bins=1000):
+    """
+    Computes NaN-skipping percentiles of every zone, all percentiles in one pass.
+
+    The 'exact' method sorts every zone segment of the compact pixel array and
+    interpolates linearly, like `numpy.nanpercentile`. The 'sketch' method
+    builds a histogram of `bins` bins between the minimum and maximum of every zone
+    instead of sorting, in linear time: the error is at most the zone value range
+    divided by `bins`. 'auto' uses the sketch for zones larger than
+    `SKETCH_PIXELS_PER_BIN * bins` pixels only.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+        q (list of float): Percentiles between 0 and 100.
+        method (str): 'exact', 'sketch' or 'auto'.
+        bins (int): Number of histogram bins of the sketch, the accuracy/speed knob.
+
+    Raises:
+        ValueError: If method is not one of the options.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones, len(q)), NaN for zones without valid pixels.
+    """
+    if method not in PERCENTILE_METHODS:
+        raise ValueError(
+            f"Invalid percentile method: {method}. Options are 'exact', 'sketch', 'auto'.")
+
+    values = values.astype('float64')
+    q = np.asarray(q, dtype='float64') / 100
+
+    if method == "exact":
+        sketched = np.zeros(zone_index.n_zones, dtype=bool)
+    elif method == "sketch":
+        sketched = zone_index.counts > 0
+    else:
+        sketched = zone_index.counts > SKETCH_PIXELS_PER_BIN * bins
+
+    out = _sorted_percentiles(values, zone_index, q, skip=sketched)
+
+    for zone_id in np.flatnonzero(sketched):
+        start, stop = zone_index.indptr[zone_id], zone_index.indptr[zone_id + 1]
+        out[..., zone_id, :] = _sketch_percentiles(
+            values[..., start:stop], q, bins)
+
+    return out
+
+
+def _sorted_percentiles(values, zone_index, q, skip):
+    """Linear-interpolation percentiles of every zone from a segment-wise sort."""
+    indptr = zone_index.indptr
+    sorted_values = values.copy()
+
+    # NaN sort last within every zone segment, skipped zones are left unsorted
+    for zone_id in np.flatnonzero((zone_index.counts > 0) & ~skip):
+        start, stop = indptr[zone_id], indptr[zone_id + 1]
+        sorted_values[..., start:stop].sort(axis=-1)
+
+    counts = zonal_count(~np.isnan(values), zone_index)
+
+    position = q * (counts[..., np.newaxis] - 1)
+    low = np.floor(position)
+    fraction = position - low
+    start = zone_index.indptr[:-1, np.newaxis]
+    # Zones without pixels past the last pixel read any pixel, they are NaN anyway
+    last = np.minimum(start + np.maximum(counts[..., np.newaxis] - 1, 0),
+                      max(values.shape[-1] - 1, 0))
+    start = np.minimum(start, last)
+
+    low_index = np.clip(start + low.astype('int64'), start, last)
+    high_index = np.minimum(low_index + 1, last)
+
+    shape = values.shape[:-1] + (-1,)
+    below = np.take_along_axis(
+        sorted_values, low_index.reshape(shape), axis=-1).reshape(low.shape)
+    above = np.take_along_axis(
+        sorted_values, high_index.reshape(shape), axis=-1).reshape(low.shape)
+
+    difference = above - below
+    out = np.where(fraction >= 0.5, above - difference * (1 - fraction),
+                   below + difference * fraction)
+    out[counts == 0] = np.nan
+
+    return out
+
+
+def _sketch_percentiles(values, q, bins):
+    """Percentiles of one zone from a fixed-size histogram per row, in linear time."""
+    rows = values.reshape(-1, values.shape[-1])
+    out = np.full((rows.shape[0], len(q)), np.nan)
+
+    # Rows are binned in chunks, so the temporary arrays stay small whatever the zone size
+    chunk = max(SKETCH_CHUNK_SIZE // max(rows.shape[-1], 1), 1)
+
+    for start in range(0, rows.shape[0], chunk):
+        out[start:start + chunk] = _histogram_percentiles(
+            rows[start:start + chunk], q, bins)
+
+    return out.reshape(values.shape[:-1] + (len(q),))
+
+
+def _histogram_percentiles(rows, q, bins):
+    """Percentiles of every row of a 2D array from a histogram of `bins` bins per row."""
+    out = np.full((rows.shape[0], len(q)), np.nan)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low = np.nanmin(rows, axis=-1)
+        high = np.nanmax(rows, axis=-1)
+
+    valid = ~np.isnan(rows)
+    counts = valid.sum(axis=-1)
+    width = np.where(high > low, (high - low) / bins, 1)
+    n_cells = rows.shape[0] * bins
+
+    # Bin of every pixel, counted per row with a single bincount, NaN in a last extra cell
+    bin_index = (rows - low[:, np.newaxis]) / width[:, np.newaxis]
+    np.clip(bin_index, 0, bins - 1, out=bin_index)
+    keys = bin_index.astype('int64')
+    keys += (np.arange(rows.shape[0]) * bins)[:, np.newaxis]
+    keys[~valid] = n_cells
+    histogram = np.bincount(
+        keys.ravel(), minlength=n_cells + 1)[:n_cells].reshape(-1, bins)
+    cumulative = np.cumsum(histogram, axis=-1)
+
+    last = np.maximum(counts - 1, 0)
+
+    # Interpolated between the neighbouring ranks like the exact method
+    for column, quantile in enumerate(q):
+        position = quantile * last
+        below = np.floor(position)
+        fraction = position - below
+        lower = _binned_order_statistic(histogram, cumulative, below, low, high, width)
+        upper = _binned_order_statistic(
+            histogram, cumulative, np.minimum(below + 1, last), low, high, width)
+        out[:, column] = lower + (upper - lower) * fraction
+
+    out[counts == 0] = np.nan
+
+    return out
+
+
+def _binned_order_statistic(histogram, cumulative, rank, low, high, width):
+    """Value of the pixel of a rank in every row, placed linearly inside the bin holding it."""
+    bins = histogram.shape[-1]
+    bin_id = np.minimum(
+        (cumulative <= rank[:, np.newaxis]).sum(axis=-1), bins - 1)[:, np.newaxis]
+    in_bin = np.take_along_axis(histogram, bin_id, axis=-1)[:, 0]
+    before = np.take_along_axis(cumulative, bin_id, axis=-1)[:, 0] - in_bin
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.clip((rank - before + 0.5) / in_bin, 0, 1)
+
+    return np.clip(low + (bin_id[:, 0] + offset) * width, low, high)
+
+
+def zonal_std(values, zone_index, weights=None):
+    """
+    Computes the NaN-skipping, optionally weighted, population standard deviation of every zone.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+        weights (ndarray, optional): Per-pixel weights broadcastable to `values`.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones), NaN for zones without valid pixels.
+    """
+    mean = zonal_mean(values, zone_index, weights)
+    deviation = values - mean[..., zone_index.labels]
+    return np.sqrt(zonal_mean(deviation ** 2, zone_index, weights))
+
+
+STATISTICS = ('mean', 'median', 'min', 'max', 'sum', 'std', 'count')
+
+
+def parse_statistic(stat):
+    """
+    Validates a statistic name.
+
+    Args:
+        stat (str): One of `STATISTICS`, or a percentile such as 'p90' or 'p2.5'.
+
+    Raises:
+        ValueError: If stat is not a valid statistic.
+
+    Returns:
+        tuple: The statistic name, 'percentile' for percentiles, and the percentile or None.
+    """
+    if stat in STATISTICS:
+        return stat, None
+
+    if isinstance(stat, str) and stat.startswith('p'):
+        try:
+            q = float(stat[1:])
+        except ValueError:
+            q = None
+
+        if q is not None and 0 <= q <= 100:
+            return 'percentile', q
+
+    raise ValueError(
+        f"Invalid stat: {stat}. Options are 'mean', 'median', 'min', 'max', 'sum', "
+        "'std', 'count' or a percentile such as 'p90'.")
+
+
+def zonal_statistics(values, zone_index, stats, weights=None,
+                     percentile_method="exact", percentile_bins=1000):
+    """
+    Computes several NaN-skipping statistics of every zone from one gathered block.
+
+    The block is read and masked once for all statistics, and all percentiles,
+    including the median, share one pass per zone.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+        stats (list of str): Statistics, see `parse_statistic`. 'count' is the number
+            of valid pixels.
+        weights (ndarray, optional): Per-pixel weights of the mean and the std.
+        percentile_method (str): Method of the median and percentiles, see `zonal_percentiles`.
+        percentile_bins (int): Number of histogram bins of the percentile sketch.
+
+    Raises:
+        ValueError: If a statistic or the percentile method is not valid.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones, len(stats)).
+
+    With coverage fractions in the zone index, the mean, std and sum weight every
+    pixel by its covered fraction, the other statistics use every covered pixel.
+    """
+    parsed = [parse_statistic(stat) for stat in stats]
+    values = values.astype('float64')
+    out = np.full(values.shape[:-1] + (zone_index.n_zones, len(stats)), np.nan)
+
+    quantiles = [50 if name == 'median' else q for name, q in parsed
+                 if name in ('median', 'percentile')]
+    if quantiles:
+        percentiles = zonal_percentiles(
+            values, zone_index, quantiles, percentile_method, percentile_bins)
+
+    position = 0
+    for column, (name, q) in enumerate(parsed):
+
+        if name in ('median', 'percentile'):
+            out[..., column] = percentiles[..., position]
+            position += 1
+        elif name == 'mean':
+            out[..., column] = zonal_mean(values, zone_index, weights)
+        elif name == 'std':
+            out[..., column] = zonal_std(values, zone_index, weights)
+        elif name == 'min':
+            out[..., column] = zonal_min(values, zone_index)
+        elif name == 'max':
+            out[..., column] = zonal_max(values, zone_index)
+        elif name == 'count':
+            out[..., column] = zonal_count(~np.isnan(values), zone_index)
+        elif zone_index.coverage is not None:
+            out[..., column] = zonal_sum(values * zone_index.coverage, zone_index)
+        else:
+            out[..., column] = zonal_sum(values, zone_index)
+
+    return out
+
+
+def zonal_statistic(values, zone_index, stat="mean", percentile_method="exact"):
+    """
+    Computes a NaN-skipping statistic of every zone in one pass over the zone pixels.
+
+    Args:
+        values (ndarray): Array of shape (..., n_pixels) from `ZoneIndex.gather`.
+        zone_index (ZoneIndex): The zone index the values were gathered with.
+        stat (str): A statistic accepted by `zonal_statistics`.
+        percentile_method (str): Method of the median and percentiles, see `zonal_percentiles`.
+
+    Raises:
+        ValueError: If stat is not valid.
+
+    Returns:
+        ndarray: Array of shape (..., n_zones).
+    """
+    return zonal_statistics(
+        values, zone_index, [stat], percentile_method=percentile_method)[..., 0]
+
+
+def _segment_reduce(ufunc, values, indptr, empty):
+    """Reduces contiguous zone segments of the last axis, filling empty zones."""
+    counts = np.diff(indptr)
+    out = np.full(values.shape[:-1] + (len(counts),), empty, dtype=values.dtype)
+    nonempty = counts > 0
+
+    if nonempty.any():
+        out[..., nonempty] = ufunc.reduceat(
+            values, indptr[:-1][nonempty], axis=-1)
+
+    return out
+
+
+def _rasterize_geometry(geom, transform, height, width, all_touched):
+    """Returns the row and column of every grid pixel covered by a geometry."""
+    empty = (np.empty(0, 'int64'), np.empty(0, 'int64'))
+
+    if geom is None or geom.is_empty:
+        return empty
+
+    window = pixel_window(geom, transform, (height, width))
+
+    if window is None:
+        return empty
+
+    geom_mask = geometry_mask(
+        [geom], out_shape=(window.height, window.width),
+        transform=windows.transform(window, transform), invert=True,
+        all_touched=all_touched)
+
+    rows, cols = np.nonzero(geom_mask)
+    return (rows.astype('int64') + window.row_off,
+            cols.astype('int64') + window.col_off)
+
+
+def _coverage_fractions(geom, rows, cols, transform):
+    """Returns the fraction of every grid pixel covered by a geometry, vectorized over pixels."""
+    if rows.size == 0:
+        return np.empty(0, 'float64')
+
+    x0, y0 = transform * (cols, rows)
+    x1, y1 = transform * (cols + 1, rows + 1)
+    cells = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1),
+                        np.maximum(x0, x1), np.maximum(y0, y1))
+    cell_area = abs(transform.a * transform.e - transform.b * transform.d)
+
+    shapely.prepare(geom)
+    fractions = np.ones(rows.size, dtype='float64')
+
+    # Only cells crossed by the boundary need an intersection
+    border = ~shapely.contains_properly(geom, cells)
+    fractions[border] = shapely.area(
+        shapely.intersection(cells[border], geom)) / cell_area
+
+    return np.clip(fractions, 0, 1)
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import shapely
+from affine import Affine
+from rasterio.windows import Window
+
+from .zone_index import ZoneIndex
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "earthstat", "zone_index")
+
+# Bumped whenever the rasterization or the file layout changes
+CACHE_VERSION = 1
+
+
+class ZoneIndexCache():
+    """
+    A persistent, content-addressed cache of zone indexes.
+
+    Entries are keyed on the geometries, the grid transform and shape and the
+    `all_touched` and `coverage` options, so runs against the same boundaries and
+    the same grid reuse the rasterization of a previous run. Every entry is a
+    compressed `.npz` file of the sparse zone pixel indices. When the cache grows
+    beyond `max_size`, the least recently used entries are evicted.
+
+    Attributes:
+        cache_dir (str): Directory of the cache entries.
+        max_size (int): Maximum total size of the entries in bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_size=1024 ** 3):
+
+        self.cache_dir = cache_dir if cache_dir else DEFAULT_CACHE_DIR
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(geometries, transform, out_shape, all_touched=False, coverage=False):
+        """
+        Returns the content hash of a rasterization.
+
+        Args:
+            geometries (iterable): Shapely geometries, one per zone.
+            transform (Affine): Affine transform of the raster grid.
+            out_shape (tuple): Height and width of the raster grid.
+            all_touched (bool): Include all pixels that touch a geometry.
+            coverage (bool): Whether the coverage fractions are computed.
+
+        Returns:
+            str: Hexadecimal SHA-256 of the geometries and grid.
+        """
+        digest = hashlib.sha256()
+        digest.update(f"v{CACHE_VERSION}|{tuple(transform)[:6]}|"
+                      f"{tuple(out_shape)}|{bool(all_touched)}|{bool(coverage)}".encode())
+
+        for wkb in shapely.to_wkb(np.asarray(list(geometries), dtype=object)):
+            digest.update(wkb if wkb is not None else b"")
+            digest.update(b"|")
+
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        """
+        Loads a cached zone index.
+
+        Args:
+            key (str): Key returned by `key`.
+
+        Returns:
+            ZoneIndex: The cached zone index, or None on a cache miss.
+        """
+        path = self.path(key)
+
+        try:
+            with np.load(path) as entry:
+                zone_index = ZoneIndex(
+                    entry["indptr"], entry["indices"], Window(*entry["window"]),
+                    tuple(entry["shape"]), Affine(*entry["transform"]),
+                    bool(entry["all_touched"]),
+                    entry["coverage"] if "coverage" in entry.files else None)
+
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            return None
+
+        # The modification time tracks the last use for the LRU eviction
+        os.utime(path)
+
+        return zone_index
+
+    def put(self, key, zone_index):
+        """
+        Stores a zone index and evicts old entries beyond the size limit.
+
+        Args:
+            key (str): Key returned by `key`.
+            zone_index (ZoneIndex): The zone index to store.
+        """
+        window = zone_index.window
+        arrays = {} if zone_index.coverage is None else {"coverage": zone_index.coverage}
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=self.cache_dir)
+
+        # Written to a temporary file first, so concurrent runs never read partial entries
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(
+                f, indptr=zone_index.indptr, indices=zone_index.indices,
+                window=np.array([window.col_off, window.row_off,
+                                 window.width, window.height], dtype='int64'),
+                shape=np.array(zone_index.shape, dtype='int64'),
+                transform=np.array(tuple(zone_index.transform)[:6]),
+                all_touched=np.array(zone_index.all_touched), **arrays)
+
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in max_size."""
+        entries = []
+
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def cachedZoneIndex(geometries, transform, out_shape, all_touched=False,
+                    cache_dir=None, max_cache_size=1024 ** 3, coverage=False):
+    """
+    Returns the zone index of geometries on a grid, rasterizing only on a cache miss.
+
+    Args:
+        geometries (iterable): Shapely geometries, one per zone.
+        transform (Affine): Affine transform of the raster grid.
+        out_shape (tuple): Height and width of the raster grid.
+        all_touched (bool): Include all pixels that touch a geometry.
+        cache_dir (str, optional): Cache directory, defaults to ~/.cache/earthstat/zone_index.
+        max_cache_size (int): Maximum size of the cache in bytes.
+        coverage (bool): Compute the fraction of every pixel covered by its geometry.
+
+    Returns:
+        ZoneIndex: The zone index of the geometries on the grid.
+    """
+    geometries = list(geometries)
+    cache = ZoneIndexCache(cache_dir, max_size=max_cache_size)
+    key = cache.key(geometries, transform, out_shape, all_touched, coverage)
+
+    zone_index = cache.get(key)
+
+    if zone_index is None:
+        zone_index = ZoneIndex.from_geometries(
+            geometries, transform, out_shape, all_touched=all_touched,
+            coverage=coverage)
+        cache.put(key, zone_index)
+
+    return zone_index
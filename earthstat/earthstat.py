@@ -8,6 +8,9 @@ from .geo_data_processing.shapefile_process import filterShapefile as extractROI
 from .geo_data_processing.clip_raster import clipMultipleRasters as clipRaster
 from .analysis_aggregation.aggregate_process import conAggregate
 from .analysis_aggregation.parallel_clip_aggregate import parallelAggregate
+from .analysis_aggregation.output_sink import outputPath
+from .analysis_aggregation.raster_cube import buildCube
+from .analysis_aggregation.tile_scheduler import TILE_SIZE, TIME_BATCH
 from .utils import loadTiff
 
 import os
@@ -30,6 +33,7 @@ class EarthStat():
         predictory_meta, mask_meta, shapefile_meta (dict): Metadata for respective data types.
         ROI (GeoDataFrame): Selected region of interest.
         clipped_dir (str): Directory containing clipped raster data.
+        cube_dir (str): Directory of the memory-mapped cube of the predictor data, if built.
         aggregated_csv (str): Path to the output aggregated CSV file.
     """
 
@@ -52,6 +56,7 @@ class EarthStat():
         # Modified Data
         self.ROI = None
         self.clipped_dir = None
+        self.cube_dir = None
 
         # Aggregated Data path
         self.aggregated_csv = None
@@ -257,7 +262,9 @@ class EarthStat():
     def clipPredictor(
 
         self,
-        invalid_values=None
+        invalid_values=None,
+        max_workers=None,
+        executor="process"
 
     ):
         """
@@ -265,6 +272,8 @@ class EarthStat():
 
         Args:
             invalid_values (list, optional): List of values to treat as invalid in the raster data.
+            max_workers (int, optional): Number of workers, defaults to all cores.
+            executor (str): 'process' or 'thread', which shares the shapefile between threads.
         """
 
         print("Clipping the predictor data...")
@@ -275,7 +284,9 @@ class EarthStat():
 
                 self.predictor_paths,
                 self.ROI,
-                invalid_values=invalid_values
+                invalid_values=invalid_values,
+                max_workers=max_workers,
+                executor=executor
 
             )
 
@@ -287,7 +298,9 @@ class EarthStat():
 
                 self.predictor_paths,
                 self.shapefile_path,
-                invalid_values=invalid_values
+                invalid_values=invalid_values,
+                max_workers=max_workers,
+                executor=executor
 
             )
 
@@ -297,13 +310,39 @@ class EarthStat():
             print(
                 "Failed to clip the predictor data. Check the shapefile and predictor paths")
 
+    def buildCube(self, cube_dir=None):
+        """
+        Converts the predictor data into a memory-mapped cube read by the next 'zone_index' runs.
+
+        Args:
+            cube_dir (str, optional): Directory of the cube, a 'cube' folder of the predictor
+                directory by default. An up-to-date cube is reused.
+        """
+
+        print("Building the predictor cube...")
+
+        cube = buildCube(self.predictor_dir, cube_dir)
+        self.cube_dir = cube.directory
+
+        print(f"Cube of {len(cube.paths)} rasters saved to {self.cube_dir}.")
+
     def runAggregation(
 
         self,
         use_mask=False,
         invalid_values=None,
         calculation_mode="overall_mean",
-        all_touched=False
+        all_touched=False,
+        engine="zone_index",
+        output_format="csv",
+        zone_cache_dir=None,
+        coverage=False,
+        stats=None,
+        incremental=False,
+        checkpoint_dir=None,
+        resume=False,
+        retries=0,
+        skip_failed=False
 
     ):
         """
@@ -314,15 +353,27 @@ class EarthStat():
             invalid_values (list, optional): List of values to treat as invalid in the raster data.
             calculation_mode (str): Determines how values are aggregated.
             all_touched (bool): Whether to include all pixels that touch the geometry in the aggregation.
+            engine (str): 'zone_index' to rasterize the shapefile once for all rasters, or 'mask'.
+            output_format (str): 'csv', 'parquet' (partitioned by year and variable) or 'feather'.
+            zone_cache_dir (str, optional): Directory of a persistent zone index cache reused across runs.
+            coverage (bool): Weight every pixel by the exact fraction of its area covered by the geometry.
+            stats (list of str, optional): Statistics computed in one pass, one output column each.
+            incremental (bool): Only aggregate the rasters new or changed since the last incremental run,
+                merging their rows into its output, which is named without a timestamp.
+            checkpoint_dir (str, optional): Directory where the aggregated blocks are saved during the run.
+            resume (bool): Resume the interrupted run from checkpoint_dir, skipping its aggregated rasters.
+            retries (int): Number of times a raster failing to aggregate is attempted again.
+            skip_failed (bool): Skip the rasters that still fail after the retries instead of stopping.
         """
 
         print("Starting aggregation...")
 
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-        aggregate_output = (
-            f'Aggregated_{calculation_mode}_{self.predictor_name}_'
-            f'{timestamp}.csv'
+        # Incremental runs continue the same output
+        aggregate_output = outputPath(
+            f'Aggregated_{calculation_mode}_{self.predictor_name}'
+            f'{"" if incremental else "_" + timestamp}', output_format
         )
 
         # Check if a Region of Interest (ROI) has been selected for aggregation
@@ -341,7 +392,18 @@ class EarthStat():
                 invalid_values,
                 calculation_mode,
                 predictor_name=self.predictor_name,
-                all_touched=all_touched
+                all_touched=all_touched,
+                engine=engine,
+                output_format=output_format,
+                zone_cache_dir=zone_cache_dir,
+                coverage=coverage,
+                stats=stats,
+                incremental=incremental,
+                checkpoint_dir=checkpoint_dir,
+                resume=resume,
+                retries=retries,
+                skip_failed=skip_failed,
+                cube_dir=self.cube_dir if engine == "zone_index" else None
             )
 
         else:
@@ -359,7 +421,18 @@ class EarthStat():
                 invalid_values,
                 calculation_mode,
                 predictor_name=self.predictor_name,
-                all_touched=all_touched
+                all_touched=all_touched,
+                engine=engine,
+                output_format=output_format,
+                zone_cache_dir=zone_cache_dir,
+                coverage=coverage,
+                stats=stats,
+                incremental=incremental,
+                checkpoint_dir=checkpoint_dir,
+                resume=resume,
+                retries=retries,
+                skip_failed=skip_failed,
+                cube_dir=self.cube_dir if engine == "zone_index" else None
             )
 
         print(f"Aggregation complete. Data saved to {aggregate_output}.")
@@ -371,7 +444,23 @@ class EarthStat():
         invalid_values=None,
         calculation_mode="overall_mean",
         all_touched=False,
-        max_workers=None
+        max_workers=None,
+        engine="zone_index",
+        output_format="csv",
+        zone_cache_dir=None,
+        coverage=False,
+        stats=None,
+        incremental=False,
+        checkpoint_dir=None,
+        resume=False,
+        retries=0,
+        skip_failed=False,
+        executor="process",
+        client=None,
+        tile_size=TILE_SIZE,
+        time_batch=TIME_BATCH,
+        batch_size=1,
+        memory_budget=None
 
     ):
         """
@@ -382,14 +471,37 @@ class EarthStat():
             invalid_values (list, optional): List of values to treat as invalid in the raster data.
             calculation_mode (str): Determines how values are aggregated.
             all_touched (bool): Whether to include all pixels that touch the geometry in the aggregation.
+            max_workers (int, optional): Number of workers.
+            engine (str): 'zone_index' to rasterize the shapefile once for all rasters, 'tiled' to also
+                split the grid into block-aligned tiles processed by batches of rasters, or 'mask'.
+            output_format (str): 'csv', 'parquet' (partitioned by year and variable) or 'feather'.
+            zone_cache_dir (str, optional): Directory of a persistent zone index cache reused across runs.
+            coverage (bool): Weight every pixel by the exact fraction of its area covered by the geometry.
+            stats (list of str, optional): Statistics computed in one pass, one output column each.
+            incremental (bool): Only aggregate the rasters new or changed since the last incremental run,
+                merging their rows into its output, which is named without a timestamp.
+            checkpoint_dir (str, optional): Directory where the aggregated blocks are saved during the run.
+            resume (bool): Resume the interrupted run from checkpoint_dir, skipping its aggregated rasters.
+            retries (int): Number of times a raster failing to aggregate is attempted again.
+            skip_failed (bool): Skip the rasters that still fail after the retries instead of stopping.
+            executor (str): 'process', 'thread' or 'dask' to run the rasters on a dask.distributed cluster.
+            client (dask.distributed.Client or str, optional): Client or scheduler address for 'dask',
+                a LocalCluster is started by default.
+            tile_size (int): With the 'tiled' engine, side of the tiles in pixels.
+            time_batch (int): With the 'tiled' engine, number of rasters read per tile by one task.
+            batch_size (int or str): Number of rasters stacked and reduced together by one task, or
+                'auto' to fit memory_budget, in bytes.
+            memory_budget (int, optional): Bytes of raster data a task may stack with batch_size='auto'.
         """
 
         print("Starting Parallel Aggregation...")
 
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-        aggregate_output = (
-            f'Aggregated_{calculation_mode}_{self.predictor_name}_{timestamp}.csv'
+        # Incremental runs continue the same output
+        aggregate_output = outputPath(
+            f'Aggregated_{calculation_mode}_{self.predictor_name}'
+            f'{"" if incremental else "_" + timestamp}', output_format
         )
 
         # Check if a Region of Interest (ROI) has been selected for aggregation
@@ -410,7 +522,24 @@ class EarthStat():
                 calculation_mode,
                 predictor_name=self.predictor_name,
                 all_touched=all_touched,
-                max_workers=max_workers
+                max_workers=max_workers,
+                engine=engine,
+                output_format=output_format,
+                zone_cache_dir=zone_cache_dir,
+                coverage=coverage,
+                stats=stats,
+                incremental=incremental,
+                checkpoint_dir=checkpoint_dir,
+                resume=resume,
+                retries=retries,
+                skip_failed=skip_failed,
+                executor=executor,
+                client=client,
+                tile_size=tile_size,
+                time_batch=time_batch,
+                batch_size=batch_size,
+                memory_budget=memory_budget,
+                cube_dir=self.cube_dir if engine == "zone_index" else None
             )
 
         else:
@@ -430,7 +559,24 @@ class EarthStat():
                 calculation_mode,
                 predictor_name=self.predictor_name,
                 all_touched=all_touched,
-                max_workers=max_workers
+                max_workers=max_workers,
+                engine=engine,
+                output_format=output_format,
+                zone_cache_dir=zone_cache_dir,
+                coverage=coverage,
+                stats=stats,
+                incremental=incremental,
+                checkpoint_dir=checkpoint_dir,
+                resume=resume,
+                retries=retries,
+                skip_failed=skip_failed,
+                executor=executor,
+                client=client,
+                tile_size=tile_size,
+                time_batch=time_batch,
+                batch_size=batch_size,
+                memory_budget=memory_budget,
+                cube_dir=self.cube_dir if engine == "zone_index" else None
             )
 
         print(f"Aggregation complete. Data saved to {aggregate_output}.")
@@ -6,8 +6,7 @@ from rasterio.mask import mask
 from shapely.geometry import mapping
 from tqdm import tqdm
 from ..utils import savedFilePath
-
-from concurrent.futures import ProcessPoolExecutor
+from ..analysis_aggregation.executors import getExecutor, workerState
 
 
 def clipRasterWithShapefile(raster_path, shapefile, invalid_values=None):
@@ -52,7 +51,34 @@ def clipRasterWithShapefile(raster_path, shapefile, invalid_values=None):
         dest.write(out_image)
 
 
-def clipMultipleRasters(raster_paths, shapefile_path, invalid_values=None):
+def init_clip_worker(shapefile, invalid_values=None):
+    """
+    Executor initializer receiving the shapefile once per worker.
+
+    Args:
+        shapefile (GeoDataFrame): Shapefile used for clipping.
+        invalid_values (list, optional): Values in the raster to treat as invalid and replace with NaN.
+    """
+    state = workerState()
+    state["shapefile"] = shapefile
+    state["invalid_values"] = invalid_values
+
+
+def clip_worker(raster_path):
+    state = workerState()
+
+    # Errors are returned as messages instead of raised, like the aggregation tasks:
+    # some GDAL errors cannot be unpickled, which would stall the pool
+    try:
+        clipRasterWithShapefile(raster_path, state["shapefile"], state["invalid_values"])
+    except Exception as e:
+        return f"Failed to clip {raster_path}: {e!r}"
+
+    return None
+
+
+def clipMultipleRasters(raster_paths, shapefile_path, invalid_values=None, max_workers=None,
+                        executor="process"):
     """
     Clips a raster file using a shapefile, optionally filtering out specified invalid values.
     The clipped raster is saved in a new directory named 'clipped' plus the original file directory.
@@ -61,6 +87,12 @@ def clipMultipleRasters(raster_paths, shapefile_path, invalid_values=None):
         raster_path (str): Path to the raster file to be clipped.
         shapefile_path (str): Path to the shapefile used for clipping.
         invalid_values (list, optional): Values in the raster to treat as invalid and replace with NaN.
+        max_workers (int, optional): Number of workers, defaults to all cores.
+        executor (str): 'process' clips in worker processes, 'thread' in threads sharing the
+            shapefile, each opening its own raster handles.
+
+    Raises:
+        RuntimeError: If a raster fails to clip, with its path.
 
     The function creates a new directory (if it doesn't already exist) and saves the clipped raster there.
     """
@@ -71,11 +103,13 @@ def clipMultipleRasters(raster_paths, shapefile_path, invalid_values=None):
 
     shapefile = gpd.read_file(shapefile_path)
 
-    # Using ProcessPoolExecutor to parallelize the task
-    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+    # The shapefile is sent once per worker, tasks only carry a raster path
+    with getExecutor(executor, max_workers if max_workers else os.cpu_count(),
+                     init_clip_worker, (shapefile, invalid_values)) as pool:
 
-        # Use list to force execution and tqdm for progress bar
-        list(tqdm(executor.map(clipRasterWithShapefile, raster_paths, [shapefile]*len(raster_paths), [invalid_values]*len(raster_paths)),
-                  total=len(raster_paths), desc="Clipping Rasters"))
+        for _, error in tqdm(pool.imap(clip_worker, raster_paths),
+                             total=len(raster_paths), desc="Clipping Rasters"):
+            if error:
+                raise RuntimeError(error)
 
     return output_clip_dir
@@ -1,11 +1,19 @@
+import numpy as np
 import pandas as pd
 import glob
 import os
 import xarray as xr
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm.auto import tqdm
 from rasterio.features import geometry_mask
-import rioxarray
+
+from ..analysis_aggregation.output_sink import getOutputSink, outputPath, readOutput
+from ..analysis_aggregation.result_builder import ResultBuilder, zone_attributes
+from ..analysis_aggregation.run_manifest import RunManifest, runSignature
+from ..analysis_aggregation.zone_index import (
+    PERCENTILE_METHODS, ZoneIndex, parse_statistic, zonal_statistics)
+from ..analysis_aggregation.zone_index_cache import cachedZoneIndex
+from .xES_utiles import (
+    build_variable_folders, dataset_grid, open_sample_dataset, open_variable_dataset)
 
 try:
     import cupy as cp
@@ -17,13 +25,33 @@ except ImportError:
 
 
 class DailyDatasetBuilder:
-    def __init__(self, area_name, shapefile, multiprocessing=False, max_workers=None, all_touched=False, stat='mean'):
+    def __init__(self, area_name, shapefile, multiprocessing=False, max_workers=None, all_touched=False, stat='mean', output_format='csv', engine='zone_index', time_block=None, zone_cache_dir=None, coverage=False, percentile_method='exact', percentile_bins=1000, incremental=False, resume=False, retries=0, skip_failed=False, from_zip=False):
 
         # Constructor
         self.area_name = area_name
         self.shapefile = shapefile
         self.all_touched = all_touched
         self.stat = stat
+        # A list of statistics is computed in one pass, one output column per statistic
+        self.stats = [stat] if isinstance(stat, str) else list(stat)
+        self.output_format = output_format
+        self.engine = engine
+        self.zone_cache_dir = zone_cache_dir
+        # Weight every pixel by the fraction of its area covered by the geo-object
+        self.coverage = coverage
+        # 'exact' sorts the pixels of every zone, 'sketch' bins them into percentile_bins bins
+        self.percentile_method = percentile_method
+        self.percentile_bins = percentile_bins
+        # Read the netCDF members of the zip files instead of the extracted files
+        self.from_zip = from_zip
+        # Skip the variables completed by an interrupted run, retry or skip failing ones
+        self.resume = resume
+        self.retries = retries
+        self.skip_failed = skip_failed
+        # Number of days loaded at once, None loads the full time series
+        self.time_block = time_block
+        # Only aggregate the files new or changed since the last incremental run
+        self.incremental = incremental
 
         if multiprocessing:
             self.multiprocessing = multiprocessing
@@ -31,8 +59,32 @@ class DailyDatasetBuilder:
         else:
             self.multiprocessing = False
 
+        if engine not in ("zone_index", "mask"):
+            raise ValueError(
+                f"Invalid engine: {engine}. Options are 'zone_index', 'mask'.")
+
+        if coverage and engine != "zone_index":
+            raise ValueError("coverage requires the 'zone_index' engine.")
+
+        # The run manifest tracks extracted files
+        if incremental and from_zip:
+            raise ValueError("incremental requires the extracted files, not from_zip.")
+
+        if percentile_method not in PERCENTILE_METHODS:
+            raise ValueError(
+                f"Invalid percentile method: {percentile_method}. Options are 'exact', 'sketch', 'auto'.")
+
+        if engine == "zone_index":
+            for zone_stat in self.stats:
+                parse_statistic(zone_stat)
+
         self._processing_status()
-        self.masks = self._compute_masks()
+
+        # 'zone_index' gathers only the pixels of every zone, 'mask' masks the full grid per zone
+        if engine == "zone_index":
+            self.zone_index = self._compute_zone_index()
+        else:
+            self.masks = self._compute_masks()
 
     def _processing_status(self):
 
@@ -46,13 +98,26 @@ class DailyDatasetBuilder:
         else:
             print("Single processing mode on, suitable for Google Colab.")
 
-    def _compute_masks(self):
+    def _grid(self):
         # Assuming the first dataset has the same spatial properties as the others
-        sample_file = glob.glob(f'{self.area_name}/*/Extracted/*/*.nc')[0]
-        ds = xr.open_dataset(sample_file)
-        ds = ds.rio.write_crs("EPSG:4326")
-        transform = ds.rio.transform()
-        out_shape = (ds.rio.height, ds.rio.width)
+        return dataset_grid(open_sample_dataset(self.area_name, self.from_zip))
+
+    def _compute_zone_index(self):
+        transform, out_shape = self._grid()
+
+        # Runs with the same shapefile and grid reuse the cached rasterization
+        if self.zone_cache_dir:
+            return cachedZoneIndex(
+                self.shapefile.geometry, transform, out_shape,
+                all_touched=self.all_touched, cache_dir=self.zone_cache_dir,
+                coverage=self.coverage)
+
+        return ZoneIndex.from_geometries(
+            self.shapefile.geometry, transform, out_shape, all_touched=self.all_touched,
+            coverage=self.coverage)
+
+    def _compute_masks(self):
+        transform, out_shape = self._grid()
 
         masks = []
         for _, geo_obj in self.shapefile.iterrows():
@@ -61,38 +126,47 @@ class DailyDatasetBuilder:
             masks.append(mask)
         return masks
 
-    def build_datasets(self, max_workers):
+    def build_datasets(self, max_workers, executor='process', client=None):
         os.makedirs(f'{self.area_name}_aggregated_daily_csv', exist_ok=True)
         var_folders = glob.glob(f'{self.area_name}/*/')
 
-        if self.multiprocessing:
-            with ProcessPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(
-                    self._daily_datasets, folder) for folder in var_folders]
-
-                for future in tqdm(as_completed(futures), total=len(futures)):
-                    future.result()
+        # Completed variables are recorded, so a failing one does not lose the others
+        build_variable_folders(
+            self._daily_datasets, var_folders,
+            f'{self.area_name}_aggregated_daily_csv/checkpoint.json', self._signature(),
+            multiprocessing=self.multiprocessing, max_workers=max_workers,
+            resume=self.resume, retries=self.retries, skip_failed=self.skip_failed,
+            executor=executor, client=client)
 
-        else:
-            for folder in tqdm(var_folders, desc='Processing folders'):
-                self._daily_datasets(folder)
+    def _signature(self):
+        """Signature of the options the outputs depend on."""
+        return runSignature(
+            self.shapefile, all_touched=self.all_touched, stat=self.stat,
+            output_format=self.output_format, engine=self.engine, coverage=self.coverage,
+            percentile_method=self.percentile_method, percentile_bins=self.percentile_bins)
 
-    def _daily_datasets(self, folder):
-        aggregated_data = []
-        file_list = glob.glob(f'{folder}/Extracted/*/*.nc')
+    def _stat_columns(self, ds_variable):
+        """Output column of every statistic, the variable name alone for a single stat."""
+        if isinstance(self.stat, str):
+            return [ds_variable]
+        return [f"{ds_variable}_{zone_stat}" for zone_stat in self.stats]
 
-        if self.multiprocessing:
-            ds = xr.open_mfdataset(
-                file_list, combine='by_coords', parallel=True)
-        else:
-            ds = xr.open_mfdataset(file_list, combine='by_coords')
+    def _aggregate_zones(self, data, results, dates):
+        """Reduces every zone of a (time, lat, lon) block into the date slots of results."""
+        if self.engine == "zone_index":
+            # One pass over the pixels of all zones, shape (time, zones, stats)
+            zone_values = zonal_statistics(
+                self.zone_index.gather_grid(data), self.zone_index, self.stats,
+                percentile_method=self.percentile_method,
+                percentile_bins=self.percentile_bins)
 
-        ds_variable = list(ds.data_vars)[0]
+            for zone_id in range(self.zone_index.n_zones):
+                results.set_zone(zone_id, zone_values[:, zone_id, :], dates)
+            return
 
-        ds = ds.rio.write_crs("EPSG:4326")
-        gpu_data = cp.asarray(ds[ds_variable].values)
+        gpu_data = cp.asarray(data)
 
-        for mask, (_, geo_obj) in tqdm(zip(self.masks, self.shapefile.iterrows()), total=len(self.masks), desc='Countries'):
+        for zone_id, mask in enumerate(tqdm(self.masks, desc='Countries')):
 
             mask_gpu = cp.asarray(mask)
             masked_data_gpu = cp.where(mask_gpu, gpu_data, cp.nan)
@@ -107,29 +181,110 @@ class DailyDatasetBuilder:
                 'sum': cp.nansum
             }
 
-            try:
-                result_gpu = stats_functions[self.stat](
-                    masked_data_gpu, axis=(1, 2))
-            except KeyError:
-                raise ValueError(
-                    f"Invalid stat: {self.stat}. Options are 'mean', 'median', 'min', 'max', 'sum'.")
-
-            if gpu_available:
-                calculation_results = cp.asnumpy(result_gpu)
-            else:
-                calculation_results = result_gpu
-
-            for date, mean_value in zip(ds.time.values, calculation_results):
-                date_str = str(date)
-                new_row = {
-                    col: geo_obj[col] for col in self.shapefile.columns if col != 'geometry'}
-                new_row.update(
-                    {'date': date_str, f'{ds_variable}': mean_value})
-                aggregated_data.append(new_row)
-
-        if aggregated_data:
-            df = pd.DataFrame(aggregated_data)
-            df.to_csv(
-                f'{self.area_name}_aggregated_daily_csv/AgERA5_{self.area_name}_{ds_variable}_dekadal.csv', index=False)
+            calculation_results = []
+
+            # The masked copy is shared by all statistics
+            for zone_stat in self.stats:
+                try:
+                    result_gpu = stats_functions[zone_stat](
+                        masked_data_gpu, axis=(1, 2))
+                except KeyError:
+                    raise ValueError(
+                        f"Invalid stat: {zone_stat}. Options are 'mean', 'median', 'min', 'max', 'sum'.")
+
+                if gpu_available:
+                    calculation_results.append(cp.asnumpy(result_gpu))
+                else:
+                    calculation_results.append(result_gpu)
+
+            results.set_zone(zone_id, np.stack(calculation_results, axis=-1), dates)
+
+    def _run_manifest(self, folder):
+        """Manifest of the files of a variable folder aggregated by previous incremental runs."""
+        folder_name = os.path.basename(os.path.normpath(folder))
+
+        return RunManifest.load(
+            f'{self.area_name}_aggregated_daily_csv/{folder_name}.manifest.json',
+            self._signature())
+
+    def _merge_previous(self, df, output_path, stale_dates):
+        """Merges new rows into the previous output, in zone then date order."""
+        previous = readOutput(output_path, self.output_format)
+        n_zones = len(self.shapefile)
+
+        # Both outputs list every date of a zone before the next zone
+        previous['zone_id'] = np.repeat(np.arange(n_zones), len(previous) // n_zones)
+        df['zone_id'] = np.repeat(np.arange(n_zones), len(df) // n_zones)
+        previous['date'] = previous['date'].astype(str)
+        previous = previous[~previous['date'].isin(stale_dates)]
+
+        merged = pd.concat([previous, df], ignore_index=True).sort_values(
+            ['zone_id', 'date'], kind='stable')
+
+        return merged.drop(columns='zone_id').reset_index(drop=True)
+
+    def _daily_datasets(self, folder):
+        file_list = glob.glob(f'{folder}/Extracted/*/*.nc')
+        manifest = None
+
+        if self.incremental:
+            manifest = self._run_manifest(folder)
+            previous_run = bool(manifest.files)
+            file_list = manifest.pending(file_list)
+
+            if not file_list:
+                print(f"{folder} is up to date, nothing to aggregate.")
+                return
+
+            stale_dates = manifest.stale_dates(file_list)
+
+        if self.incremental:
+            files_ds = xr.open_mfdataset(
+                file_list, combine='by_coords', parallel=bool(self.multiprocessing))
+        else:
+            files_ds = open_variable_dataset(
+                folder, self.from_zip, parallel=bool(self.multiprocessing))
+
+        ds_variable = list(files_ds.data_vars)[0]
+
+        ds = files_ds
+        n_times = len(ds.time)
+        time_block = self.time_block if self.time_block else max(n_times, 1)
+
+        results = ResultBuilder(
+            len(self.shapefile), n_times, self._stat_columns(ds_variable),
+            dtype=ds[ds_variable].dtype)
+        results.set_dates([str(date) for date in ds.time.values])
+
+        # Only one block of days is loaded at a time, the lazy dataset is read block by block
+        for start in tqdm(range(0, n_times, time_block), desc='Time blocks',
+                          disable=time_block >= n_times):
+            dates = slice(start, start + time_block)
+            data = ds[ds_variable].isel(time=dates).values
+            self._aggregate_zones(data, results, dates)
+
+        # Zip members read by HDF5 must be released before the interpreter exits
+        files_ds.close()
+
+        if results.values.size:
+            df = results.to_frame(
+                zone_attributes(self.shapefile), order="zone")
+            output_path = outputPath(
+                f'{self.area_name}_aggregated_daily_csv/AgERA5_{self.area_name}_{ds_variable}_dekadal',
+                self.output_format)
+
+            # The rows of new and changed files replace their previous rows
+            merge = manifest and previous_run and os.path.exists(output_path)
+            if merge:
+                df = self._merge_previous(df, output_path, stale_dates)
+
+            with getOutputSink(output_path, self.output_format, variable=ds_variable) as sink:
+                sink.write(df)
         else:
             print(f"No data found for {ds_variable}")
+
+        if manifest:
+            for file_path in file_list:
+                with xr.open_dataset(file_path) as file_ds:
+                    manifest.record(file_path, [str(date) for date in file_ds.time.values])
+            manifest.save()
@@ -1,11 +1,18 @@
+import numpy as np
 import pandas as pd
 import glob
 import os
-import xarray as xr
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm.auto import tqdm
 from rasterio.features import geometry_mask
-import rioxarray
+
+from ..analysis_aggregation.output_sink import getOutputSink, outputPath
+from ..analysis_aggregation.result_builder import ResultBuilder, zone_attributes
+from ..analysis_aggregation.run_manifest import runSignature
+from ..analysis_aggregation.zone_index import (
+    PERCENTILE_METHODS, ZoneIndex, parse_statistic, zonal_statistics, zonal_sum)
+from ..analysis_aggregation.zone_index_cache import cachedZoneIndex
+from .xES_utiles import (
+    build_variable_folders, dataset_grid, open_sample_dataset, open_variable_dataset)
 
 try:
     import cupy as cp
@@ -16,14 +23,39 @@ except ImportError:
     gpu_available = False
 
 
+# Dekads of daily data loaded and reduced at once, about a year
+DEKAD_BLOCK = 36
+
+# Zone statistics that can be rolled up from daily zone sums and pixel counts
+ROLLUP_STATISTICS = ('mean', 'sum')
+
+
 class DekadalDatasetBuilder():
-    def __init__(self, area_name, shapefile, multiprocessing=False, max_workers=None, all_touched=False, stat='mean'):
+    def __init__(self, area_name, shapefile, multiprocessing=False, max_workers=None, all_touched=False, stat='mean', output_format='csv', engine='zone_index', zone_cache_dir=None, coverage=False, percentile_method='exact', percentile_bins=1000, resume=False, retries=0, skip_failed=False, aggregate_first=False, from_zip=False):
 
         # Constructor
         self.area_name = area_name
         self.shapefile = shapefile
         self.all_touched = all_touched
         self.stat = stat
+        # A list of statistics is computed in one pass, one output column per statistic
+        self.stats = [stat] if isinstance(stat, str) else list(stat)
+        self.output_format = output_format
+        self.engine = engine
+        self.zone_cache_dir = zone_cache_dir
+        # Weight every pixel by the fraction of its area covered by the geo-object
+        self.coverage = coverage
+        # 'exact' sorts the pixels of every zone, 'sketch' bins them into percentile_bins bins
+        self.percentile_method = percentile_method
+        self.percentile_bins = percentile_bins
+        # Read the netCDF members of the zip files instead of the extracted files
+        self.from_zip = from_zip
+        # Skip the variables completed by an interrupted run, retry or skip failing ones
+        self.resume = resume
+        self.retries = retries
+        self.skip_failed = skip_failed
+        # Reduce the zones of the daily data, then roll their series up to dekads
+        self.aggregate_first = aggregate_first
 
         if multiprocessing:
             self.multiprocessing = multiprocessing
@@ -31,8 +63,35 @@ class DekadalDatasetBuilder():
         else:
             self.multiprocessing = False
 
+        if engine not in ("zone_index", "mask"):
+            raise ValueError(
+                f"Invalid engine: {engine}. Options are 'zone_index', 'mask'.")
+
+        if coverage and engine != "zone_index":
+            raise ValueError("coverage requires the 'zone_index' engine.")
+
+        if percentile_method not in PERCENTILE_METHODS:
+            raise ValueError(
+                f"Invalid percentile method: {percentile_method}. Options are 'exact', 'sketch', 'auto'.")
+
+        if engine == "zone_index":
+            for zone_stat in self.stats:
+                parse_statistic(zone_stat)
+
+        if aggregate_first and engine != "zone_index":
+            raise ValueError("aggregate_first requires the 'zone_index' engine.")
+
+        if aggregate_first and not set(self.stats) <= set(ROLLUP_STATISTICS):
+            raise ValueError(
+                "aggregate_first only supports the 'mean' and 'sum' statistics.")
+
         self._processing_status()
-        self.masks = self._compute_masks()
+
+        # 'zone_index' gathers only the pixels of every zone, 'mask' masks the full grid per zone
+        if engine == "zone_index":
+            self.zone_index = self._compute_zone_index()
+        else:
+            self.masks = self._compute_masks()
 
     def _processing_status(self):
 
@@ -46,13 +105,26 @@ class DekadalDatasetBuilder():
         else:
             print("Single processing mode on, suitable for Google Colab.")
 
-    def _compute_masks(self):
+    def _grid(self):
         # Assuming the first dataset has the same spatial properties as the others
-        sample_file = glob.glob(f'{self.area_name}/*/Extracted/*/*.nc')[0]
-        ds = xr.open_dataset(sample_file)
-        ds = ds.rio.write_crs("EPSG:4326")
-        transform = ds.rio.transform()
-        out_shape = (ds.rio.height, ds.rio.width)
+        return dataset_grid(open_sample_dataset(self.area_name, self.from_zip))
+
+    def _compute_zone_index(self):
+        transform, out_shape = self._grid()
+
+        # Runs with the same shapefile and grid reuse the cached rasterization
+        if self.zone_cache_dir:
+            return cachedZoneIndex(
+                self.shapefile.geometry, transform, out_shape,
+                all_touched=self.all_touched, cache_dir=self.zone_cache_dir,
+                coverage=self.coverage)
+
+        return ZoneIndex.from_geometries(
+            self.shapefile.geometry, transform, out_shape, all_touched=self.all_touched,
+            coverage=self.coverage)
+
+    def _compute_masks(self):
+        transform, out_shape = self._grid()
 
         masks = []
         for _, geo_obj in self.shapefile.iterrows():
@@ -61,21 +133,25 @@ class DekadalDatasetBuilder():
             masks.append(mask)
         return masks
 
-    def build_datasets(self, max_workers):
+    def build_datasets(self, max_workers, executor='process', client=None):
         os.makedirs(f'{self.area_name}_Aggregated_dekadal_csv', exist_ok=True)
         var_folders = glob.glob(f'{self.area_name}/*/')
 
-        if self.multiprocessing:
-            with ProcessPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(
-                    self._dekadal_datasets, folder) for folder in var_folders]
-
-                for future in tqdm(as_completed(futures), total=len(futures)):
-                    future.result()
-
-        else:
-            for folder in tqdm(var_folders, desc='Processing folders'):
-                self._dekadal_datasets(folder)
+        # Completed variables are recorded, so a failing one does not lose the others
+        build_variable_folders(
+            self._dekadal_datasets, var_folders,
+            f'{self.area_name}_Aggregated_dekadal_csv/checkpoint.json', self._signature(),
+            multiprocessing=self.multiprocessing, max_workers=max_workers,
+            resume=self.resume, retries=self.retries, skip_failed=self.skip_failed,
+            executor=executor, client=client)
+
+    def _signature(self):
+        """Signature of the options the outputs depend on."""
+        return runSignature(
+            self.shapefile, all_touched=self.all_touched, stat=self.stat,
+            output_format=self.output_format, engine=self.engine, coverage=self.coverage,
+            percentile_method=self.percentile_method, percentile_bins=self.percentile_bins,
+            aggregate_first=self.aggregate_first)
 
     @staticmethod
     def adjust_date(date):
@@ -88,17 +164,91 @@ class DekadalDatasetBuilder():
         else:
             return date
 
-    def _dekadal_datasets(self, folder):
+    @staticmethod
+    def dekad_labels(times):
+        """
+        Labels every timestamp with its dekad like `adjust_date`, on whole arrays.
+
+        Days 2 to 11 are labelled the 11th, days 12 to 21 the 21st, days 22 to 31 the
+        1st of the next month, and the 1st keeps its date. The time of day is kept.
+
+        Args:
+            times (array-like): Timestamps of the daily data.
+
+        Returns:
+            ndarray: The datetime64[ns] label of every timestamp.
+        """
+        times = np.asarray(times, dtype='datetime64[ns]')
+        days = times.astype('datetime64[D]')
+        month_starts = times.astype('datetime64[M]').astype('datetime64[D]')
+        next_month_starts = (times.astype('datetime64[M]') + 1).astype('datetime64[D]')
+        day = (days - month_starts).astype('int64') + 1
+
+        labels = np.select(
+            [day == 1, day <= 11, day <= 21],
+            [days, month_starts + np.timedelta64(10, 'D'), month_starts + np.timedelta64(20, 'D')],
+            default=next_month_starts)
+
+        return labels.astype('datetime64[ns]') + (times - days.astype('datetime64[ns]'))
+
+    def _stat_columns(self, ds_variable):
+        """Output column of every statistic, the variable name alone for a single stat."""
+        if isinstance(self.stat, str):
+            return [ds_variable]
+        return [f"{ds_variable}_{zone_stat}" for zone_stat in self.stats]
+
+    def _aggregate_zones(self, data, results):
+        """Reduces every zone of a (time, lat, lon) array into results."""
+        if self.engine == "zone_index":
+            # One pass over the pixels of all zones, shape (time, zones, stats)
+            zone_values = zonal_statistics(
+                self.zone_index.gather_grid(data), self.zone_index, self.stats,
+                percentile_method=self.percentile_method,
+                percentile_bins=self.percentile_bins)
+
+            for zone_id in range(self.zone_index.n_zones):
+                results.set_zone(zone_id, zone_values[:, zone_id, :])
+            return
+
+        gpu_data = cp.asarray(data)
+
+        for zone_id, mask in enumerate(tqdm(self.masks, desc='Countries')):
 
-        aggregated_data = []
-        file_list = glob.glob(f'{folder}/Extracted/*/*.nc')
-        # Future enhancement we can add the option to run it parallel if the user use
+            mask_gpu = cp.asarray(mask)
+            masked_data_gpu = cp.where(
+                mask_gpu, gpu_data, cp.nan)
+            # axis=(1, 2) for 2D data (time, lat, lon)
 
-        if self.multiprocessing:
-            combined_ds = xr.open_mfdataset(
-                file_list, combine='by_coords', parallel=True)
-        else:
-            combined_ds = xr.open_mfdataset(file_list, combine='by_coords')
+            stats_functions = {
+                'mean': cp.nanmean,
+                'median': cp.nanmedian,
+                'min': cp.nanmin,
+                'max': cp.nanmax,
+                'sum': cp.nansum
+            }
+
+            calculation_results = []
+
+            # The masked copy is shared by all statistics
+            for zone_stat in self.stats:
+                try:
+                    result_gpu = stats_functions[zone_stat](
+                        masked_data_gpu, axis=(1, 2))
+                except KeyError:
+                    raise ValueError(
+                        f"Invalid stat: {zone_stat}. Options are 'mean', 'median', 'min', 'max', 'sum'.")
+
+                if gpu_available:
+                    calculation_results.append(cp.asnumpy(result_gpu))
+                else:
+                    calculation_results.append(result_gpu)
+
+            results.set_zone(zone_id, np.stack(calculation_results, axis=-1))
+
+    def _dekadal_datasets(self, folder):
+
+        combined_ds = open_variable_dataset(
+            folder, self.from_zip, parallel=bool(self.multiprocessing))
 
         ds_variable = list(combined_ds.data_vars)[0]
 
@@ -111,56 +261,38 @@ class DekadalDatasetBuilder():
             combined_ds, last_year, 12, 22, True)
         combined_mask = mask_jan_1 & mask_dec_22_31
 
-        ds_masked = combined_ds.where(combined_mask, drop=True)
-        time_index = pd.to_datetime(ds_masked['time'].values)
-        adjusted_dates = time_index.map(self.adjust_date)
-        ds_masked['time'] = ('time', adjusted_dates)
+        ds_masked = combined_ds.isel(time=combined_mask.values)
 
-        resampled_ds = self._resample_dataset(ds_masked, ds_variable)
+        # The days of a dekad are contiguous, its boundaries are found once
+        labels = self.dekad_labels(ds_masked['time'].values)
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])[:labels.size]
 
-        resampled_ds_variable = list(resampled_ds.data_vars)[0]
-        gpu_data = cp.asarray(
-            resampled_ds[resampled_ds_variable].values)
+        results = ResultBuilder(
+            len(self.shapefile), len(starts), self._stat_columns(ds_variable),
+            dtype=ds_masked[ds_variable].dtype)
+        results.set_dates([str(date) for date in labels[starts]])
 
-        for mask, (_, geo_obj) in tqdm(zip(self.masks, self.shapefile.iterrows()), total=len(self.masks), desc='Countries'):
+        if self._rolls_up(ds_variable):
+            zone_values = self._rollup_zones(ds_masked[ds_variable], ds_variable, starts)
 
-            mask_gpu = cp.asarray(mask)
-            masked_data_gpu = cp.where(
-                mask_gpu, gpu_data, cp.nan)
-            # axis=(1, 2) for 2D data (time, lat, lon)
+            for zone_id in range(self.zone_index.n_zones):
+                results.set_zone(zone_id, zone_values[:, zone_id, :])
+        else:
+            data = self._resample_dataset(ds_masked[ds_variable], ds_variable, starts)
+            self._aggregate_zones(data, results)
 
-            stats_functions = {
-                'mean': cp.nanmean,
-                'median': cp.nanmedian,
-                'min': cp.nanmin,
-                'max': cp.nanmax,
-                'sum': cp.nansum
-            }
+        # Zip members read by HDF5 must be released before the interpreter exits
+        combined_ds.close()
 
-            try:
-                result_gpu = stats_functions[self.stat](
-                    masked_data_gpu, axis=(1, 2))
-            except KeyError:
-                raise ValueError(
-                    f"Invalid stat: {self.stat}. Options are 'mean', 'median', 'min', 'max', 'sum'.")
-
-            if gpu_available:
-                calculation_results = cp.asnumpy(result_gpu)
-            else:
-                calculation_results = result_gpu
-
-            for date, result_value in zip(resampled_ds.time.values, calculation_results):
-                date_str = str(date)
-                new_row = {
-                    col: geo_obj[col] for col in self.shapefile.columns if col != 'geometry'}
-                new_row.update(
-                    {'date': date_str, f'{ds_variable}': result_value})
-                aggregated_data.append(new_row)
-
-        if aggregated_data:
-            df = pd.DataFrame(aggregated_data)
-            df.to_csv(
-                f'{self.area_name}_Aggregated_dekadal_csv/AgERA5_{self.area_name}_{ds_variable}_dekadal.csv', index=False)
+        if results.values.size:
+            df = results.to_frame(
+                zone_attributes(self.shapefile), order="zone")
+            output_path = outputPath(
+                f'{self.area_name}_Aggregated_dekadal_csv/AgERA5_{self.area_name}_{ds_variable}_dekadal',
+                self.output_format)
+
+            with getOutputSink(output_path, self.output_format, variable=ds_variable) as sink:
+                sink.write(df)
         else:
             print(f"No data found for {ds_variable}")
 
@@ -171,11 +303,115 @@ class DekadalDatasetBuilder():
         else:
             return ~((ds.time.dt.year == year) & (ds.time.dt.month == month) & (ds.time.dt.day == day))
 
-    def _resample_dataset(self, ds, variable):
-        """Resample dataset based on the variable type."""
+    def _resample_dataset(self, data_array, variable, starts):
+        """
+        Reduces daily data into dekads based on the variable type.
+
+        Every dekad is a contiguous run of days starting at one of starts, so each
+        reduction is a single segmented `reduceat` over the time axis, applied to
+        blocks of whole dekads loaded one at a time.
+
+        Args:
+            data_array (DataArray): Daily data of shape (time, lat, lon).
+            variable (str): Name of the variable, selecting the sum, min, max or mean.
+            starts (ndarray): Position of the first day of every dekad.
+
+        Returns:
+            ndarray: The dekadal data of shape (dekads, lat, lon).
+        """
+        bounds = np.r_[starts, data_array.shape[0]]
+        resampled = None
+
+        for first in range(0, len(starts), DEKAD_BLOCK):
+            last = min(first + DEKAD_BLOCK, len(starts))
+            days = data_array.isel(time=slice(bounds[first], bounds[last])).values
+            block = self._reduce_dekads(days, variable, starts[first:last] - bounds[first])
+
+            if resampled is None:
+                resampled = np.empty((len(starts),) + block.shape[1:], dtype=block.dtype)
+            resampled[first:last] = block
+
+        if resampled is None:
+            return np.empty((0,) + data_array.shape[1:], dtype=data_array.dtype)
+
+        return resampled
+
+    def _rolls_up(self, variable):
+        """Whether the zone statistics of a variable are rolled up from daily zone sums."""
+        if not self.aggregate_first:
+            return False
+
+        # The sum of the daily pixel means of a dekad is not linear in the days
         if variable in ['Precipitation_Flux', 'Solar_Radiation_Flux']:
-            return ds.groupby('time').sum().astype('float32')
+            return True
         elif variable in ['Temperature_Air_2m_Min_24h', 'Temperature_Air_2m_Max_24h']:
-            return ds.groupby('time').min() if 'Min' in variable else ds.groupby('time').max()
-        else:
-            return ds.groupby('time').mean()
+            return False
+
+        return self.stats == ['mean']
+
+    def _rollup_zones(self, data_array, variable, starts):
+        """
+        Reduces every zone of the daily data, then rolls the zone series up to dekads.
+
+        Each block of days is gathered once and reduced to the weighted sum and the
+        weight of the valid pixels of every zone and day, so only (days, zones)
+        series are rolled up with `reduceat` instead of resampling the grid.
+        Summed variables give the same dekadal zone mean and sum as resampling first.
+        Averaged variables give the mean over the valid pixel-days of the dekad, which
+        equals it when no pixel misses a day.
+
+        Args:
+            data_array (DataArray): Daily data of shape (time, lat, lon).
+            variable (str): Name of the variable, selecting the dekadal sum or mean.
+            starts (ndarray): Position of the first day of every dekad.
+
+        Returns:
+            ndarray: The zone statistics of shape (dekads, zones, stats).
+        """
+        coverage = self.zone_index.coverage
+        bounds = np.r_[starts, data_array.shape[0]]
+        totals = np.zeros((len(starts), self.zone_index.n_zones))
+        weights = np.zeros((len(starts), self.zone_index.n_zones))
+
+        for first in range(0, len(starts), DEKAD_BLOCK):
+            last = min(first + DEKAD_BLOCK, len(starts))
+            days = self.zone_index.gather_grid(
+                data_array.isel(time=slice(bounds[first], bounds[last])).values)
+            pixel_weights = ~np.isnan(days) if coverage is None else ~np.isnan(days) * coverage
+
+            runs = starts[first:last] - bounds[first]
+            totals[first:last] = np.add.reduceat(
+                zonal_sum(days if coverage is None else days * coverage, self.zone_index),
+                runs, axis=0)
+            weights[first:last] = np.add.reduceat(
+                zonal_sum(pixel_weights, self.zone_index), runs, axis=0)
+
+        # A dekadal sum is 0 rather than missing for pixels without valid days
+        if variable in ['Precipitation_Flux', 'Solar_Radiation_Flux']:
+            pixels = np.ones(self.zone_index.indices.size) if coverage is None else coverage
+            weights = zonal_sum(pixels, self.zone_index)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(weights > 0, totals / weights, np.nan)
+
+        return np.stack(
+            [means if zone_stat == 'mean' else totals for zone_stat in self.stats], axis=-1)
+
+    @staticmethod
+    def _reduce_dekads(days, variable, starts):
+        """Reduces the contiguous runs of days starting at starts, skipping NaN."""
+        if variable in ['Temperature_Air_2m_Min_24h', 'Temperature_Air_2m_Max_24h']:
+            reduction = np.fmin if 'Min' in variable else np.fmax
+            return reduction.reduceat(days, starts, axis=0)
+
+        # Sums accumulate in float64, whatever the chunks of the files
+        missing = np.isnan(days)
+        total = np.add.reduceat(np.where(missing, 0, days), starts, axis=0, dtype='float64')
+
+        if variable in ['Precipitation_Flux', 'Solar_Radiation_Flux']:
+            return total.astype('float32')
+
+        count = np.add.reduceat(~missing, starts, axis=0, dtype='int64')
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, total / count, np.nan).astype(days.dtype)
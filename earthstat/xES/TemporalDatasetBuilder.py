@@ -0,0 +1,387 @@
+import numpy as np
+import pandas as pd
+import glob
+import os
+from functools import partial
+from tqdm.auto import tqdm
+
+from ..analysis_aggregation.output_sink import getOutputSink, outputPath
+from ..analysis_aggregation.result_builder import ResultBuilder, zone_attributes
+from ..analysis_aggregation.run_manifest import runSignature
+from ..analysis_aggregation.zone_index import (
+    PERCENTILE_METHODS, ZoneIndex, parse_statistic, zonal_statistics)
+from ..analysis_aggregation.zone_index_cache import cachedZoneIndex
+from .temporal_periods import (
+    DEFAULT_REDUCERS, REDUCERS, CropCalendar, period_labels, period_positions)
+from .xES_utiles import (
+    build_variable_folders, dataset_grid, open_sample_dataset, open_variable_dataset)
+
+
+# Days of daily data loaded and reduced at once, about a year
+TIME_BLOCK = 366
+
+
+class PeriodReduction():
+    """
+    Reduces the days of every period per pixel, one block of days after another.
+
+    The days of a period are contiguous, so each block is reduced with one
+    `reduceat` per partial array. A period spanning two blocks stays open and is
+    merged with the days of the next block, so blocks need not align with periods.
+
+    Attributes:
+        period_ids (ndarray): Position of the period of every day, -1 outside any period.
+        reducer (str): 'sum', 'mean', 'min' or 'max'.
+        finished (list): Position and pixel values of the periods closed since the last `pop`.
+    """
+
+    def __init__(self, period_ids, reducer):
+
+        self.period_ids = period_ids
+        self.reducer = reducer
+        self.finished = []
+        self._open = None
+        self._partial = None
+
+    def update(self, values, first_day):
+        """
+        Reduces a block of days.
+
+        Args:
+            values (ndarray): Gathered pixels of the days, of shape (days, pixels).
+            first_day (int): Position of the first day of the block.
+        """
+        period_ids = self.period_ids[first_day:first_day + len(values)]
+        starts = np.flatnonzero(np.r_[True, period_ids[1:] != period_ids[:-1]])[:len(period_ids)]
+        partials = reduce_runs(values, starts, self.reducer)
+
+        for run, start in enumerate(starts):
+            period = period_ids[start]
+            if period < 0:
+                continue
+
+            partial_values = [array[run] for array in partials]
+
+            if period == self._open:
+                self._partial = merge_partials(self._partial, partial_values, self.reducer)
+            else:
+                self.close()
+                self._open, self._partial = period, partial_values
+
+    def close(self):
+        """Finishes the open period, once its last day is reduced."""
+        if self._open is not None:
+            self.finished.append((self._open, finish_partial(self._partial, self.reducer)))
+            self._open = self._partial = None
+
+    def pop(self):
+        """Returns the finished periods and forgets them."""
+        finished, self.finished = self.finished, []
+        return finished
+
+
+def reduce_runs(values, starts, reducer):
+    """Reduces the runs of days starting at starts into the partial arrays of a reducer."""
+    if reducer == 'min':
+        return [np.fmin.reduceat(values, starts, axis=0)]
+    if reducer == 'max':
+        return [np.fmax.reduceat(values, starts, axis=0)]
+
+    missing = np.isnan(values)
+    total = np.add.reduceat(np.where(missing, 0, values), starts, axis=0, dtype='float64')
+
+    if reducer == 'sum':
+        return [total]
+
+    return [total, np.add.reduceat(~missing, starts, axis=0, dtype='int64')]
+
+
+def merge_partials(first, second, reducer):
+    """Merges the partial arrays of two runs of days of the same period."""
+    if reducer == 'min':
+        return [np.fmin(first[0], second[0])]
+    if reducer == 'max':
+        return [np.fmax(first[0], second[0])]
+
+    return [a + b for a, b in zip(first, second)]
+
+
+def finish_partial(partial_values, reducer):
+    """Returns the per-pixel values of a period from its partial arrays, like `_reduce_dekads`."""
+    if reducer in ('min', 'max'):
+        return partial_values[0]
+    if reducer == 'sum':
+        return partial_values[0].astype('float32')
+
+    total, count = partial_values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan).astype('float32')
+
+
+class TemporalDatasetBuilder():
+    """
+    Aggregates daily AgERA5 variables to zones over any set of periods in one pass.
+
+    Every period spec labels the days: dekads, pentads, pandas period frequencies
+    (weeks, months, seasons, years), or the per-zone windows of a crop calendar.
+    The daily data of a variable is read once, block by block, and gathered once per
+    block; every spec then reduces the days of its periods per pixel with the
+    reducer of the variable, and the zone statistics of every finished period are
+    computed from the reduced pixels. One output is written per variable and period
+    spec, in a '{area_name}_Aggregated_{period}_csv' folder.
+
+    Attributes:
+        periods (list): The period specs, period names or CropCalendar.
+        reducers (dict): Reducer of every variable, 'sum', 'mean', 'min' or 'max'.
+        zone_index (ZoneIndex): Pixels of every zone on the AgERA5 grid.
+    """
+
+    def __init__(self, area_name, shapefile, periods='dekad', reducers=None, multiprocessing=False, max_workers=None, all_touched=False, stat='mean', output_format='csv', engine='zone_index', zone_cache_dir=None, coverage=False, percentile_method='exact', percentile_bins=1000, time_block=TIME_BLOCK, partial_periods=False, resume=False, retries=0, skip_failed=False, from_zip=False):
+
+        # Constructor
+        self.area_name = area_name
+        self.shapefile = shapefile
+        self.periods = [periods] if isinstance(periods, (str, CropCalendar)) else list(periods)
+        # Variables missing from the reducers are averaged
+        self.reducers = {**DEFAULT_REDUCERS, **(reducers if reducers else {})}
+        self.all_touched = all_touched
+        self.stat = stat
+        # A list of statistics is computed in one pass, one output column per statistic
+        self.stats = [stat] if isinstance(stat, str) else list(stat)
+        self.output_format = output_format
+        self.engine = engine
+        self.zone_cache_dir = zone_cache_dir
+        # Weight every pixel by the fraction of its area covered by the geo-object
+        self.coverage = coverage
+        # 'exact' sorts the pixels of every zone, 'sketch' bins them into percentile_bins bins
+        self.percentile_method = percentile_method
+        self.percentile_bins = percentile_bins
+        # Number of days loaded at once
+        self.time_block = time_block if time_block else TIME_BLOCK
+        # Keep the first and last periods even when the data misses some of their days
+        self.partial_periods = partial_periods
+        # Read the netCDF members of the zip files instead of the extracted files
+        self.from_zip = from_zip
+        # Skip the variables completed by an interrupted run, retry or skip failing ones
+        self.resume = resume
+        self.retries = retries
+        self.skip_failed = skip_failed
+
+        if multiprocessing:
+            self.multiprocessing = multiprocessing
+            self.workers = max_workers if max_workers else os.cpu_count()
+        else:
+            self.multiprocessing = False
+
+        # Periods are reduced per pixel, on the gathered pixels of the zone index
+        if engine != 'zone_index':
+            raise ValueError("Temporal aggregation requires the 'zone_index' engine.")
+
+        if not self.periods:
+            raise ValueError("At least one period is required.")
+
+        for period in self.periods:
+            if isinstance(period, str):
+                period_labels(np.array(['2000-01-01'], dtype='datetime64[ns]'), period)
+            elif not isinstance(period, CropCalendar):
+                raise ValueError(
+                    f"Invalid period: {period}. Periods are period names or CropCalendar.")
+
+            elif len(period.windows) != len(shapefile):
+                raise ValueError(
+                    f"The crop calendar {period.name} has {len(period.windows)} windows "
+                    f"for {len(shapefile)} zones.")
+
+        if len(set(self.period_names)) != len(self.period_names):
+            raise ValueError("Every period must have a different name.")
+
+        for variable, reducer in self.reducers.items():
+            if reducer not in REDUCERS:
+                raise ValueError(
+                    f"Invalid reducer for {variable}: {reducer}. Options are 'sum', 'mean', "
+                    "'min', 'max'.")
+
+        if percentile_method not in PERCENTILE_METHODS:
+            raise ValueError(
+                f"Invalid percentile method: {percentile_method}. Options are 'exact', 'sketch', 'auto'.")
+
+        for zone_stat in self.stats:
+            parse_statistic(zone_stat)
+
+        self._processing_status()
+        self.zone_index = self._compute_zone_index()
+
+    @property
+    def period_names(self):
+        """Name of every period spec, used in the output folder and file names."""
+        return [period if isinstance(period, str) else period.name for period in self.periods]
+
+    def _processing_status(self):
+
+        if self.multiprocessing:
+            print(f"Multiprocessing mode on, using {self.workers} cores.")
+        else:
+            print("Single processing mode on, suitable for Google Colab.")
+
+    def _grid(self):
+        # Assuming the first dataset has the same spatial properties as the others
+        return dataset_grid(open_sample_dataset(self.area_name, self.from_zip))
+
+    def _compute_zone_index(self):
+        transform, out_shape = self._grid()
+
+        # Runs with the same shapefile and grid reuse the cached rasterization
+        if self.zone_cache_dir:
+            return cachedZoneIndex(
+                self.shapefile.geometry, transform, out_shape,
+                all_touched=self.all_touched, cache_dir=self.zone_cache_dir,
+                coverage=self.coverage)
+
+        return ZoneIndex.from_geometries(
+            self.shapefile.geometry, transform, out_shape, all_touched=self.all_touched,
+            coverage=self.coverage)
+
+    def build_datasets(self, max_workers, executor='process', client=None):
+        for name in self.period_names:
+            os.makedirs(f'{self.area_name}_Aggregated_{name}_csv', exist_ok=True)
+        var_folders = glob.glob(f'{self.area_name}/*/')
+
+        # Completed variables are recorded, so a failing one does not lose the others
+        build_variable_folders(
+            self._temporal_datasets, var_folders,
+            f'{self.area_name}_Aggregated_{self.period_names[0]}_csv/checkpoint.json',
+            self._signature(), multiprocessing=self.multiprocessing, max_workers=max_workers,
+            resume=self.resume, retries=self.retries, skip_failed=self.skip_failed,
+            executor=executor, client=client)
+
+    def _signature(self):
+        """Signature of the options the outputs depend on."""
+        periods = [period if isinstance(period, str) else [period.name, period.windows]
+                   for period in self.periods]
+
+        return runSignature(
+            self.shapefile, periods=periods, reducers=self.reducers,
+            all_touched=self.all_touched, stat=self.stat, output_format=self.output_format,
+            coverage=self.coverage, percentile_method=self.percentile_method,
+            percentile_bins=self.percentile_bins, partial_periods=self.partial_periods)
+
+    def _stat_columns(self, ds_variable):
+        """Output column of every statistic, the variable name alone for a single stat."""
+        if isinstance(self.stat, str):
+            return [ds_variable]
+        return [f"{ds_variable}_{zone_stat}" for zone_stat in self.stats]
+
+    def _period_reductions(self, times, reducer, stat_columns, dtype):
+        """
+        Sets up the reduction of every period spec, one per window of a crop calendar.
+
+        A crop-calendar window only reduces the pixels of its zones, and its zone index
+        and result builder only hold its zones.
+
+        Returns:
+            list: The position of the spec, the zone ids of the window or None for every
+            zone, the zone index, the positions of its pixels among the gathered pixels
+            or None for every pixel, the period reduction and the result builder of
+            every reduction.
+        """
+        reductions = []
+
+        for position, period in enumerate(self.periods):
+            if isinstance(period, CropCalendar):
+                labels_functions = [
+                    (zone_ids, partial(CropCalendar.window_labels, window=window))
+                    for window, zone_ids in period.groups().items()]
+            else:
+                labels_functions = [(None, partial(period_labels, period=period))]
+
+            for zone_ids, labels_function in labels_functions:
+                period_ids, labels = period_positions(
+                    times, labels_function, self.partial_periods)
+
+                if zone_ids is None:
+                    zone_index, entries = self.zone_index, None
+                else:
+                    zone_index = self.zone_index.subset(zone_ids)
+                    entries = self.zone_index.entries(zone_ids)
+
+                results = ResultBuilder(
+                    zone_index.n_zones, len(labels), stat_columns, dtype=dtype)
+                results.set_dates([str(label) for label in labels])
+                reductions.append((position, zone_ids, zone_index, entries,
+                                   PeriodReduction(period_ids, reducer), results))
+
+        return reductions
+
+    def _aggregate_periods(self, reduction, results, zone_index):
+        """Computes the zone statistics of the periods finished by a reduction."""
+        finished = reduction.pop()
+        if not finished:
+            return
+
+        positions = [position for position, _ in finished]
+        zone_values = zonal_statistics(
+            np.stack([values for _, values in finished]), zone_index, self.stats,
+            percentile_method=self.percentile_method, percentile_bins=self.percentile_bins)
+
+        results.values[:, positions, :] = zone_values.transpose(1, 0, 2)
+
+    def _temporal_datasets(self, folder):
+
+        ds = open_variable_dataset(folder, self.from_zip, parallel=bool(self.multiprocessing))
+
+        ds_variable = list(ds.data_vars)[0]
+        reducer = self.reducers.get(ds_variable, 'mean')
+        n_times = len(ds.time)
+
+        reductions = self._period_reductions(
+            ds['time'].values, reducer, self._stat_columns(ds_variable), ds[ds_variable].dtype)
+
+        # Every block of days is read and gathered once for all the periods
+        for start in tqdm(range(0, n_times, self.time_block), desc='Time blocks',
+                          disable=self.time_block >= n_times):
+            values = self.zone_index.gather_grid(
+                ds[ds_variable].isel(time=slice(start, start + self.time_block)).values)
+
+            for _, _, zone_index, entries, reduction, results in reductions:
+                reduction.update(values if entries is None else values[:, entries], start)
+                self._aggregate_periods(reduction, results, zone_index)
+
+        for _, _, zone_index, _, reduction, results in reductions:
+            reduction.close()
+            self._aggregate_periods(reduction, results, zone_index)
+
+        # Zip members read by HDF5 must be released before the interpreter exits
+        ds.close()
+
+        attributes = zone_attributes(self.shapefile)
+
+        for position, name in enumerate(self.period_names):
+            frames = []
+
+            for _, zone_ids, _, _, _, results in [
+                    reduction for reduction in reductions if reduction[0] == position]:
+                if zone_ids is None:
+                    zone_ids = np.arange(results.n_zones)
+
+                # A crop-calendar window only holds the rows of its zones
+                df = results.to_frame(
+                    attributes.take(zone_ids).reset_index(drop=True), order="zone")
+                df['zone_id'] = np.repeat(zone_ids, results.n_dates)
+                frames.append(df)
+
+            # A crop calendar without any window has no reduction
+            if not frames:
+                print(f"No {name} period found for {ds_variable}")
+                continue
+
+            df = pd.concat(frames, ignore_index=True).sort_values('zone_id', kind='stable')
+
+            if len(df):
+                output_path = outputPath(
+                    f'{self.area_name}_Aggregated_{name}_csv/AgERA5_{self.area_name}_{ds_variable}_{name}',
+                    self.output_format)
+
+                with getOutputSink(output_path, self.output_format, variable=ds_variable) as sink:
+                    sink.write(df.drop(columns='zone_id').reset_index(drop=True))
+            else:
+                print(f"No {name} period found for {ds_variable}")
@@ -1,24 +1,40 @@
-def get_retrieve_params(parameter, area=[71, -31, 34.5, 40], start_year=None, end_year=None):
+# Variable and statistic of every AgERA5 parameter
+AGERA5_PARAMETERS = {
+    'Maximum_Temperature': {'2m_temperature': '24_hour_maximum'},
+    'Minimum_Temperature': {'2m_temperature': '24_hour_minimum'},
+    'Mean_Temperature': {'2m_temperature': '24_hour_mean'},
+    'Solar_Radiation_Flux': {'solar_radiation_flux': None},
+    'Precipitation_Flux': {'precipitation_flux': None},
+    'Wind_Speed': {'10m_wind_speed': '24_hour_mean'},
+    'Vapour_Pressure': {'vapour_pressure': '24_hour_mean'}
+}
+
+
+def check_parameters(parameters):
+    """
+    Raises a ValueError if a parameter is not an AgERA5 parameter.
+
+    Args:
+        parameters (list): AgERA5 parameter names, e.g. 'Mean_Temperature'.
+    """
+    unknown = [parameter for parameter in parameters if parameter not in AGERA5_PARAMETERS]
+
+    if unknown:
+        raise ValueError(
+            f"Unknown AgERA5 parameters: {', '.join(map(str, unknown))}. "
+            f"Options are {', '.join(AGERA5_PARAMETERS)}.")
+
+
+def get_retrieve_params(parameter, area=[71, -31, 34.5, 40], start_year=None, end_year=None, months=None):
 
     # Set end_year to start_year if not provided
     if end_year is None:
         end_year = start_year
 
-    # AgERA5 Dictionary
-    AgERA5_parm = {
-        'Maximum_Temperature': {'2m_temperature': '24_hour_maximum'},
-        'Minimum_Temperature': {'2m_temperature': '24_hour_minimum'},
-        'Mean_Temperature': {'2m_temperature': '24_hour_mean'},
-        'Solar_Radiation_Flux': {'solar_radiation_flux': None},
-        'Precipitation_Flux': {'precipitation_flux': None},
-        'Wind_Speed': {'10m_wind_speed': '24_hour_mean'},
-        'Vapour_Pressure': {'vapour_pressure': '24_hour_mean'}
-    }
-
-    # Check if the parameter is in the AgERA5_parm dictionary
-    if parameter in AgERA5_parm:
+    # Check if the parameter is in the AgERA5_PARAMETERS dictionary
+    if parameter in AGERA5_PARAMETERS:
         # Extract the variable and statistic
-        variable_statistic_pair = AgERA5_parm[parameter]
+        variable_statistic_pair = AGERA5_PARAMETERS[parameter]
         variable, statistic = list(variable_statistic_pair.items())[0]
 
         # Construct the return dictionary
@@ -28,7 +44,7 @@ def get_retrieve_params(parameter, area=[71, -31, 34.5, 40], start_year=None, en
             'area': area,
             'variable': variable,
             'year': [str(year) for year in range(start_year, end_year + 1)],
-            'month': ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12'],
+            'month': list(months) if months else ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12'],
             'day': [
                 '01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12',
                 '13', '14', '15', '16', '17', '18', '19', '20', '21', '22', '23', '24',
@@ -1,7 +1,11 @@
 import os
 import concurrent.futures
-from .cds_param import get_retrieve_params
+from functools import partial
+from .cds_param import check_parameters, get_retrieve_params
 from .cds_api_key_manager import APIKeyManager
+from .download_queue import (
+    MAX_ENDPOINT_REQUESTS, MAX_REQUEST_SIZE, MONTHS, DownloadQueue, DownloadTask,
+    InvalidZipError, endpoint_slots, is_valid_zip, request_size, retryDownload)
 try:
     import cdsapi
 except ImportError:
@@ -9,41 +13,124 @@ except ImportError:
 
 
 class AgERA5Downloader:
-    def __init__(self, area_name, parameters, bounding_box, start_year, end_year):
+    """
+    Downloads the AgERA5 parameters of an area from the CDS, one zip file per request.
+
+    Completed zip files are recorded in '{area_name}/.download_queue.json', so a job
+    interrupted or stopped by failing requests downloads only the missing files
+    when it runs again.
+
+    Attributes:
+        cds: The CDS client, any object with a cdsapi-like `retrieve(name, request, target)`.
+        chunk (str): 'year' for one request per year, 'month' for one per month, 'auto'
+            to split the years larger than max_request_size pixel-days into months.
+        retries (int): Attempts after the first failure of a request.
+        backoff (float): Seconds waited after the first failure, doubled after every retry.
+        max_endpoint_requests (int): Concurrent requests to the CDS endpoint.
+    """
+
+    def __init__(self, area_name, parameters, bounding_box, start_year, end_year, client=None, chunk='auto', max_request_size=MAX_REQUEST_SIZE, retries=3, backoff=30.0, max_endpoint_requests=MAX_ENDPOINT_REQUESTS):
+
+        if chunk not in ('auto', 'year', 'month'):
+            raise ValueError(
+                f"Invalid chunk: {chunk}. Options are 'auto', 'year', 'month'.")
+
+        # An unknown parameter fails before any request is sent
+        check_parameters(parameters)
 
-        self.api_key_manager = APIKeyManager().add_cds_api_key()
         self.area_name = area_name
         self.parameters = parameters
         self.start_year = start_year
         self.end_year = end_year
         self.bounding_box = bounding_box
+        self.chunk = chunk
+        self.max_request_size = max_request_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_endpoint_requests = max_endpoint_requests
+
+        # A given client, e.g. a local stand-in of the CDS, needs no API key
+        if client is None:
+            self.api_key_manager = APIKeyManager().add_cds_api_key()
+            client = cdsapi.Client(progress=False)
 
-        self.cds = cdsapi.Client(progress=False)
+        self.cds = client
 
     def download_AgERA5(self, num_requests):
+        """
+        Downloads the missing zip files, num_requests at a time.
+
+        Raises:
+            RuntimeError: If requests still fail after the retries. The other files are
+                downloaded and recorded, so running again only retries the failed ones.
+        """
+        # Hidden, so it is not taken for a parameter folder
+        os.makedirs(self.area_name, exist_ok=True)
+        queue = DownloadQueue(os.path.join(self.area_name, '.download_queue.json'))
+        tasks = [task for task in self._download_tasks()
+                 if not queue.is_complete(task.path)]
+
+        if not tasks:
+            print("AgERA5 data already downloaded.")
+            return
+
+        download = partial(
+            retryDownload, self._AgERA5_Requests, retries=self.retries, backoff=self.backoff)
+        failed = []
 
         with concurrent.futures.ThreadPoolExecutor(
                 max_workers=num_requests) as executor:
-            tasks = [
-                executor.submit(self._AgERA5_Requests, year, parameter)
-                for year in range(self.start_year, self.end_year + 1)
-                for parameter in self.parameters
-            ]
+            futures = {executor.submit(download, task): task for task in tasks}
+
+            for future in concurrent.futures.as_completed(futures):
+                task = futures[future]
+                error = future.result()
+
+                if error:
+                    print(error)
+                    queue.fail(task.path, error)
+                    failed.append(task.path)
+                else:
+                    queue.complete(task.path)
+
+        if failed:
+            raise RuntimeError(
+                f"{len(failed)} AgERA5 downloads failed, run the download again to "
+                f"retry them: {', '.join(sorted(failed))}")
 
-            for future in concurrent.futures.as_completed(tasks):
-                future.result()
+    def _download_tasks(self):
+        """Every request of the job, monthly for the years too large for one request."""
+        if self.chunk == 'auto':
+            monthly = request_size(self.bounding_box) > self.max_request_size
+        else:
+            monthly = self.chunk == 'month'
 
-    def _AgERA5_Requests(self, year, parameter):
+        return [
+            DownloadTask(self.area_name, parameter, year, month)
+            for year in range(self.start_year, self.end_year + 1)
+            for parameter in self.parameters
+            for month in (MONTHS if monthly else [None])
+        ]
 
-        parameter_path = os.path.join(self.area_name, parameter)
+    def _AgERA5_Requests(self, task):
 
-        os.makedirs(parameter_path, exist_ok=True)
+        os.makedirs(os.path.dirname(task.path), exist_ok=True)
 
         retrieve_params = get_retrieve_params(
-            parameter, self.bounding_box, year)
+            task.parameter, self.bounding_box, task.year, months=task.months)
+
+        # The zip file only takes its name once complete and verified
+        partial_path = f'{task.path}.partial'
+
+        with endpoint_slots(self.cds, self.max_endpoint_requests):
+            self.cds.retrieve(
+                'sis-agrometeorological-indicators',
+                retrieve_params,
+                partial_path
+            )
+
+        if not is_valid_zip(partial_path):
+            os.remove(partial_path)
+            raise InvalidZipError(f"The downloaded file {task.path} is not a valid zip file.")
 
-        self.cds.retrieve(
-            'sis-agrometeorological-indicators',
-            retrieve_params,
-            f'{parameter_path}/{self.area_name}_{year}_{parameter}.zip'
-        )
+        os.replace(partial_path, task.path)
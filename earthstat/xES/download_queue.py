@@ -0,0 +1,225 @@
+import json
+import os
+import threading
+import time
+import zipfile
+
+
+# Concurrent requests per CDS endpoint, more may get the API key blocked
+MAX_ENDPOINT_REQUESTS = 6
+
+# Pixel-days above which a yearly request is split into monthly requests
+MAX_REQUEST_SIZE = 25_000_000
+
+# Resolution of the AgERA5 grid, in degrees
+AGERA5_RESOLUTION = 0.1
+
+MONTHS = ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']
+
+
+class InvalidZipError(Exception):
+    """A downloaded file that is not a complete zip file, e.g. a truncated transfer."""
+
+
+# Errors worth retrying a request for. The HTTP and connection errors of requests,
+# used by cdsapi, are OSErrors. Other errors, e.g. a request the CDS rejects, fail
+# the same way on every attempt.
+TRANSIENT_ERRORS = (OSError, InvalidZipError, zipfile.BadZipFile)
+
+
+class DownloadTask():
+    """
+    One CDS request, a parameter over a year or a month of a year.
+
+    Attributes:
+        parameter (str): The AgERA5 parameter.
+        year (int): The year requested.
+        month (str): The 'MM' month requested, None for the whole year.
+        path (str): Path of the downloaded zip file.
+    """
+
+    def __init__(self, area_name, parameter, year, month=None):
+
+        self.parameter = parameter
+        self.year = year
+        self.month = month
+
+        period = f'{year}_{month}' if month else f'{year}'
+        self.path = os.path.join(
+            area_name, parameter, f'{area_name}_{period}_{parameter}.zip')
+
+    @property
+    def months(self):
+        """Months of the request."""
+        return [self.month] if self.month else MONTHS
+
+
+class DownloadQueue():
+    """
+    Persistent record of the completed downloads of an area.
+
+    A download is recorded once its zip file is complete and every member passed its
+    CRC-32 check, with the size and modification time of the file. Later runs skip
+    the recorded files that did not change, so an interrupted or failed job only
+    downloads the missing files again. Failed downloads are recorded with their error.
+
+    Attributes:
+        path (str): Path of the queue JSON file.
+        completed (dict): Size and modification time of every completed zip file.
+        failed (dict): Error of every failed zip file.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        try:
+            with open(path) as f:
+                content = json.load(f)
+
+        except (FileNotFoundError, ValueError):
+            content = {}
+
+        self.completed = {
+            file_path: tuple(fingerprint)
+            for file_path, fingerprint in content.get('completed', {}).items()}
+        self.failed = content.get('failed', {})
+
+    def is_complete(self, file_path):
+        """
+        Whether a zip file is downloaded and verified.
+
+        A zip file missing from the record, e.g. downloaded by an older run, is
+        verified once and recorded.
+
+        Args:
+            file_path (str): Path of the zip file.
+
+        Returns:
+            bool: True if the file can be skipped.
+        """
+        if not os.path.isfile(file_path):
+            return False
+
+        if self.completed.get(file_path) == file_fingerprint(file_path):
+            return True
+
+        if is_valid_zip(file_path):
+            self.complete(file_path)
+            return True
+
+        return False
+
+    def complete(self, file_path):
+        """Records a verified zip file."""
+        self.completed[file_path] = file_fingerprint(file_path)
+        self.failed.pop(file_path, None)
+        self.save()
+
+    def fail(self, file_path, error):
+        """Records the error of a failed download."""
+        self.failed[file_path] = error
+        self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump({"completed": self.completed, "failed": self.failed}, f, indent=1)
+
+        os.replace(tmp_path, self.path)
+
+
+def file_fingerprint(file_path):
+    """Returns the size and modification time of a file."""
+    stat = os.stat(file_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def is_valid_zip(file_path):
+    """Whether a file is a zip file with at least one member, all passing their CRC-32 check."""
+    try:
+        with zipfile.ZipFile(file_path) as zip_ref:
+            return bool(zip_ref.infolist()) and zip_ref.testzip() is None
+
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+
+def request_size(bounding_box, days=366):
+    """
+    Estimates the pixel-days of a request.
+
+    Args:
+        bounding_box (list): The CDS area, north, west, south and east.
+        days (int): Days requested.
+
+    Returns:
+        int: The number of AgERA5 pixels of the area times the days.
+    """
+    north, west, south, east = bounding_box
+    rows = max(round(abs(north - south) / AGERA5_RESOLUTION), 1)
+    cols = max(round(abs(east - west) / AGERA5_RESOLUTION), 1)
+
+    return rows * cols * days
+
+
+# Request slots shared by every downloader of an endpoint, by endpoint
+_endpoint_slots = {}
+_endpoint_lock = threading.Lock()
+
+
+def endpoint_slots(client, max_requests=MAX_ENDPOINT_REQUESTS):
+    """
+    Returns the semaphore capping the concurrent requests to the endpoint of a client.
+
+    Every downloader of the process sending requests to the same endpoint shares the
+    semaphore, so the cap holds across downloaders. The cap of the first one applies.
+
+    Args:
+        client: The CDS client, its 'url' attribute names the endpoint.
+        max_requests (int): Concurrent requests allowed to the endpoint.
+
+    Returns:
+        threading.BoundedSemaphore: The semaphore shared by every client of the endpoint.
+    """
+    endpoint = getattr(client, 'url', None) or type(client).__name__
+
+    with _endpoint_lock:
+        if endpoint not in _endpoint_slots:
+            _endpoint_slots[endpoint] = threading.BoundedSemaphore(max_requests)
+
+        return _endpoint_slots[endpoint]
+
+
+def retryDownload(download, task, retries=3, backoff=30.0):
+    """
+    Calls a download function on a task, retrying it with exponential backoff.
+
+    Only `TRANSIENT_ERRORS` are retried, any other error fails the task at once.
+
+    Args:
+        download (callable): Function downloading a task.
+        task (DownloadTask): The task.
+        retries (int): Number of attempts after the first failure.
+        backoff (float): Seconds waited after the first failure, doubled after every
+            later failure.
+
+    Returns:
+        str: None once downloaded, else the error message of the last attempt.
+    """
+    for attempt in range(retries + 1):
+        try:
+            download(task)
+            return None
+
+        except TRANSIENT_ERRORS as e:
+            message = f"Failed to download {task.path}: {e!r}"
+
+            if attempt < retries:
+                time.sleep(backoff * 2 ** attempt)
+
+        except Exception as e:
+            return f"Failed to download {task.path}: {e!r}"
+
+    return message
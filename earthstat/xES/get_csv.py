@@ -1,19 +1,28 @@
-import glob
 import pandas as pd
 from datetime import datetime
 
+from ..analysis_aggregation.output_sink import (
+    getOutputSink, globOutputs, outputPath, readOutput)
+from ..analysis_aggregation.zone_index import parse_statistic
 
-def get_merged_csv(area_name, workflow, kelvin_to_celsius=False, output_name=None):
+
+# Statistics in the unit of the values, shifted by a change of temperature scale.
+# Sums, standard deviations and counts are not.
+LOCATION_STATISTICS = ('mean', 'median', 'min', 'max', 'percentile')
+
+
+def get_merged_csv(area_name, workflow, kelvin_to_celsius=False, output_name=None, output_format='csv'):
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    files_to_merge = glob.glob(f'{area_name}_Aggregated_{workflow}_csv/*.csv')
+    files_to_merge = globOutputs(f'{area_name}_Aggregated_{workflow}_csv')
 
-    common_columns = _common_columns_csvs(files_to_merge)
-    merged_df = pd.read_csv(files_to_merge[0])
+    # Each aggregated output is read once, whatever format it was written in
+    dataframes = [readOutput(file) for file in files_to_merge]
+    common_columns = _common_columns(dataframes)
+    merged_df = dataframes[0]
 
-    for file in files_to_merge[1:]:
-        temp_df = pd.read_csv(file)
+    for temp_df in dataframes[1:]:
         merged_df = pd.merge(merged_df, temp_df,
                              on=common_columns, how='outer')
 
@@ -26,8 +35,14 @@ def get_merged_csv(area_name, workflow, kelvin_to_celsius=False, output_name=Non
         conversion_factor = 273.15
 
         for column in temperature_columns:
+            # Multi-statistic outputs have one '{variable}_{stat}' column per statistic
+            stat_columns = [
+                col for col in merged_df.columns if _is_location_statistic(col, column)]
+
             if column in merged_df.columns:
                 merged_df[column] -= conversion_factor
+            elif stat_columns:
+                merged_df[stat_columns] -= conversion_factor
             else:
                 print(f"Column {column} does not exist in the DataFrame.")
 
@@ -37,16 +52,31 @@ def get_merged_csv(area_name, workflow, kelvin_to_celsius=False, output_name=Non
     merged_df = merged_df[['date'] + merged_columns]
 
     if output_name:
-        filename = f'{output_name}_{workflow}_{timestamp}.csv'
-        merged_df.to_csv(filename, index=False)
+        filename = outputPath(
+            f'{output_name}_{workflow}_{timestamp}', output_format)
 
     else:
-        filename = f'AgERA5_{area_name}_merged_parameters_{workflow}_{timestamp}.csv'
-        merged_df.to_csv(filename, index=False)
+        filename = outputPath(
+            f'AgERA5_{area_name}_merged_parameters_{workflow}_{timestamp}', output_format)
+
+    with getOutputSink(filename, output_format) as sink:
+        sink.write(merged_df)
 
 
-def _common_columns_csvs(file_paths):
-    dataframes = [pd.read_csv(file_path) for file_path in file_paths]
+def _common_columns(dataframes):
     common_cols = list(set.intersection(
         *[set(df.columns) for df in dataframes]))
     return common_cols
+
+
+def _is_location_statistic(column, variable):
+    """Whether a column is a '{variable}_{stat}' column of a location statistic."""
+    if not column.startswith(f'{variable}_'):
+        return False
+
+    try:
+        name, _ = parse_statistic(column[len(variable) + 1:])
+    except ValueError:
+        return False
+
+    return name in LOCATION_STATISTICS
@@ -0,0 +1,203 @@
+import numpy as np
+import pandas as pd
+
+from .DekadalDatasetBuilder import DekadalDatasetBuilder
+
+
+# Periods with their own labelling rules, any other period is a pandas frequency
+NAMED_PERIODS = ('dekad', 'pentad')
+
+# Reductions of the days of a period, per pixel
+REDUCERS = ('sum', 'mean', 'min', 'max')
+
+# Reducer of the AgERA5 variables, the other variables are averaged
+DEFAULT_REDUCERS = {
+    'Precipitation_Flux': 'sum',
+    'Solar_Radiation_Flux': 'sum',
+    'Temperature_Air_2m_Min_24h': 'min',
+    'Temperature_Air_2m_Max_24h': 'max',
+}
+
+# Days added on both sides of the data to count the days of its first and last periods
+PERIOD_MARGIN_DAYS = 400
+
+
+def period_labels(times, period):
+    """
+    Labels every day with the period it belongs to.
+
+    Args:
+        times (array-like): Timestamps of the daily data.
+        period (str): 'dekad', labelled like `DekadalDatasetBuilder`, 'pentad', six periods
+            per month whose last one ends with the month, or a pandas period frequency such
+            as 'W', 'M', 'Q-NOV' (DJF, MAM, JJA and SON seasons) or 'Y'. Pentads and
+            frequency periods are labelled by their first day.
+
+    Raises:
+        ValueError: If period is not a named period nor a pandas period frequency.
+
+    Returns:
+        ndarray: The datetime64[ns] label of every day.
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+
+    if period == 'dekad':
+        return DekadalDatasetBuilder.dekad_labels(times)
+
+    days = times.astype('datetime64[D]')
+
+    if period == 'pentad':
+        month_starts = times.astype('datetime64[M]').astype('datetime64[D]')
+        pentad = np.minimum((days - month_starts).astype('int64') // 5, 5)
+        return (month_starts + pentad * np.timedelta64(5, 'D')).astype('datetime64[ns]')
+
+    try:
+        periods = pd.DatetimeIndex(days).to_period(period)
+    except (ValueError, TypeError):
+        raise ValueError(
+            f"Invalid period: {period}. Options are 'dekad', 'pentad' or a pandas period "
+            "frequency such as 'W', 'M', 'Q-NOV', 'Y'.")
+
+    return periods.start_time.values.astype('datetime64[ns]')
+
+
+class CropCalendar():
+    """
+    Per-zone crop-calendar windows, one season per year and zone.
+
+    A season starting on 'MM-DD' and ending on an earlier 'MM-DD' crosses the new
+    year, and is labelled by its first day. Zones sharing the same window are
+    reduced together.
+
+    Attributes:
+        name (str): Name of the calendar, used in the output folder and file names.
+        windows (list): Start and end 'MM-DD' of the season of every zone, in shapefile
+            order, or None for the zones without season.
+    """
+
+    def __init__(self, name, windows):
+
+        self.name = name
+        self.windows = [tuple(window) if window is not None else None for window in windows]
+
+        for window in self.windows:
+            if window is None:
+                continue
+
+            for month_day in window:
+                if month_day == '02-29' or not _is_month_day(month_day):
+                    raise ValueError(
+                        f"Invalid crop-calendar date: {month_day}. Dates are 'MM-DD', "
+                        "except '02-29'.")
+
+    @classmethod
+    def from_columns(cls, name, shapefile, start_column, end_column):
+        """
+        Reads the window of every zone from two 'MM-DD' columns of the shapefile.
+
+        Args:
+            name (str): Name of the calendar.
+            shapefile (GeoDataFrame): The shapefile of the zones.
+            start_column (str): Column of the first day of the season.
+            end_column (str): Column of the last day of the season.
+
+        Returns:
+            CropCalendar: The calendar, without season for the zones missing either date.
+        """
+        windows = [
+            (start, end) if isinstance(start, str) and isinstance(end, str) else None
+            for start, end in zip(shapefile[start_column], shapefile[end_column])]
+
+        return cls(name, windows)
+
+    def groups(self):
+        """
+        Groups the zones sharing the same window.
+
+        Returns:
+            dict: The zone ids of every window.
+        """
+        groups = {}
+        for zone_id, window in enumerate(self.windows):
+            if window is not None:
+                groups.setdefault(window, []).append(zone_id)
+
+        return {window: np.array(zone_ids) for window, zone_ids in groups.items()}
+
+    @staticmethod
+    def window_labels(times, window):
+        """
+        Labels every day inside a window with the first day of its season.
+
+        Args:
+            times (array-like): Timestamps of the daily data.
+            window (tuple): Start and end 'MM-DD' of the season.
+
+        Returns:
+            ndarray: The datetime64[ns] label of every day, NaT outside the season.
+        """
+        days = pd.DatetimeIndex(np.asarray(times, dtype='datetime64[ns]')).normalize()
+        month_day = days.month * 100 + days.day
+        start, end = (int(date[:2]) * 100 + int(date[3:]) for date in window)
+
+        if start <= end:
+            inside = (month_day >= start) & (month_day <= end)
+            years = days.year
+        else:
+            inside = (month_day >= start) | (month_day <= end)
+            years = np.where(month_day >= start, days.year, days.year - 1)
+
+        labels = np.full(len(days), np.datetime64('NaT'), dtype='datetime64[ns]')
+        labels[inside] = pd.to_datetime(
+            [f"{year}-{window[0]}" for year in np.asarray(years)[inside]]).values
+
+        return labels
+
+
+def period_positions(times, labels_function, partial_periods=False):
+    """
+    Numbers the consecutive periods of the days, dropping the incomplete ones.
+
+    Args:
+        times (ndarray): Sorted timestamps of the daily data, reduced to their day.
+        labels_function (callable): Function of timestamps returning their period labels.
+        partial_periods (bool): Keep the periods missing some of their days in the data.
+
+    Returns:
+        tuple: The position of the period of every day, -1 outside any period, and the
+        label of every period.
+    """
+    times = np.asarray(times, dtype='datetime64[D]').astype('datetime64[ns]')
+    labels = labels_function(times)
+    valid = ~np.isnat(labels)
+    period_starts, positions = np.unique(labels[valid], return_inverse=True)
+
+    if not partial_periods and len(times):
+        days = pd.date_range(
+            pd.Timestamp(times.min()).normalize() - pd.Timedelta(days=PERIOD_MARGIN_DAYS),
+            pd.Timestamp(times.max()).normalize() + pd.Timedelta(days=PERIOD_MARGIN_DAYS))
+        all_labels = labels_function(days.values)
+        expected = pd.Series(all_labels[~np.isnat(all_labels)]).value_counts()
+        observed = np.bincount(positions, minlength=len(period_starts))
+
+        complete = observed == expected.reindex(period_starts).to_numpy()
+        period_starts = period_starts[complete]
+        positions = np.where(complete[positions], np.cumsum(complete)[positions] - 1, -1)
+
+    period_ids = np.full(len(times), -1)
+    period_ids[valid] = positions
+
+    return period_ids, period_starts
+
+
+def _is_month_day(month_day):
+
+    if not isinstance(month_day, str) or len(month_day) != 5:
+        return False
+
+    try:
+        pd.Timestamp(f"2001-{month_day}")
+    except ValueError:
+        return False
+
+    return True
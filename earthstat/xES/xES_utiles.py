@@ -1,8 +1,27 @@
 import zipfile
+import importlib.util
 import os
 import glob
+import io
+import json
 import re
+import shutil
 import logging
+import zlib
+from functools import partial
+from tqdm.auto import tqdm
+import xarray as xr
+from affine import Affine
+
+from ..analysis_aggregation.checkpoint import retryAggregation
+from ..analysis_aggregation.executors import getExecutor
+
+# h5netcdf is only used by xarray as an engine, so it is looked up without importing it
+h5netcdf_available = importlib.util.find_spec("h5netcdf") is not None
+
+
+# Bytes copied or checked at once, so members are streamed instead of loaded whole
+COPY_BUFFER = 1024 * 1024
 
 
 def create_directories(area_name):
@@ -15,16 +34,104 @@ def create_directories(area_name):
                 f"Failed to create directories in {param_folder}: {e}")
 
 
-def extract_zip(file_path, extract_path):
+def extract_zip(file_path, extract_path, check_crc=True):
+    """
+    Extracts the members of a zip file missing from the extract path.
+
+    Members are streamed to disk in chunks and their CRC-32 is checked while they
+    are read, so a corrupted zip raises instead of leaving a damaged file. A member is
+    written to a '.partial' file renamed once complete, so an interrupted extraction
+    never leaves a truncated member behind. Members already extracted with the same
+    size, and the same CRC-32 when check_crc is True, are skipped.
+
+    Args:
+        file_path (str): Path of the zip file.
+        extract_path (str): Directory the members are extracted to.
+        check_crc (bool): Compare the CRC-32 of the extracted members to skip them,
+            else only their size.
+
+    Raises:
+        zipfile.BadZipFile: If the zip file or the CRC-32 of a member is corrupted.
+
+    Returns:
+        tuple: The number of extracted and skipped members.
+    """
+    extracted = skipped = 0
+    root = os.path.realpath(extract_path)
+
     with zipfile.ZipFile(file_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_path)
+        for member in zip_ref.infolist():
+            target = os.path.realpath(os.path.join(extract_path, member.filename))
+
+            if member.is_dir():
+                continue
+
+            # Members are never written outside the extract path
+            if os.path.commonpath([root, target]) != root:
+                raise zipfile.BadZipFile(
+                    f"Member {member.filename} of {file_path} is outside the extract path.")
+
+            if is_extracted(member, target, check_crc):
+                skipped += 1
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            partial_path = f'{target}.partial'
+
+            try:
+                with zip_ref.open(member) as source, open(partial_path, 'wb') as destination:
+                    shutil.copyfileobj(source, destination, COPY_BUFFER)
+
+            except BaseException:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise
+
+            os.replace(partial_path, target)
+            extracted += 1
+
+    return extracted, skipped
+
+
+def is_extracted(member, target, check_crc=True):
+    """Whether a zip member is already extracted to target, by size and CRC-32."""
+    if not os.path.isfile(target) or os.path.getsize(target) != member.file_size:
+        return False
+
+    return not check_crc or file_crc32(target) == member.CRC
+
+
+def file_crc32(file_path):
+    """CRC-32 of a file, read in chunks."""
+    crc = 0
 
+    with open(file_path, 'rb') as f:
+        for chunk in iter(partial(f.read, COPY_BUFFER), b''):
+            crc = zlib.crc32(chunk, crc)
 
-def extract_AgERA5_zips(area_name):
+    return crc
+
+
+def extract_AgERA5_zips(area_name, max_workers=None, executor='thread', check_crc=True):
+    """
+    Extracts the yearly zip files of every variable in parallel.
+
+    Every zip file is extracted to '{variable}/Extracted/{year}' by one worker.
+    Decompression, CRC checks and writes release the GIL, so threads keep all cores
+    busy without the start-up cost of processes. Members already extracted are
+    skipped, so calling it again only extracts new or damaged members.
+
+    Args:
+        area_name (str): The area folder holding one folder per variable.
+        max_workers (int, optional): Number of workers, all cores but one by default.
+        executor (str): 'thread' (default), 'process' or 'dask', see `getExecutor`.
+        check_crc (bool): Skip the extracted members by size and CRC-32, else only by size.
+    """
     logging.basicConfig(level=logging.INFO)
     downloaded_zip_files = [file for path in glob.glob(
         f'{area_name}/*') for file in glob.glob(f'{path}/*.zip')]
     year_pattern = re.compile(r'\d{4}')
+    tasks = []
 
     for file in downloaded_zip_files:
         filename = os.path.basename(file)
@@ -32,15 +139,143 @@ def extract_AgERA5_zips(area_name):
         if year_match:
             year = year_match.group()
             parameter_path = os.path.dirname(file)
-            try:
-                extract_path = f'{parameter_path}/Extracted/{year}'
-                extract_zip(file, extract_path)
-                logging.info(f"Extracted {file} to {extract_path}")
-            except Exception as e:
-                logging.error(f"Failed to extract {file}: {e}")
+            tasks.append((file, f'{parameter_path}/Extracted/{year}'))
         else:
             logging.warning(f"Year not found in filename: {filename}")
 
+    if not tasks:
+        return
+
+    extract = partial(_extract_year_zip, check_crc=check_crc)
+
+    with getExecutor(executor, max_workers) as pool:
+        results = pool.imap(extract, tasks, ordered=False)
+
+        for index, error in tqdm(results, total=len(tasks), desc='Extracting'):
+            file, extract_path = tasks[index]
+            if error:
+                logging.error(f"Failed to extract {file}: {error}")
+
+
+def _extract_year_zip(task, check_crc=True):
+    """Extracts one zip file, returning the error instead of raising it."""
+    file, extract_path = task
+
+    try:
+        extracted, skipped = extract_zip(file, extract_path, check_crc)
+        logging.info(
+            f"Extracted {file} to {extract_path}: {extracted} extracted, {skipped} up to date")
+
+    except Exception as e:
+        return str(e)
+
+    return None
+
+
+def zip_members(folder):
+    """
+    Opens the netCDF members of the zip files of a variable folder, without extracting them.
+
+    Stored members are read lazily from the zip file. Compressed members cannot be
+    read at random offsets, so each is decompressed once in memory.
+
+    Args:
+        folder (str): The variable folder holding the yearly zip files.
+
+    Returns:
+        list: A file object per netCDF member.
+    """
+    members = []
+
+    for file_path in sorted(glob.glob(f'{folder}/*.zip')):
+        # Opened members keep the zip file open once it is closed here
+        with zipfile.ZipFile(file_path, 'r') as zip_ref:
+            members.extend(
+                open_member(zip_ref, member) for member in zip_ref.infolist()
+                if member.filename.endswith('.nc'))
+
+    return members
+
+
+def open_member(zip_ref, member):
+    """Opens a zip member as a seekable file object."""
+    if member.compress_type == zipfile.ZIP_STORED:
+        return zip_ref.open(member)
+
+    return io.BytesIO(zip_ref.read(member))
+
+
+def open_variable_dataset(folder, from_zip=False, parallel=False):
+    """
+    Opens the daily files of a variable folder as one dataset.
+
+    Args:
+        folder (str): The variable folder.
+        from_zip (bool): Read the netCDF members of the zip files with h5netcdf instead of
+            the extracted files.
+        parallel (bool): Open the files in parallel with dask.
+
+    Raises:
+        ImportError: If from_zip is True and h5netcdf is not installed.
+
+    Returns:
+        Dataset: The lazy dataset of the variable.
+    """
+    if not from_zip:
+        return xr.open_mfdataset(
+            glob.glob(f'{folder}/Extracted/*/*.nc'), combine='by_coords', parallel=parallel)
+
+    _require_h5netcdf()
+
+    return xr.open_mfdataset(
+        zip_members(folder), combine='by_coords', engine='h5netcdf', parallel=parallel)
+
+
+def open_sample_dataset(area_name, from_zip=False):
+    """Opens one daily file of the area, to read the grid shared by every file."""
+    if from_zip:
+        _require_h5netcdf()
+
+        with zipfile.ZipFile(glob.glob(f'{area_name}/*/*.zip')[0], 'r') as zip_ref:
+            member = next(
+                member for member in zip_ref.infolist() if member.filename.endswith('.nc'))
+            # Loaded and closed, a single day is small
+            with xr.open_dataset(open_member(zip_ref, member), engine='h5netcdf') as ds:
+                return ds.load()
+
+    return xr.open_dataset(glob.glob(f'{area_name}/*/Extracted/*/*.nc')[0])
+
+
+def dataset_grid(ds):
+    """
+    Returns the affine transform and the shape of the grid of a dataset.
+
+    The 'lat' and 'lon' coordinates are the centers of the pixels of a regular grid.
+
+    Args:
+        ds (Dataset): A dataset with 'lat' and 'lon' coordinates of at least two values.
+
+    Returns:
+        tuple: The Affine transform and the (height, width) of the grid.
+    """
+    lat = ds['lat'].values.astype('float64')
+    lon = ds['lon'].values.astype('float64')
+    res_x = float(lon[-1] - lon[0]) / (len(lon) - 1)
+    res_y = float(lat[-1] - lat[0]) / (len(lat) - 1)
+
+    transform = (Affine.translation(float(lon[0]) - res_x / 2, float(lat[0]) - res_y / 2)
+                 * Affine.scale(res_x, res_y))
+
+    return transform, (len(lat), len(lon))
+
+
+def _require_h5netcdf():
+
+    if not h5netcdf_available:
+        raise ImportError(
+            "Reading the zip files requires h5netcdf, or extract them. "
+            "Install it using 'pip install h5netcdf'.")
+
 
 # Pre-compile the regular expression (do this outside the function)
 year_pattern = re.compile(r'\d{4}')
@@ -68,3 +303,94 @@ def separate_path_components(path):
     normalized_path = path.replace('\\', '/')
     components = normalized_path.split('/')
     return components
+
+
+def load_completed_folders(checkpoint_path, signature):
+    """Variable folders completed by an interrupted run with the same signature."""
+    try:
+        with open(checkpoint_path) as f:
+            content = json.load(f)
+
+    except (FileNotFoundError, ValueError):
+        return []
+
+    if content.get("signature") != signature:
+        return []
+
+    return content.get("folders", [])
+
+
+def save_completed_folders(checkpoint_path, signature, folders):
+    tmp_path = f"{checkpoint_path}.tmp"
+
+    with open(tmp_path, "w") as f:
+        json.dump({"signature": signature, "folders": folders}, f, indent=1)
+
+    os.replace(tmp_path, checkpoint_path)
+
+
+def build_variable_folders(build_folder, var_folders, checkpoint_path, signature,
+                           multiprocessing=False, max_workers=None, resume=False,
+                           retries=0, skip_failed=False, executor='process', client=None):
+    """
+    Builds the dataset of every variable folder, recording the completed folders.
+
+    Every completed folder is saved to a checkpoint file, so a run interrupted by a
+    crash or a failing variable can be resumed without building the completed
+    variables again. The checkpoint is deleted once every folder is built.
+
+    Args:
+        build_folder (callable): Builds the dataset of one variable folder.
+        var_folders (list): The variable folders.
+        checkpoint_path (str): Path of the checkpoint JSON file.
+        signature (str): Signature of the run, see `runSignature`.
+        multiprocessing (bool): Build the folders in parallel on the executor.
+        max_workers (int, optional): Number of workers.
+        resume (bool): Skip the folders completed by the interrupted run.
+        retries (int): Number of times a failing folder is built again.
+        skip_failed (bool): Skip the folders that still fail after the retries instead of
+            stopping the run.
+        executor (str): With multiprocessing, 'process' or 'dask', see `getExecutor`.
+        client (dask.distributed.Client or str, optional): With the 'dask' executor, the client
+            or scheduler address of the cluster.
+
+    Raises:
+        ValueError: If executor is 'thread': netCDF files cannot be opened by several threads.
+    """
+    if multiprocessing and executor == 'thread':
+        raise ValueError(
+            "The 'thread' executor cannot build datasets: HDF5 is not thread-safe. "
+            "Options are 'process', 'dask'.")
+
+    completed = load_completed_folders(checkpoint_path, signature) if resume else []
+    pending = [folder for folder in var_folders if folder not in completed]
+    failed = []
+
+    for folder, error in _build_folders(build_folder, pending, multiprocessing, max_workers,
+                                        retries, skip_failed, executor, client):
+        if error:
+            print(f"{error}. Skipping the folder.")
+            failed.append(folder)
+        else:
+            completed.append(folder)
+            save_completed_folders(checkpoint_path, signature, completed)
+
+    if not failed and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def _build_folders(build_folder, folders, multiprocessing, max_workers, retries, skip_failed,
+                   executor='process', client=None):
+    """Yields every folder with the error of its build, None once built."""
+    if multiprocessing:
+        build = partial(retryAggregation, build_folder, retries=retries, skip_failed=skip_failed)
+
+        with getExecutor(executor, max_workers, client=client) as pool:
+            tasks = pool.imap(build, folders, ordered=False, chunksize=1)
+
+            for index, (_, error) in tqdm(tasks, total=len(folders)):
+                yield folders[index], error
+
+    else:
+        for folder in tqdm(folders, desc='Processing folders'):
+            yield folder, retryAggregation(build_folder, folder, retries, skip_failed)[1]
@@ -3,6 +3,7 @@ from .xES.xES_utiles import create_directories, extract_AgERA5_zips
 from .xES.download_AgERA5py import AgERA5Downloader
 from .xES.DekadalDatasetBuilder import DekadalDatasetBuilder
 from .xES.DailyDatasetBuilder import DailyDatasetBuilder
+from .xES.TemporalDatasetBuilder import TemporalDatasetBuilder
 from .xES.get_csv import get_merged_csv
 
 # Python built-in Libraries
@@ -10,6 +11,17 @@ import os
 import geopandas as gpd
 
 
+# Dataset types supporting an option, and its default value
+DATASET_OPTIONS = {
+    'time_block': (('daily', 'temporal'), None),
+    'incremental': (('daily',), False),
+    'aggregate_first': (('dekadal',), False),
+    'periods': (('temporal',), 'dekad'),
+    'reducers': (('temporal',), None),
+    'partial_periods': (('temporal',), False),
+}
+
+
 class xEarthStat():
     """
     xEarthStat is a Python package that provides a simple interface to download and aggregate AgERA5 data for a given region of interest (ROI).
@@ -39,7 +51,9 @@ class xEarthStat():
                 "If you plan to aggregate the data later, you will be asked to provide the shapefile path.")
             self.shapefile = None
 
-    def init_AgERA5_downloader(self, parameters, bounding_box, start_year, end_year):
+    def init_AgERA5_downloader(
+            self, parameters, bounding_box, start_year, end_year, client=None, chunk='auto',
+            retries=3, backoff=30.0):
 
         self.data_downloader = AgERA5Downloader(
 
@@ -47,44 +61,83 @@ class xEarthStat():
             parameters,
             bounding_box,
             start_year,
-            end_year
+            end_year,
+            client=client,
+            chunk=chunk,
+            retries=retries,
+            backoff=backoff
         )
 
-    def download_AgERA5(self, num_requests, extract=True):
+    def download_AgERA5(self, num_requests, extract=True, max_workers=None, check_crc=True):
 
         self.data_downloader.download_AgERA5(num_requests)
         # ask users if they want to extract the data
         if extract:
             create_directories(self.area_name)
-            extract_AgERA5_zips(self.area_name)
+            extract_AgERA5_zips(self.area_name, max_workers=max_workers, check_crc=check_crc)
             print("AgERA5 Data Downloaded and Extracted Successfully")
 
     # for extract later
 
-    def extract_AgERA5(self):
+    def extract_AgERA5(self, max_workers=None, executor='thread', check_crc=True):
         create_directories(self.area_name)
-        extract_AgERA5_zips(self.area_name)
+        extract_AgERA5_zips(
+            self.area_name, max_workers=max_workers, executor=executor, check_crc=check_crc)
         print("AgERA5 Data Extracted Successfully")
 
     def Aggregate_AgERA5(
             self, dataset_type='dekadal', all_touched=False, stat='mean',
-            multi_processing=False, max_workers=os.cpu_count()):
-
+            multi_processing=False, max_workers=os.cpu_count(),
+            output_format='csv', time_block=None, engine='zone_index', zone_cache_dir=None,
+            coverage=False, percentile_method='exact', percentile_bins=1000,
+            incremental=False, resume=False, retries=0, skip_failed=False,
+            executor='process', client=None, aggregate_first=False,
+            periods='dekad', reducers=None, partial_periods=False, from_zip=False):
+
+        self._check_dataset_options(
+            dataset_type, time_block=time_block, incremental=incremental,
+            aggregate_first=aggregate_first, periods=periods, reducers=reducers,
+            partial_periods=partial_periods)
         self._check_shapefile()
 
         self.aggregation_workflow = dataset_type
         self.processing = multi_processing
 
         self._init_aggregation_workflow(
-            self.aggregation_workflow, all_touched=all_touched, stat=stat)
+            self.aggregation_workflow, all_touched=all_touched, stat=stat,
+            output_format=output_format, time_block=time_block, engine=engine,
+            zone_cache_dir=zone_cache_dir, coverage=coverage,
+            percentile_method=percentile_method, percentile_bins=percentile_bins,
+            incremental=incremental, resume=resume, retries=retries,
+            skip_failed=skip_failed, aggregate_first=aggregate_first,
+            periods=periods, reducers=reducers, partial_periods=partial_periods,
+            from_zip=from_zip)
 
         print(f"Building {self.aggregation_workflow} ({stat}) Datasets...")
-        self.dataset_builder.build_datasets(max_workers=max_workers)
+        self.dataset_builder.build_datasets(
+            max_workers=max_workers, executor=executor, client=client)
         print(f"{self.aggregation_workflow} Datasets Aggregated Successfully")
 
+    def _check_dataset_options(self, dataset_type, **options):
+        # Any other dataset type builds daily datasets
+        builder = dataset_type if dataset_type in ('dekadal', 'temporal') else 'daily'
+
+        for option, value in options.items():
+            dataset_types, default = DATASET_OPTIONS[option]
+
+            if builder not in dataset_types and value != default:
+                raise ValueError(
+                    f"{option} is not supported by the {builder} datasets, only by the "
+                    f"{' and '.join(dataset_types)} datasets.")
+
     def _init_aggregation_workflow(
             self, dataset_type, max_workers=os.cpu_count(),
-            all_touched=False, stat='mean'):
+            all_touched=False, stat='mean', output_format='csv',
+            time_block=None, engine='zone_index', zone_cache_dir=None,
+            coverage=False, percentile_method='exact', percentile_bins=1000,
+            incremental=False, resume=False, retries=0, skip_failed=False,
+            aggregate_first=False, periods='dekad', reducers=None, partial_periods=False,
+            from_zip=False):
 
         if dataset_type == 'dekadal':
 
@@ -95,7 +148,45 @@ class xEarthStat():
                 multiprocessing=self.processing,
                 max_workers=max_workers,
                 all_touched=all_touched,
-                stat=stat
+                stat=stat,
+                output_format=output_format,
+                engine=engine,
+                zone_cache_dir=zone_cache_dir,
+                coverage=coverage,
+                percentile_method=percentile_method,
+                percentile_bins=percentile_bins,
+                resume=resume,
+                retries=retries,
+                skip_failed=skip_failed,
+                aggregate_first=aggregate_first,
+                from_zip=from_zip
+
+            )
+
+        elif dataset_type == 'temporal':
+
+            self.dataset_builder = TemporalDatasetBuilder(
+
+                self.area_name,
+                self.shapefile,
+                periods=periods,
+                reducers=reducers,
+                multiprocessing=self.processing,
+                max_workers=max_workers,
+                all_touched=all_touched,
+                stat=stat,
+                output_format=output_format,
+                engine=engine,
+                zone_cache_dir=zone_cache_dir,
+                coverage=coverage,
+                percentile_method=percentile_method,
+                percentile_bins=percentile_bins,
+                time_block=time_block,
+                partial_periods=partial_periods,
+                resume=resume,
+                retries=retries,
+                skip_failed=skip_failed,
+                from_zip=from_zip
 
             )
 
@@ -108,13 +199,33 @@ class xEarthStat():
                 multiprocessing=self.processing,
                 max_workers=max_workers,
                 all_touched=all_touched,
-                stat=stat
+                stat=stat,
+                output_format=output_format,
+                time_block=time_block,
+                incremental=incremental,
+                engine=engine,
+                zone_cache_dir=zone_cache_dir,
+                coverage=coverage,
+                percentile_method=percentile_method,
+                percentile_bins=percentile_bins,
+                resume=resume,
+                retries=retries,
+                skip_failed=skip_failed,
+                from_zip=from_zip
 
             )
 
-    def AgERA5_merged_csv(self, kelvin_to_celsius=False, output_name=None):
-        get_merged_csv(self.area_name, self.aggregation_workflow,
-                       kelvin_to_celsius=kelvin_to_celsius, output_name=output_name)
+    def AgERA5_merged_csv(self, kelvin_to_celsius=False, output_name=None, output_format='csv'):
+        # A temporal aggregation writes one folder per period
+        if self.aggregation_workflow == 'temporal':
+            workflows = self.dataset_builder.period_names
+        else:
+            workflows = [self.aggregation_workflow]
+
+        for workflow in workflows:
+            get_merged_csv(self.area_name, workflow,
+                           kelvin_to_celsius=kelvin_to_celsius, output_name=output_name,
+                           output_format=output_format)
         print("CSV Merged Successfully")
 
     def _check_shapefile(self):
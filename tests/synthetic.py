@@ -0,0 +1,114 @@
+"""Tiny synthetic rasters and zones shared by the tests."""
+
+
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import xarray as xr
+from rasterio.transform import from_origin
+from shapely.geometry import Polygon, box
+
+
+DATES = ['20191231', '20200101', '20200102', '20200103']
+
+# Folder and netCDF variable of the AgERA5 parameters of the daily archives
+DAILY_VARIABLES = {
+    'Precipitation_Flux': 'Precipitation_Flux',
+    'Maximum_Temperature': 'Temperature_Air_2m_Max_24h',
+}
+
+TRANSFORM = from_origin(10.0, 50.0, 0.1, 0.1)
+
+
+def synthetic_zones():
+    """Returns three zones of different shapes inside the archive grid."""
+    geometries = [box(10.05, 48.53, 11.02, 49.95),
+                  box(11.21, 48.12, 12.93, 49.47),
+                  Polygon([(10.3, 48.1), (11.1, 48.9), (11.8, 48.05)])]
+
+    return gpd.GeoDataFrame({'NAME': ['A', 'B', 'C'], 'CODE': [1, 2, 3]},
+                            geometry=geometries, crs='EPSG:4326')
+
+
+def write_raster(path, values, nodata=-9999.0):
+    """Writes a single band GeoTIFF on the grid of the archive."""
+    profile = dict(driver='GTiff', height=values.shape[0], width=values.shape[1], count=1,
+                   dtype=values.dtype, crs='EPSG:4326', transform=TRANSFORM, nodata=nodata)
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(values, 1)
+
+
+def write_archive(root, dates=DATES, seed=0):
+    """
+    Writes a tiny archive of predictor rasters, a crop mask and three zones.
+
+    Args:
+        root (str): Directory of the archive.
+        dates (list): 'YYYYMMDD' date of every predictor raster.
+        seed (int): Seed of the random pixel values.
+
+    Returns:
+        tuple: The predictor directory and the shapefile path.
+    """
+    rng = np.random.default_rng(seed)
+    predictor_dir = os.path.join(root, 'pred')
+    os.makedirs(predictor_dir, exist_ok=True)
+
+    for position, date in enumerate(dates):
+        values = (rng.random((20, 30)) * 10 + position).astype('float32')
+        values[rng.random((20, 30)) < 0.05] = -9999.0
+        values[rng.random((20, 30)) < 0.02] = 251
+        write_raster(os.path.join(predictor_dir, f'fpar_{date}.tif'), values)
+
+    mask = (rng.random((20, 30)) * 100).astype('uint8')
+    mask[rng.random((20, 30)) < 0.1] = 255
+    write_raster(os.path.join(root, 'mask.tif'), mask, nodata=255)
+
+    shapefile_path = os.path.join(root, 'zones.shp')
+    synthetic_zones().to_file(shapefile_path)
+
+    return predictor_dir, shapefile_path
+
+
+def write_daily_archive(root, area_name='area', start='2019-12-20', end='2020-03-10',
+                        seed=0):
+    """
+    Writes the extracted daily netCDF files of an AgERA5 area, on the archive grid.
+
+    Args:
+        root (str): Directory of the area folder, the working directory of the builders.
+        area_name (str): Name of the area.
+        start (str): First day of the data.
+        end (str): Last day of the data.
+        seed (int): Seed of the random pixel values.
+
+    Returns:
+        tuple: The path of the area and the zones.
+    """
+    rng = np.random.default_rng(seed)
+    area_path = os.path.join(root, area_name)
+    lat = 50 - 0.1 * (np.arange(20) + 0.5)
+    lon = 10 + 0.1 * (np.arange(30) + 0.5)
+
+    for folder, variable in DAILY_VARIABLES.items():
+        for day in pd.date_range(start, end):
+            values = (rng.random((1, 20, 30)) * 10 + 270).astype('float32')
+            values[rng.random((1, 20, 30)) < 0.03] = np.nan
+
+            directory = os.path.join(area_path, folder, 'Extracted', str(day.year))
+            os.makedirs(directory, exist_ok=True)
+            ds = xr.Dataset({variable: (('time', 'lat', 'lon'), values)},
+                            coords={'time': [day], 'lat': lat, 'lon': lon})
+            ds.to_netcdf(os.path.join(
+                directory, f'{variable}_C3S-glob-agric_AgERA5_{day:%Y%m%d}_final-v1.1.nc'))
+
+    return area_path, synthetic_zones()
+
+
+def sort_rows(frame):
+    """Sorts output rows by date and zone name, whatever order they were written in."""
+    return frame.sort_values(['date', 'NAME'], kind='stable').reset_index(drop=True)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""Tests for the checkpoints, retries and skipped rasters of aggregation runs."""
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from earthstat.analysis_aggregation.aggregate_process import conAggregate
+from earthstat.analysis_aggregation.checkpoint import retryAggregation
+from earthstat.analysis_aggregation.output_sink import readOutput
+from earthstat.analysis_aggregation.parallel_clip_aggregate import parallelAggregate
+from earthstat.utils import loadTiff
+from tests.synthetic import DATES, sort_rows, write_archive
+
+
+class FlakyWorker():
+    """Fails a number of times before returning the raster path."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self, raster_path):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise OSError("read failed")
+        return raster_path
+
+
+class TestRetryAggregation(unittest.TestCase):
+    """Tests for `retryAggregation`."""
+
+    def test_retries(self):
+        worker = FlakyWorker(2)
+        self.assertEqual(retryAggregation(worker, 'a.tif', retries=2), ('a.tif', None))
+        self.assertEqual(worker.calls, 3)
+
+    def test_raises_after_retries(self):
+        worker = FlakyWorker(2)
+        with self.assertRaises(OSError):
+            retryAggregation(worker, 'a.tif', retries=1)
+        self.assertEqual(worker.calls, 2)
+
+    def test_skip_failed(self):
+        result, error = retryAggregation(FlakyWorker(1), 'a.tif', skip_failed=True)
+        self.assertIsNone(result)
+        self.assertIn('a.tif', error)
+
+
+class TestFailedRasters(unittest.TestCase):
+    """Tests for runs hitting a raster whose pixels cannot be read."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.predictor_dir, self.shapefile_path = write_archive(self.root)
+        self.output_path = os.path.join(self.root, 'output.csv')
+        self.checkpoint_dir = os.path.join(self.root, 'checkpoint')
+
+        expected_path = os.path.join(self.root, 'expected.csv')
+        conAggregate(self.predictor_dir, self.shapefile_path, expected_path,
+                     predictor_name='fpar')
+        self.expected = sort_rows(readOutput(expected_path))
+
+        # The last raster of the run fails, so the blocks of the others are saved first.
+        # Its header still opens, whatever raster the zone index is built from.
+        self.failed_path = loadTiff(self.predictor_dir)[-1]
+        self.failed_date = int(os.path.basename(self.failed_path)[5:13])
+        self.failed_copy = os.path.join(self.root, 'failed.tif')
+        shutil.copy(self.failed_path, self.failed_copy)
+        os.truncate(self.failed_path, 1200)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_skip_failed(self):
+        """With skip_failed, the other rasters are written and the failure is listed."""
+        runs = [
+            ('conAggregate', conAggregate, {}),
+            ('parallelAggregate', parallelAggregate,
+             {'executor': 'process', 'max_workers': 2}),
+        ]
+
+        for name, aggregate, options in runs:
+            with self.subTest(run=name):
+                aggregate(self.predictor_dir, self.shapefile_path, self.output_path,
+                          predictor_name='fpar', skip_failed=True, retries=1,
+                          checkpoint_dir=self.checkpoint_dir, **options)
+
+                output = readOutput(self.output_path)
+                self.assertEqual(len(output), 3 * (len(DATES) - 1))
+                self.assertNotIn(self.failed_date, set(output['date']))
+
+                with open(os.path.join(self.checkpoint_dir, 'failed.json')) as f:
+                    self.assertEqual(list(json.load(f)), [self.failed_path])
+
+    def test_resume(self):
+        """A resumed run writes the saved blocks and only aggregates the failed raster."""
+        for name, aggregate, options in [
+                ('conAggregate', conAggregate, {}),
+                ('parallelAggregate', parallelAggregate,
+                 {'executor': 'thread', 'max_workers': 1, 'max_in_flight': 1})]:
+            with self.subTest(run=name):
+                os.truncate(self.failed_path, 1200)
+
+                with self.assertRaises(Exception):
+                    aggregate(self.predictor_dir, self.shapefile_path, self.output_path,
+                              predictor_name='fpar', write_every=1,
+                              checkpoint_dir=self.checkpoint_dir, **options)
+
+                saved = len([path for path in os.listdir(self.checkpoint_dir)
+                             if path.startswith('block-')])
+                shutil.copy(self.failed_copy, self.failed_path)
+
+                aggregate(self.predictor_dir, self.shapefile_path, self.output_path,
+                          predictor_name='fpar', write_every=1,
+                          checkpoint_dir=self.checkpoint_dir, resume=True, **options)
+
+                output = sort_rows(readOutput(self.output_path))
+                self.assertEqual(saved, len(DATES) - 1)
+                self.assertTrue(output.equals(self.expected))
+                self.assertFalse(os.path.exists(self.checkpoint_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""Tests for the parallel clipping of rasters."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from earthstat.geo_data_processing.clip_raster import clipMultipleRasters
+from earthstat.utils import loadTiff
+from tests.synthetic import DATES, write_archive
+
+
+class TestClipMultipleRasters(unittest.TestCase):
+    """Tests for `clipMultipleRasters` on every local executor."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.predictor_dir, self.shapefile_path = write_archive(self.root)
+        self.raster_paths = sorted(loadTiff(self.predictor_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_clip(self):
+        for executor in ['thread', 'process']:
+            with self.subTest(executor=executor):
+                output_dir = clipMultipleRasters(
+                    self.raster_paths, self.shapefile_path, invalid_values=[251],
+                    max_workers=2, executor=executor)
+
+                self.assertEqual(sorted(os.listdir(output_dir)),
+                                 [f'clipped_fpar_{date}.tif' for date in DATES])
+
+    def test_failed_raster(self):
+        """A raster failing to clip raises with its path."""
+        failed_path = self.raster_paths[2]
+        os.truncate(failed_path, 1200)
+
+        for executor in ['thread', 'process']:
+            with self.subTest(executor=executor):
+                with self.assertRaisesRegex(RuntimeError, failed_path):
+                    clipMultipleRasters(self.raster_paths, self.shapefile_path,
+                                        max_workers=2, executor=executor)
+
+
+if __name__ == '__main__':
+    unittest.main()
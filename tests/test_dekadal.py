@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""Tests for the dekadal binning of the daily AgERA5 data."""
+
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from earthstat.xES.DekadalDatasetBuilder import DekadalDatasetBuilder
+from tests.synthetic import write_daily_archive
+
+
+# Reduction of the dekads of every kind of variable
+DEKADAL_VARIABLES = {
+    'Precipitation_Flux': 'sum',
+    'Temperature_Air_2m_Min_24h': 'min',
+    'Temperature_Air_2m_Max_24h': 'max',
+    'Relative_Humidity_2m_12h': 'mean',
+}
+
+
+class TestDekadLabels(unittest.TestCase):
+    """`dekad_labels` labels the days like `adjust_date`."""
+
+    def test_month_edges(self):
+        """Days around the dekad and month ends, also in leap Februaries."""
+        days = [date for year in (2019, 2020, 2100) for month in range(1, 13)
+                for date in pd.to_datetime(
+                    [f'{year}-{month:02d}-{day:02d}'
+                     for day in (1, 2, 10, 11, 12, 20, 21, 22, 28, 29, 30, 31)],
+                    errors='coerce')
+                if date is not pd.NaT]
+        # The time of day is kept
+        times = pd.DatetimeIndex(days + [day + pd.Timedelta(hours=12) for day in days])
+
+        labels = DekadalDatasetBuilder.dekad_labels(times.values)
+
+        for time, label in zip(times, labels):
+            with self.subTest(time=time):
+                self.assertEqual(
+                    pd.Timestamp(label), DekadalDatasetBuilder.adjust_date(time))
+
+    def test_leap_february(self):
+        times = pd.date_range('2020-02-20', '2020-03-02').values
+        labels = DekadalDatasetBuilder.dekad_labels(times)
+
+        self.assertEqual(list(pd.DatetimeIndex(labels).strftime('%m-%d')),
+                         ['02-21', '02-21'] + ['03-01'] * 9 + ['03-11'])
+
+
+class TestReduceDekads(unittest.TestCase):
+    """The segmented reductions match the groupby over the relabelled days."""
+
+    def test_groupby(self):
+        rng = np.random.default_rng(0)
+        times = pd.date_range('2019-12-02', '2020-03-31')
+        values = (rng.random((len(times), 4, 5)) * 10 + 270).astype('float32')
+        values[rng.random(values.shape) < 0.1] = np.nan
+
+        labels = DekadalDatasetBuilder.dekad_labels(times.values)
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+
+        # The dataset of the days relabelled with adjust_date, like the builder before
+        adjusted = times.map(DekadalDatasetBuilder.adjust_date)
+        days = xr.DataArray(values, dims=('time', 'lat', 'lon'), coords={'time': adjusted})
+
+        for variable, reduction in DEKADAL_VARIABLES.items():
+            with self.subTest(variable=variable):
+                expected = getattr(days.groupby('time'), reduction)()
+                if reduction == 'sum':
+                    expected = expected.astype('float32')
+
+                dekads = DekadalDatasetBuilder._reduce_dekads(values, variable, starts)
+
+                np.testing.assert_array_equal(labels[starts], expected['time'].values)
+                self.assertEqual(dekads.dtype, np.float32)
+                # Sums accumulate in float64 instead of float32
+                np.testing.assert_allclose(dekads, expected.values, rtol=1e-6)
+
+
+class TestDekadalDatasetBuilder(unittest.TestCase):
+    """Tests for `DekadalDatasetBuilder` on a small daily archive."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.area_path, self.zones = write_daily_archive(self.root)
+        self.area_name = os.path.basename(self.area_path)
+
+        # The builders write their outputs next to the area folder
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def test_engines_match(self):
+        """The zone index and the full-grid masks give the same dekadal outputs."""
+        outputs = {}
+        for engine in ('zone_index', 'mask'):
+            DekadalDatasetBuilder(self.area_name, self.zones, engine=engine
+                                  ).build_datasets(max_workers=1)
+
+            outputs[engine] = {
+                os.path.basename(path): pd.read_csv(path) for path in
+                glob.glob(f'{self.area_name}_Aggregated_dekadal_csv/*.csv')}
+
+        self.assertEqual(len(outputs['zone_index']), 2)
+        for name, output in outputs['zone_index'].items():
+            with self.subTest(output=name):
+                expected = outputs['mask'][name]
+                self.assertEqual(list(output['date']), list(expected['date']))
+                np.testing.assert_allclose(
+                    output.iloc[:, -1], expected.iloc[:, -1], rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""Tests for the resumable AgERA5 download queue."""
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from earthstat.xES.download_AgERA5py import AgERA5Downloader
+from earthstat.xES.download_queue import (
+    DownloadQueue, DownloadTask, InvalidZipError, is_valid_zip, request_size,
+    retryDownload)
+
+
+class FakeClient():
+    """Stands in for the CDS, writing a zip file with one member per requested month."""
+
+    url = 'fake://cds'
+
+    def __init__(self, fail_first=0, error=None):
+        self.requests = []
+        self.fail_first = fail_first
+        self.error = error
+
+    def retrieve(self, name, request, target):
+        self.requests.append(request)
+
+        if self.error is not None:
+            raise self.error
+
+        # The first requests are truncated transfers
+        if len(self.requests) <= self.fail_first:
+            with open(target, 'wb') as f:
+                f.write(b'PK truncated')
+            return
+
+        with zipfile.ZipFile(target, 'w') as zip_ref:
+            for month in request['month']:
+                zip_ref.writestr(f"{request['year'][0]}{month}.nc", b'data')
+
+
+class FlakyDownload():
+    """Raises an error on the first calls, then downloads nothing."""
+
+    def __init__(self, error, failures):
+        self.error = error
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self, task):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+
+
+class TestDownloadQueue(unittest.TestCase):
+    """Tests for `DownloadQueue` and the request helpers."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.root, 'area_2019.zip')
+
+        with zipfile.ZipFile(self.zip_path, 'w') as zip_ref:
+            zip_ref.writestr('201901.nc', b'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_queue_is_saved(self):
+        queue_path = os.path.join(self.root, '.download_queue.json')
+        queue = DownloadQueue(queue_path)
+        self.assertFalse(queue.is_complete(os.path.join(self.root, 'missing.zip')))
+
+        queue.fail(self.zip_path, 'timeout')
+        queue.complete(self.zip_path)
+
+        queue = DownloadQueue(queue_path)
+        self.assertIn(self.zip_path, queue.completed)
+        self.assertEqual(queue.failed, {})
+        self.assertTrue(queue.is_complete(self.zip_path))
+
+    def test_changed_file_is_verified_again(self):
+        """A recorded file that changed since is only complete if it is a valid zip."""
+        queue = DownloadQueue(os.path.join(self.root, '.download_queue.json'))
+        queue.complete(self.zip_path)
+
+        with open(self.zip_path, 'r+b') as f:
+            f.truncate(10)
+
+        self.assertFalse(is_valid_zip(self.zip_path))
+        self.assertFalse(queue.is_complete(self.zip_path))
+
+    def test_request_size(self):
+        self.assertEqual(request_size([50, 10, 48, 13], days=10), 20 * 30 * 10)
+
+    def test_transient_errors_are_retried(self):
+        task = DownloadTask('area', 'Precipitation_Flux', 2019)
+
+        for error in [ConnectionError("reset"), InvalidZipError("truncated")]:
+            with self.subTest(error=error):
+                download = FlakyDownload(error, 2)
+                self.assertIsNone(retryDownload(download, task, retries=2, backoff=0))
+                self.assertEqual(download.calls, 3)
+
+    def test_other_errors_fail_at_once(self):
+        task = DownloadTask('area', 'Precipitation_Flux', 2019)
+        download = FlakyDownload(KeyError('variable'), 1)
+
+        self.assertIn('KeyError', retryDownload(download, task, retries=2, backoff=60))
+        self.assertEqual(download.calls, 1)
+
+
+class TestAgERA5Downloader(unittest.TestCase):
+    """Tests for `AgERA5Downloader` with a fake CDS client."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def downloader(self, client, **options):
+        options.setdefault('backoff', 0)
+        return AgERA5Downloader(
+            'area', ['Precipitation_Flux', 'Mean_Temperature'], [50, 10, 48, 13],
+            2019, 2020, client=client, **options)
+
+    def test_download_and_resume(self):
+        """Every file is downloaded once, a second run sends no request."""
+        client = FakeClient()
+        self.downloader(client).download_AgERA5(2)
+
+        self.assertEqual(len(client.requests), 4)
+        for parameter in ['Precipitation_Flux', 'Mean_Temperature']:
+            self.assertEqual(sorted(os.listdir(os.path.join('area', parameter))),
+                             [f'area_2019_{parameter}.zip', f'area_2020_{parameter}.zip'])
+
+        with open(os.path.join('area', '.download_queue.json')) as f:
+            self.assertEqual(len(json.load(f)['completed']), 4)
+
+        client = FakeClient()
+        self.downloader(client).download_AgERA5(2)
+        self.assertEqual(client.requests, [])
+
+    def test_monthly_chunks(self):
+        client = FakeClient()
+        self.downloader(client, chunk='month').download_AgERA5(4)
+
+        self.assertEqual(len(client.requests), 2 * 2 * 12)
+        self.assertTrue(all(len(request['month']) == 1 for request in client.requests))
+
+    def test_invalid_zip_is_retried(self):
+        client = FakeClient(fail_first=2)
+        self.downloader(client, retries=2).download_AgERA5(1)
+
+        self.assertEqual(len(client.requests), 4 + 2)
+        self.assertEqual(len(os.listdir(os.path.join('area', 'Precipitation_Flux'))), 2)
+
+    def test_rejected_request_is_not_retried(self):
+        """An error other than I/O, HTTP or an invalid zip fails at the first attempt."""
+        client = FakeClient(error=Exception("the request is not valid"))
+
+        with self.assertRaises(RuntimeError):
+            self.downloader(client, retries=3, backoff=60).download_AgERA5(1)
+
+        self.assertEqual(len(client.requests), 4)
+
+        with open(os.path.join('area', '.download_queue.json')) as f:
+            self.assertEqual(len(json.load(f)['failed']), 4)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            AgERA5Downloader('area', ['Precip'], [50, 10, 48, 13], 2019, 2019,
+                             client=FakeClient())
+
+        with self.assertRaises(ValueError):
+            self.downloader(FakeClient(), chunk='week')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""Tests for the process, thread and dask executors of parallel aggregation."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from earthstat.analysis_aggregation.aggregate_process import conAggregate
+from earthstat.analysis_aggregation import executors
+from earthstat.analysis_aggregation.executors import (
+    dask_available, getExecutor, workerState)
+from earthstat.analysis_aggregation.output_sink import readOutput
+from earthstat.analysis_aggregation.parallel_clip_aggregate import parallelAggregate
+from tests.synthetic import DATES, sort_rows, write_archive
+
+
+if dask_available:
+    from dask.distributed import Client, LocalCluster
+
+
+def set_offset(offset):
+    workerState()["offset"] = offset
+
+
+def add_offset(task):
+    return task + workerState()["offset"]
+
+
+def worker_states():
+    return len(executors._worker_states)
+
+
+class TestExecutors(unittest.TestCase):
+    """Tests for the executors of `getExecutor`."""
+
+    def test_imap(self):
+        """Results come back with the index of their task, in order unless unordered."""
+        for executor in ['thread', 'process']:
+            for ordered in (True, False):
+                with self.subTest(executor=executor, ordered=ordered):
+                    with getExecutor(executor, 2) as pool:
+                        results = list(pool.imap(abs, list(range(-20, 0)),
+                                                 ordered=ordered, max_in_flight=4))
+
+                    if ordered:
+                        self.assertEqual(results, list(enumerate(range(20, 0, -1))))
+                    self.assertEqual(sorted(results), list(enumerate(range(20, 0, -1))))
+
+    def test_close_during_imap(self):
+        """Closing an executor while the caller stops iterating midway does not hang."""
+        for executor in ['thread', 'process']:
+            with self.subTest(executor=executor):
+                with self.assertRaises(RuntimeError):
+                    with getExecutor(executor, 2) as pool:
+                        # Held like in parallelAggregate, so it is still open at close
+                        results = pool.imap(abs, list(range(200)), max_in_flight=2,
+                                            chunksize=1)
+
+                        for index, _ in results:
+                            if index == 3:
+                                raise RuntimeError("failed raster")
+
+    def test_interleaved_states(self):
+        """Executors running at once keep their own worker state, dropped at close."""
+        for executor in ['thread', 'process']:
+            with self.subTest(executor=executor):
+                states = worker_states()
+                first = getExecutor(executor, 2, set_offset, (100,))
+                second = getExecutor(executor, 2, set_offset, (200,))
+
+                with first, second:
+                    results = zip(first.imap(add_offset, list(range(20))),
+                                  second.imap(add_offset, list(range(20))))
+                    for (_, first_result), (_, second_result) in results:
+                        self.assertEqual(second_result - first_result, 100)
+
+                self.assertEqual(worker_states(), states)
+
+    @unittest.skipUnless(dask_available, "dask.distributed is not installed")
+    def test_shared_dask_cluster(self):
+        """Executors sharing a cluster keep their own worker state, dropped at close."""
+        with LocalCluster(n_workers=1, threads_per_worker=2, processes=True,
+                          dashboard_address=None) as cluster, Client(cluster) as client:
+            first = getExecutor('dask', 1, set_offset, (100,), client=client)
+            second = getExecutor('dask', 1, set_offset, (200,), client=client)
+
+            with first, second:
+                results = zip(first.imap(add_offset, list(range(20))),
+                              second.imap(add_offset, list(range(20))))
+                for (_, first_result), (_, second_result) in results:
+                    self.assertEqual(second_result - first_result, 100)
+
+                self.assertEqual(list(client.run(worker_states).values()), [2])
+
+            self.assertEqual(list(client.run(worker_states).values()), [0])
+
+    def test_invalid_executor(self):
+        with self.assertRaises(ValueError):
+            getExecutor('cluster')
+
+
+class TestParallelAggregate(unittest.TestCase):
+    """Tests for `parallelAggregate` on every executor."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.predictor_dir, cls.shapefile_path = write_archive(cls.root)
+
+        expected_path = os.path.join(cls.root, 'expected.csv')
+        conAggregate(cls.predictor_dir, cls.shapefile_path, expected_path,
+                     invalid_values=[251], predictor_name='fpar')
+        cls.expected = sort_rows(readOutput(expected_path))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def aggregate(self, executor, output_path, **options):
+        parallelAggregate(self.predictor_dir, self.shapefile_path, output_path,
+                          invalid_values=[251], predictor_name='fpar', max_workers=2,
+                          executor=executor, **options)
+
+        output = sort_rows(readOutput(output_path))
+        self.assertEqual(list(output['NAME']), list(self.expected['NAME']))
+        self.assertEqual(list(output['date']), list(self.expected['date']))
+        np.testing.assert_allclose(output['fpar'], self.expected['fpar'])
+
+    def test_local_executors(self):
+        """The process and thread executors write the rows of the sequential run."""
+        for executor in ['process', 'thread']:
+            for streaming in (False, True):
+                with self.subTest(executor=executor, streaming=streaming):
+                    self.aggregate(
+                        executor, os.path.join(self.root, f'{executor}_{streaming}.csv'),
+                        streaming=streaming)
+
+    @unittest.skipUnless(dask_available, "dask.distributed is not installed")
+    def test_dask_local_cluster(self):
+        """Without a client, the dask executor runs on a local cluster."""
+        self.aggregate('dask', os.path.join(self.root, 'dask.csv'))
+
+    def test_failed_raster_does_not_hang(self):
+        """A failed raster raises even while the pool waits for free task slots."""
+        predictor_dir = os.path.join(self.root, 'failing')
+        shutil.copytree(self.predictor_dir, predictor_dir)
+        # Its header still opens, whatever raster the zone index is built from
+        os.truncate(os.path.join(predictor_dir, f'fpar_{DATES[2]}.tif'), 1200)
+
+        for executor in ['process', 'thread']:
+            with self.subTest(executor=executor):
+                with self.assertRaises(RuntimeError):
+                    parallelAggregate(
+                        predictor_dir, self.shapefile_path,
+                        os.path.join(self.root, 'failing.csv'), predictor_name='fpar',
+                        max_workers=2, executor=executor, max_in_flight=1, chunksize=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
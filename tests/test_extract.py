@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""Tests for the extraction of the AgERA5 zip files."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from earthstat.xES.xES_utiles import extract_zip
+
+
+MEMBERS = {
+    'a.nc': b'a' * 1000,
+    'b.nc': b'b' * 1000,
+}
+
+
+class TestExtractZip(unittest.TestCase):
+    """Tests for `extract_zip`."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.root, 'year.zip')
+        self.extract_path = os.path.join(self.root, 'Extracted')
+
+        # Stored members, so their bytes can be corrupted in place
+        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_STORED) as zip_ref:
+            for name, data in MEMBERS.items():
+                zip_ref.writestr(name, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_corrupt_member(self):
+        """A member failing its CRC check raises and leaves no file behind."""
+        with open(self.zip_path, 'rb') as f:
+            data = bytearray(f.read())
+        data[data.index(MEMBERS['b.nc']) + 500] ^= 0xFF
+
+        corrupt_path = os.path.join(self.root, 'corrupt.zip')
+        with open(corrupt_path, 'wb') as f:
+            f.write(data)
+
+        with self.assertRaises(zipfile.BadZipFile):
+            extract_zip(corrupt_path, self.extract_path)
+
+        self.assertEqual(os.listdir(self.extract_path), ['a.nc'])
+
+        # The intact zip only extracts the missing member
+        self.assertEqual(extract_zip(self.zip_path, self.extract_path), (1, 1))
+        for name, member_data in MEMBERS.items():
+            with open(os.path.join(self.extract_path, name), 'rb') as f:
+                self.assertEqual(f.read(), member_data)
+
+    def test_check_crc(self):
+        """A damaged member of the same size is extracted again, unless check_crc."""
+        extract_zip(self.zip_path, self.extract_path)
+        with open(os.path.join(self.extract_path, 'a.nc'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+        self.assertEqual(
+            extract_zip(self.zip_path, self.extract_path, check_crc=False), (0, 2))
+        self.assertEqual(extract_zip(self.zip_path, self.extract_path), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
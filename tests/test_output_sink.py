@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""Tests for the CSV, Feather and Parquet output sinks."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from earthstat.analysis_aggregation.aggregate_process import conAggregate
+from earthstat.analysis_aggregation.output_sink import (
+    arrow_available, getOutputSink, outputFormat, outputPath, readOutput)
+from earthstat.analysis_aggregation.parallel_clip_aggregate import parallelAggregate
+from tests.synthetic import DATES, sort_rows, write_archive
+
+
+class TestOutputSinks(unittest.TestCase):
+    """Tests for the sinks of `getOutputSink`."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.frame = pd.DataFrame({'date': ['2019-12-31', '2020-01-01'], 'fpar': [1.0, 2.0]})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    @unittest.skipUnless(arrow_available, "pyarrow is not installed")
+    def test_round_trip(self):
+        """Blocks written one after another are read back in order, in every format."""
+        for output_format in ['csv', 'feather', 'parquet']:
+            with self.subTest(output_format=output_format):
+                path = outputPath(os.path.join(self.root, 'output'), output_format)
+                with getOutputSink(path, output_format, variable='fpar') as sink:
+                    sink.write(self.frame)
+                    sink.write(self.frame.iloc[:0])
+                    sink.write(self.frame.assign(fpar=[3.0, 4.0]))
+
+                self.assertEqual(sink.rows_written, 4)
+                self.assertEqual(outputFormat(path), output_format)
+
+                output = readOutput(path).sort_values('fpar').reset_index(drop=True)
+                self.assertEqual(list(output.columns), ['date', 'fpar'])
+                np.testing.assert_allclose(output['fpar'], [1.0, 2.0, 3.0, 4.0])
+
+    def test_csv_append(self):
+        """Appended rows only reach the file when the sink is closed without error."""
+        path = os.path.join(self.root, 'output.csv')
+        with getOutputSink(path) as sink:
+            sink.write(self.frame)
+
+        with self.assertRaises(KeyError):
+            with getOutputSink(path, append=True) as sink:
+                sink.write(self.frame)
+                raise KeyError('date')
+        self.assertEqual(len(readOutput(path)), 2)
+
+        with getOutputSink(path, append=True) as sink:
+            sink.write(self.frame)
+        self.assertEqual(len(readOutput(path)), 4)
+        self.assertFalse(os.path.exists(path + '.partial'))
+
+    @unittest.skipUnless(arrow_available, "pyarrow is not installed")
+    def test_failed_write_keeps_output(self):
+        """A sink closed by an error keeps the previous output of every format."""
+        for output_format in ['csv', 'feather', 'parquet']:
+            with self.subTest(output_format=output_format):
+                path = os.path.join(self.root, f'failed.{output_format}')
+                with getOutputSink(path, output_format, variable='fpar') as sink:
+                    sink.write(self.frame)
+
+                with self.assertRaises(RuntimeError):
+                    with getOutputSink(path, output_format, variable='fpar') as sink:
+                        sink.write(self.frame.iloc[:1])
+                        raise RuntimeError('failed run')
+
+                self.assertEqual(len(readOutput(path, output_format)), 2)
+                self.assertFalse(os.path.exists(path + '.partial'))
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            getOutputSink(os.path.join(self.root, 'output.xlsx'), 'xlsx')
+
+        with self.assertRaises(ValueError):
+            getOutputSink(os.path.join(self.root, 'output.feather'), 'feather', append=True)
+
+
+class TestAggregationOutput(unittest.TestCase):
+    """Tests for the outputs written by `conAggregate` and `parallelAggregate`."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.predictor_dir, self.shapefile_path = write_archive(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    @unittest.skipUnless(arrow_available, "pyarrow is not installed")
+    def test_formats_match(self):
+        """Every output format holds the rows of the CSV output."""
+        outputs = {}
+        for output_format in ['csv', 'feather', 'parquet']:
+            path = outputPath(os.path.join(self.root, 'output'), output_format)
+            conAggregate(self.predictor_dir, self.shapefile_path, path,
+                         predictor_name='fpar', output_format=output_format,
+                         write_every=3)
+            # CSV reads the 'YYYYMMDD' dates back as integers
+            outputs[output_format] = sort_rows(readOutput(path).astype({'date': str}))
+
+        for output_format in ['feather', 'parquet']:
+            with self.subTest(output_format=output_format):
+                pd.testing.assert_frame_equal(
+                    outputs[output_format], outputs['csv'], check_dtype=False)
+
+    @unittest.skipUnless(arrow_available, "pyarrow is not installed")
+    def test_parquet_rewrite(self):
+        """Rewriting a Parquet output keeps no partition of the previous output."""
+        output_path = os.path.join(self.root, 'output.parquet')
+        conAggregate(self.predictor_dir, self.shapefile_path, output_path,
+                     predictor_name='fpar', output_format='parquet')
+        self.assertIn('year=2019', os.listdir(output_path))
+
+        # The second run only has the rasters of 2020
+        predictor_dir = os.path.join(self.root, 'pred_2020')
+        shutil.copytree(self.predictor_dir, predictor_dir,
+                        ignore=shutil.ignore_patterns('*2019*'))
+
+        conAggregate(predictor_dir, self.shapefile_path, output_path,
+                     predictor_name='fpar', output_format='parquet')
+
+        self.assertEqual(os.listdir(output_path), ['year=2020'])
+        self.assertEqual(len(readOutput(output_path)), 3 * (len(DATES) - 1))
+        self.assertFalse(os.path.exists(output_path + '.partial'))
+
+    def test_failed_run_keeps_output(self):
+        """A run failing on a raster raises and leaves the previous output untouched."""
+        output_path = os.path.join(self.root, 'output.csv')
+        conAggregate(self.predictor_dir, self.shapefile_path, output_path,
+                     predictor_name='fpar')
+
+        # Its header still opens, whatever raster the zone index is built from
+        os.truncate(os.path.join(self.predictor_dir, f'fpar_{DATES[2]}.tif'), 1200)
+
+        runs = [
+            ('conAggregate', conAggregate, {}),
+            ('parallelAggregate', parallelAggregate,
+             {'executor': 'thread', 'max_workers': 2}),
+        ]
+
+        for name, aggregate, options in runs:
+            with self.subTest(run=name):
+                with self.assertRaises(Exception):
+                    aggregate(self.predictor_dir, self.shapefile_path, output_path,
+                              predictor_name='fpar', write_every=1, **options)
+
+                self.assertEqual(len(readOutput(output_path)), 3 * len(DATES))
+                self.assertFalse(os.path.exists(output_path + '.partial'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Tests for the exact and sketched zonal percentiles."""
+
+
+import unittest
+import warnings
+
+import numpy as np
+from affine import Affine
+from shapely.geometry import Polygon, box
+
+from earthstat.analysis_aggregation.zone_index import (
+    SKETCH_PIXELS_PER_BIN, ZoneIndex, zonal_percentiles, zonal_statistics)
+
+
+PERCENTILES = [0, 2.5, 10, 50, 90, 99.9, 100]
+
+
+class TestZonalPercentiles(unittest.TestCase):
+    """Tests for `zonal_percentiles`."""
+
+    def setUp(self):
+        # Zones of different sizes on a 40 x 50 grid, the last two without valid pixels
+        self.zone_index = ZoneIndex.from_geometries(
+            [box(0, 0, 30, 40), box(30, 20, 50, 40),
+             Polygon([(5, 5), (45, 2), (25, 18)]),
+             box(40, 0, 50, 10), box(100, 100, 101, 101)],
+            Affine(1, 0, 0, 0, -1, 40), (40, 50))
+
+        rng = np.random.default_rng(0)
+        grids = rng.gamma(2.0, 3.0, (3, 40, 50))
+        grids[rng.random(grids.shape) < 0.2] = np.nan
+        grids[:, 30:, 40:] = np.nan
+        self.values = self.zone_index.gather_grid(grids)
+
+    def zone_values(self, zone_id):
+        indptr = self.zone_index.indptr
+        return self.values[..., indptr[zone_id]:indptr[zone_id + 1]]
+
+    def expected(self):
+        """`numpy.nanpercentile` of every zone, of shape (dates, zones, percentiles)."""
+        expected = np.full((3, self.zone_index.n_zones, len(PERCENTILES)), np.nan)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for zone_id in range(self.zone_index.n_zones):
+                if self.zone_index.counts[zone_id]:
+                    expected[:, zone_id, :] = np.nanpercentile(
+                        self.zone_values(zone_id), PERCENTILES, axis=-1).T
+
+        return expected
+
+    def test_exact(self):
+        """The exact percentiles equal numpy.nanpercentile, NaN without valid pixels."""
+        out = zonal_percentiles(self.values, self.zone_index, PERCENTILES)
+
+        np.testing.assert_array_equal(out, self.expected())
+        self.assertTrue(np.isnan(out[:, 3:]).all())
+
+    def test_sketch_error_bound(self):
+        """The sketch is within the zone value range divided by the number of bins."""
+        expected = self.expected()
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            value_range = np.stack(
+                [np.nanmax(self.zone_values(zone_id), axis=-1)
+                 - np.nanmin(self.zone_values(zone_id), axis=-1)
+                 if self.zone_index.counts[zone_id] else np.full(3, np.nan)
+                 for zone_id in range(self.zone_index.n_zones)], axis=-1)
+
+        for bins in (10, 100, 1000):
+            with self.subTest(bins=bins):
+                out = zonal_percentiles(self.values, self.zone_index, PERCENTILES,
+                                        method='sketch', bins=bins)
+
+                self.assertTrue(np.array_equal(np.isnan(out), np.isnan(expected)))
+                error = np.abs(out - expected)[:, :3]
+                self.assertTrue(
+                    (error <= value_range[:, :3, np.newaxis] / bins + 1e-9).all())
+
+    def test_auto(self):
+        """'auto' only sketches the zones above SKETCH_PIXELS_PER_BIN pixels per bin."""
+        bins = 4
+        sketched = self.zone_index.counts > SKETCH_PIXELS_PER_BIN * bins
+        self.assertTrue(sketched.any() and not sketched.all())
+
+        out = zonal_percentiles(self.values, self.zone_index, PERCENTILES,
+                                method='auto', bins=bins)
+        sketch = zonal_percentiles(self.values, self.zone_index, PERCENTILES,
+                                   method='sketch', bins=bins)
+        expected = self.expected()
+
+        np.testing.assert_array_equal(out[:, sketched], sketch[:, sketched])
+        np.testing.assert_array_equal(out[:, ~sketched], expected[:, ~sketched])
+
+    def test_statistics(self):
+        """The median and percentile statistics share the exact percentiles."""
+        out = zonal_statistics(self.values, self.zone_index, ['median', 'p90', 'mean'])
+        expected = self.expected()
+
+        np.testing.assert_array_equal(out[..., 0], expected[..., PERCENTILES.index(50)])
+        np.testing.assert_array_equal(out[..., 1], expected[..., PERCENTILES.index(90)])
+
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError):
+            zonal_percentiles(self.values, self.zone_index, [50], method='tdigest')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""Tests for the memory-mapped raster cubes."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from earthstat.analysis_aggregation.aggregate_process import conAggregate
+from earthstat.analysis_aggregation.output_sink import readOutput
+from earthstat.analysis_aggregation.parallel_clip_aggregate import parallelAggregate
+from earthstat.analysis_aggregation.raster_cube import buildCube
+from tests.synthetic import DATES, sort_rows, write_archive, write_raster
+
+
+AGGREGATIONS = {
+    'conAggregate': conAggregate,
+    'thread': partial(parallelAggregate, max_workers=2, executor='thread'),
+    'process': partial(parallelAggregate, max_workers=2, executor='process'),
+    'batches': partial(parallelAggregate, max_workers=2, executor='thread',
+                       batch_size=3),
+}
+
+OPTIONS = {
+    'overall_mean': dict(stats=['mean', 'count', 'max', 'p90']),
+    'weighted_mean': dict(use_mask=True, calculation_mode='weighted_mean'),
+}
+
+
+class TestRasterCube(unittest.TestCase):
+    """A run reading a cube gives the output of a run reading the GeoTIFFs."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.predictor_dir, self.shapefile_path = write_archive(self.root)
+        self.mask_path = os.path.join(self.root, 'mask.tif')
+        self.cube_dir = os.path.join(self.root, 'cube')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def aggregate(self, aggregation, name, **options):
+        """Runs an aggregation of the predictor rasters and returns its sorted rows."""
+        output_path = os.path.join(self.root, f'{name}.csv')
+        AGGREGATIONS[aggregation](
+            self.predictor_dir, self.shapefile_path, output_path,
+            mask_path=self.mask_path, invalid_values=[251], predictor_name='fpar',
+            write_every=2, **options)
+
+        return sort_rows(readOutput(output_path))
+
+    def test_plain_run(self):
+        cube = buildCube(self.predictor_dir, self.cube_dir)
+        self.assertEqual(cube.data.shape, (len(DATES), 20, 30))
+
+        for aggregation in AGGREGATIONS:
+            for mode, options in OPTIONS.items():
+                with self.subTest(aggregation=aggregation, mode=mode):
+                    expected = self.aggregate(aggregation, 'expected', **options)
+                    output = self.aggregate(
+                        aggregation, 'cube', cube_dir=self.cube_dir, **options)
+
+                    pd.testing.assert_frame_equal(output, expected)
+
+    def test_default_directory(self):
+        """The cube inside the raster directory is not taken for a raster."""
+        cube = buildCube(self.predictor_dir)
+
+        self.assertEqual(cube.directory, os.path.join(self.predictor_dir, 'cube'))
+        pd.testing.assert_frame_equal(
+            self.aggregate('conAggregate', 'cube', cube_dir=cube.directory),
+            self.aggregate('conAggregate', 'expected'))
+
+    def test_rebuilt_when_changed(self):
+        """A stale cube is refused, and only rebuilt once a raster changed."""
+        buildCube(self.predictor_dir, self.cube_dir)
+        data_path = os.path.join(self.cube_dir, 'data.npy')
+        built = os.stat(data_path).st_mtime_ns
+
+        # An up to date cube is reused as is
+        buildCube(self.predictor_dir, self.cube_dir)
+        self.assertEqual(os.stat(data_path).st_mtime_ns, built)
+
+        changed_path = os.path.join(self.predictor_dir, f'fpar_{DATES[1]}.tif')
+        write_raster(changed_path, np.full((20, 30), 100.0, dtype='float32'))
+        write_raster(os.path.join(self.predictor_dir, 'fpar_20200104.tif'),
+                     np.full((20, 30), 7.0, dtype='float32'))
+
+        for aggregation in ('conAggregate', 'thread'):
+            with self.subTest(aggregation=aggregation):
+                with self.assertRaisesRegex(ValueError, 'buildCube'):
+                    self.aggregate(aggregation, 'cube', cube_dir=self.cube_dir)
+
+        cube = buildCube(self.predictor_dir, self.cube_dir)
+
+        self.assertNotEqual(os.stat(data_path).st_mtime_ns, built)
+        self.assertEqual(cube.dates[-1], '20200104')
+        np.testing.assert_array_equal(cube.data[1], 100)
+
+        for aggregation in ('conAggregate', 'thread', 'process'):
+            with self.subTest(aggregation=aggregation):
+                output = self.aggregate(aggregation, 'cube', cube_dir=self.cube_dir)
+
+                expected = self.aggregate(aggregation, 'expected')
+                pd.testing.assert_frame_equal(output, expected)
+                self.assertTrue((output.loc[output['date'].astype(str) == DATES[1],
+                                            'fpar'] == 100).all())
+
+    def test_grid_mismatch(self):
+        write_raster(os.path.join(self.predictor_dir, 'fpar_20200104.tif'),
+                     np.zeros((10, 30), dtype='float32'))
+
+        with self.assertRaises(ValueError):
+            buildCube(self.predictor_dir, self.cube_dir)
+
+        self.assertFalse(os.path.exists(os.path.join(self.cube_dir, 'cube.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""Tests for the incremental aggregation runs and their run manifest."""
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from earthstat.analysis_aggregation.aggregate_process import conAggregate
+from earthstat.analysis_aggregation.output_sink import readOutput
+from earthstat.analysis_aggregation.parallel_clip_aggregate import parallelAggregate
+from earthstat.analysis_aggregation.run_manifest import manifestPath
+from tests.synthetic import DATES, sort_rows, write_archive, write_raster
+
+
+AGGREGATIONS = {
+    'conAggregate': conAggregate,
+    'parallelAggregate': partial(parallelAggregate, max_workers=2, executor='thread'),
+}
+
+
+class TestIncrementalRun(unittest.TestCase):
+    """Incremental runs give the output of a full run over the current rasters."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write_rasters()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_rasters(self):
+        """Writes the archive again, without its last raster."""
+        self.predictor_dir, self.shapefile_path = write_archive(self.root)
+        self.raster_paths = {date: os.path.join(self.predictor_dir, f'fpar_{date}.tif')
+                             for date in DATES}
+
+        # The last raster is only added after the first run
+        self.added_path = os.path.join(self.root, f'fpar_{DATES[-1]}.tif')
+        os.replace(self.raster_paths[DATES[-1]], self.added_path)
+
+    def aggregate(self, aggregation, output_path, **options):
+        """Runs an aggregation of the predictor rasters and returns its sorted rows."""
+        AGGREGATIONS[aggregation](
+            self.predictor_dir, self.shapefile_path, output_path, invalid_values=[251],
+            predictor_name='fpar', write_every=2, **options)
+
+        return sort_rows(readOutput(output_path))
+
+    def assert_full_run(self, aggregation, output, output_format='csv'):
+        """Checks rows against a run without manifest over the current rasters."""
+        expected_path = os.path.join(self.root, f'expected.{output_format}')
+        expected = self.aggregate(
+            aggregation, expected_path, output_format=output_format)
+
+        pd.testing.assert_frame_equal(output, expected)
+
+    def test_unchanged(self):
+        for aggregation in AGGREGATIONS:
+            with self.subTest(aggregation=aggregation):
+                output_path = os.path.join(self.root, f'{aggregation}.csv')
+                first = self.aggregate(aggregation, output_path, incremental=True)
+                modified = os.stat(output_path).st_mtime_ns
+
+                # Touched rasters are checked by content, not aggregated again
+                for path in self.raster_paths.values():
+                    if os.path.exists(path):
+                        os.utime(path)
+
+                second = self.aggregate(aggregation, output_path, incremental=True)
+
+                self.assertEqual(os.stat(output_path).st_mtime_ns, modified)
+                pd.testing.assert_frame_equal(second, first)
+
+    def test_changed_added_removed(self):
+        """Rows of changed rasters are replaced, added appended, removed dropped."""
+        for output_format in ('csv', 'feather'):
+            for aggregation in AGGREGATIONS:
+                with self.subTest(aggregation=aggregation, output_format=output_format):
+                    self.write_rasters()
+                    output_path = os.path.join(
+                        self.root, f'{aggregation}.{output_format}')
+                    self.aggregate(aggregation, output_path, incremental=True,
+                                   output_format=output_format)
+
+                    changed = np.full((20, 30), 100.0, dtype='float32')
+                    write_raster(self.raster_paths[DATES[1]], changed)
+                    shutil.copy(self.added_path, self.raster_paths[DATES[-1]])
+                    os.remove(self.raster_paths[DATES[0]])
+
+                    output = self.aggregate(aggregation, output_path, incremental=True,
+                                            output_format=output_format)
+
+                    self.assertEqual(sorted(set(output['date'].astype(str))), DATES[1:])
+                    self.assertTrue((output.loc[output['date'].astype(str) == DATES[1],
+                                                'fpar'] == 100).all())
+                    self.assert_full_run(aggregation, output, output_format)
+
+                    with open(manifestPath(output_path)) as f:
+                        files = json.load(f)['files']
+                    self.assertEqual(sorted(files),
+                                     [self.raster_paths[date] for date in DATES[1:]])
+
+    def test_removed_only(self):
+        """Removing a raster drops its rows even with nothing to aggregate."""
+        for aggregation in AGGREGATIONS:
+            with self.subTest(aggregation=aggregation):
+                output_path = os.path.join(self.root, f'{aggregation}.csv')
+                self.aggregate(aggregation, output_path, incremental=True)
+                removed_path = os.path.join(self.root, 'removed.tif')
+                os.replace(self.raster_paths[DATES[1]], removed_path)
+
+                output = self.aggregate(aggregation, output_path, incremental=True)
+
+                self.assertEqual(
+                    sorted(set(output['date'].astype(str))), [DATES[0], DATES[2]])
+                self.assert_full_run(aggregation, output)
+                os.replace(removed_path, self.raster_paths[DATES[1]])
+
+    def test_new_signature(self):
+        """A changed option aggregates every raster again into a new output."""
+        for aggregation in AGGREGATIONS:
+            with self.subTest(aggregation=aggregation):
+                output_path = os.path.join(self.root, f'{aggregation}.csv')
+                self.aggregate(aggregation, output_path, incremental=True)
+
+                output = self.aggregate(aggregation, output_path, incremental=True,
+                                        all_touched=True)
+
+                expected_path = os.path.join(self.root, 'expected.csv')
+                expected = self.aggregate(aggregation, expected_path, all_touched=True)
+                pd.testing.assert_frame_equal(output, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
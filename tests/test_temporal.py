@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""Tests for the temporal dataset builder and its period specs."""
+
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from affine import Affine
+from rasterio.features import geometry_mask
+from shapely.geometry import box
+
+from earthstat.analysis_aggregation.zone_index import ZoneIndex
+from earthstat.xES.TemporalDatasetBuilder import (
+    PeriodReduction, TemporalDatasetBuilder, finish_partial, merge_partials,
+    reduce_runs)
+from earthstat.xES.temporal_periods import (
+    REDUCERS, CropCalendar, period_labels, period_positions)
+from earthstat.xES.xES_utiles import dataset_grid
+from tests.synthetic import DAILY_VARIABLES, write_daily_archive
+
+
+# Reducer of the variables of the synthetic archive
+VARIABLE_REDUCERS = {
+    'Precipitation_Flux': 'sum',
+    'Temperature_Air_2m_Max_24h': 'max',
+}
+
+NUMPY_REDUCERS = {
+    'sum': np.nansum,
+    'mean': np.nanmean,
+    'min': np.nanmin,
+    'max': np.nanmax,
+}
+
+
+class TestPeriodReduction(unittest.TestCase):
+    """Tests for `PeriodReduction` and the partial arrays of its reducers."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.values = rng.random((40, 5)).astype('float32')
+        self.values[rng.random((40, 5)) < 0.1] = np.nan
+        # Every period keeps a valid day in every pixel
+        self.values[[3, 13, 27]] = 1.0
+        self.period_ids = np.array([-1] * 3 + [0] * 10 + [1] * 12 + [-1] * 2 + [2] * 13)
+
+    def test_blocks(self):
+        """Blocks of any size give the reduction of the whole periods."""
+        for reducer in REDUCERS:
+            expected = [
+                NUMPY_REDUCERS[reducer](self.values[self.period_ids == period], axis=0)
+                for period in range(3)]
+
+            for time_block in (40, 7, 1):
+                with self.subTest(reducer=reducer, time_block=time_block):
+                    reduction = PeriodReduction(self.period_ids, reducer)
+                    for start in range(0, len(self.values), time_block):
+                        reduction.update(self.values[start:start + time_block], start)
+                    reduction.close()
+
+                    finished = reduction.pop()
+                    self.assertEqual([period for period, _ in finished], [0, 1, 2])
+                    for (_, values), period_values in zip(finished, expected):
+                        np.testing.assert_allclose(values, period_values, rtol=1e-6)
+                    self.assertEqual(reduction.pop(), [])
+
+    def test_merge_partials(self):
+        """Two runs of days merged equal the reduction of the joined run."""
+        for reducer in REDUCERS:
+            with self.subTest(reducer=reducer):
+                first, second = (
+                    [array[0] for array in reduce_runs(values, [0], reducer)]
+                    for values in (self.values[:15], self.values[15:]))
+                merged = finish_partial(merge_partials(first, second, reducer), reducer)
+
+                np.testing.assert_allclose(
+                    merged, NUMPY_REDUCERS[reducer](self.values, axis=0), rtol=1e-6)
+
+
+class TestPeriodPositions(unittest.TestCase):
+    """Tests for `period_positions` and the crop-calendar windows."""
+
+    def test_partial_periods(self):
+        """The months missing some of their days are dropped unless partial_periods."""
+        times = pd.date_range('2020-01-30', '2020-03-02').values
+        months = partial(period_labels, period='M')
+
+        period_ids, labels = period_positions(times, months)
+        self.assertEqual(list(labels), [np.datetime64('2020-02-01', 'ns')])
+        self.assertEqual(list(period_ids), [-1] * 2 + [0] * 29 + [-1] * 2)
+
+        period_ids, labels = period_positions(times, months, partial_periods=True)
+        self.assertEqual(len(labels), 3)
+        self.assertEqual(list(period_ids), [0] * 2 + [1] * 29 + [2] * 2)
+
+    def test_window_across_new_year(self):
+        """A window ending before its start is labelled by its first day."""
+        times = pd.date_range('2019-12-20', '2020-01-25').values
+        labels = CropCalendar.window_labels(times, ('12-25', '01-20'))
+
+        inside = ((times >= np.datetime64('2019-12-25'))
+                  & (times <= np.datetime64('2020-01-20')))
+        self.assertTrue(np.isnat(labels[~inside]).all())
+        self.assertTrue((labels[inside] == np.datetime64('2019-12-25', 'ns')).all())
+
+        # The season is dropped once the data misses its first days
+        period_ids, labels = period_positions(
+            times[8:], partial(CropCalendar.window_labels, window=('12-25', '01-20')))
+        self.assertEqual(len(labels), 0)
+        self.assertTrue((period_ids == -1).all())
+
+    def test_calendar_groups(self):
+        window = ('12-25', '01-20')
+        groups = CropCalendar('season', [window, None, window]).groups()
+
+        self.assertEqual(list(groups), [window])
+        self.assertEqual(list(groups[window]), [0, 2])
+
+        with self.assertRaises(ValueError):
+            CropCalendar('season', [('02-29', '03-10')])
+
+
+class TestZoneSubset(unittest.TestCase):
+    """Tests for the zone subsets of the crop-calendar windows."""
+
+    def test_subset(self):
+        """A subset gathers the pixels of its zones, in the order of its zone ids."""
+        zone_index = ZoneIndex.from_geometries(
+            [box(0, 2, 2, 4), box(1, 0, 4, 2), box(2, 2, 4, 4)],
+            Affine(1, 0, 0, 0, -1, 4), (4, 4))
+        subset = zone_index.subset([2, 0])
+
+        self.assertEqual(list(subset.counts), [4, 4])
+
+        grid = np.arange(16, dtype='float64').reshape(4, 4)
+        entries = zone_index.entries([2, 0])
+        np.testing.assert_array_equal(
+            subset.gather_grid(grid), zone_index.gather_grid(grid)[entries])
+        self.assertEqual(sorted(subset.gather_grid(grid)[:4]), [2, 3, 6, 7])
+
+
+class TestTemporalDatasetBuilder(unittest.TestCase):
+    """The outputs of `TemporalDatasetBuilder` match a plain xarray reduction."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.area_path, cls.zones = write_daily_archive(cls.root)
+        cls.area_name = os.path.basename(cls.area_path)
+
+        cls.daily = {}
+        for folder, variable in DAILY_VARIABLES.items():
+            paths = sorted(glob.glob(
+                os.path.join(cls.area_path, folder, 'Extracted', '*', '*.nc')))
+            cls.daily[variable] = xr.concat(
+                [xr.load_dataset(path)[variable] for path in paths], dim='time')
+
+        # Zone C has vertices on pixel centers, so it is rasterized on the data grid
+        transform, out_shape = dataset_grid(
+            cls.daily['Precipitation_Flux'].to_dataset())
+        cls.masks = [geometry_mask([geometry], out_shape, transform, invert=True)
+                     for geometry in cls.zones.geometry]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        # The builders write their outputs next to the area folder
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        for folder in glob.glob(f'{self.area_name}_Aggregated_*'):
+            shutil.rmtree(folder)
+        os.chdir(self.cwd)
+
+    def outputs(self, name):
+        return glob.glob(f'{self.area_name}_Aggregated_{name}_csv/*.csv')
+
+    def read_output(self, name, variable):
+        output = pd.read_csv(f'{self.area_name}_Aggregated_{name}_csv/'
+                             f'AgERA5_{self.area_name}_{variable}_{name}.csv')
+        output['date'] = pd.to_datetime(output['date'])
+
+        return output.sort_values(['NAME', 'date']).reset_index(drop=True)
+
+    def zone_means(self, periods, zone_ids=None):
+        """Mean of the reduced pixels of the zones, one row per zone and period."""
+        rows = []
+        for zone_id in range(len(self.zones)) if zone_ids is None else zone_ids:
+            values = np.nanmean(periods.values[:, self.masks[zone_id]], axis=1)
+            for date, value in zip(periods['time'].values, values):
+                rows.append(
+                    {'NAME': self.zones['NAME'][zone_id], 'date': date, 'value': value})
+
+        return pd.DataFrame(rows)
+
+    def resampled(self, variable, frequency, period_days, offset):
+        """Resamples a variable, keeping the complete periods, labelled by start."""
+        daily = self.daily[variable]
+        periods = getattr(daily.resample(time=frequency), VARIABLE_REDUCERS[variable])()
+        days = daily['time'].resample(time=frequency).count()
+
+        complete = (days == period_days(periods['time'])).values
+        periods = periods.isel(time=complete)
+
+        return periods.assign_coords(time=periods['time'] - offset)
+
+    def assertOutput(self, output, expected):
+        expected = expected.sort_values(['NAME', 'date']).reset_index(drop=True)
+
+        self.assertEqual(list(output['NAME']), list(expected['NAME']))
+        self.assertEqual(list(output['date']), list(expected['date']))
+        np.testing.assert_allclose(output.iloc[:, -1], expected['value'], rtol=1e-5)
+
+    def test_resampled_periods(self):
+        """Weeks and months match xarray resample, whatever blocks of days are read."""
+        # Blocks of a week start on Fridays, so every week straddles two blocks
+        for time_block in (None, 7):
+            with self.subTest(time_block=time_block):
+                builder = TemporalDatasetBuilder(
+                    self.area_name, self.zones, periods=['W', 'M'],
+                    time_block=time_block)
+                builder.build_datasets(max_workers=1)
+
+                for variable in VARIABLE_REDUCERS:
+                    # pandas weeks run Monday to Sunday, resample labels them by Sunday
+                    weeks = self.resampled(
+                        variable, 'W-SUN', lambda times: 7, np.timedelta64(6, 'D'))
+                    months = self.resampled(
+                        variable, 'MS', lambda times: times.dt.days_in_month,
+                        np.timedelta64(0, 'D'))
+
+                    for name, periods in [('W', weeks), ('M', months)]:
+                        self.assertOutput(
+                            self.read_output(name, variable), self.zone_means(periods))
+
+    def test_crop_calendar(self):
+        """Every zone is reduced over its own window, across the new year and blocks."""
+        windows = [('12-25', '01-20'), ('01-05', '02-10'), ('12-25', '01-20')]
+        seasons = {('12-25', '01-20'): ('2019-12-25', '2020-01-20'),
+                   ('01-05', '02-10'): ('2020-01-05', '2020-02-10')}
+
+        TemporalDatasetBuilder(self.area_name, self.zones,
+                               periods=CropCalendar('season', windows),
+                               time_block=7).build_datasets(max_workers=1)
+
+        for variable, reducer in VARIABLE_REDUCERS.items():
+            expected = []
+            for zone_id, window in enumerate(windows):
+                start, end = seasons[window]
+                days = self.daily[variable].sel(time=slice(start, end))
+                season = getattr(days, reducer)('time').expand_dims(
+                    time=[np.datetime64(start, 'ns')])
+                expected.append(self.zone_means(season, [zone_id]))
+
+            self.assertOutput(self.read_output('season', variable), pd.concat(expected))
+
+    def test_calendar_without_window(self):
+        """A crop calendar without any window writes no output."""
+        calendar = CropCalendar('fallow', [None] * len(self.zones))
+        TemporalDatasetBuilder(self.area_name, self.zones, periods=[calendar, 'M']
+                               ).build_datasets(max_workers=1)
+
+        self.assertEqual(self.outputs('fallow'), [])
+        self.assertEqual(len(self.outputs('M')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
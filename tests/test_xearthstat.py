@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+"""Tests for the aggregation options of the xEarthStat workflow."""
+
+
+import unittest
+
+from earthstat.xearthstat import xEarthStat
+
+
+class TestAggregationOptions(unittest.TestCase):
+    """Options of another dataset type are rejected instead of ignored."""
+
+    def test_unsupported_options(self):
+        unsupported = [
+            ('dekadal', {'time_block': 30}),
+            ('dekadal', {'incremental': True}),
+            ('dekadal', {'periods': ['M']}),
+            ('daily', {'aggregate_first': True}),
+            ('daily', {'partial_periods': True}),
+            ('temporal', {'incremental': True}),
+            ('temporal', {'aggregate_first': True}),
+        ]
+
+        for dataset_type, options in unsupported:
+            with self.subTest(dataset_type=dataset_type, options=options):
+                with self.assertRaises(ValueError):
+                    xEarthStat().Aggregate_AgERA5(dataset_type=dataset_type, **options)
+
+
+if __name__ == '__main__':
+    unittest.main()
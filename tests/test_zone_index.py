@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""Tests for the zone_index aggregation engine."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+from rasterio.mask import mask
+from shapely.geometry import box
+
+from earthstat.analysis_aggregation.aggregate_process import (
+    conAggregate, process_and_aggregate_raster)
+from earthstat.analysis_aggregation.output_sink import readOutput
+from earthstat.analysis_aggregation.zone_index import (
+    ZoneIndex, zonal_max, zonal_mean, zonal_min, zonal_sum)
+from tests.synthetic import DATES, sort_rows, write_archive
+
+
+CALCULATION_MODES = [
+    ('overall_mean', False),
+    ('weighted_mean', True),
+    ('filtered_mean', True),
+]
+
+
+class TestZoneIndex(unittest.TestCase):
+    """Tests for `ZoneIndex` and its zonal reductions."""
+
+    def setUp(self):
+        # Two zones on a 4 x 4 grid of unit pixels, and a zone outside the grid
+        self.zone_index = ZoneIndex.from_geometries(
+            [box(0, 2, 2, 4), box(1, 0, 4, 2), box(10, 10, 11, 11)],
+            Affine(1, 0, 0, 0, -1, 4), (4, 4))
+
+    def test_pixels(self):
+        self.assertEqual(list(self.zone_index.counts), [4, 6, 0])
+
+        grid = np.arange(16, dtype='float64').reshape(4, 4)
+        values = self.zone_index.gather_grid(grid)
+        self.assertEqual(sorted(values[:4]), [0, 1, 4, 5])
+        self.assertEqual(sorted(values[4:]), [9, 10, 11, 13, 14, 15])
+
+    def test_reductions_skip_nan(self):
+        grid = np.arange(16, dtype='float64').reshape(4, 4)
+        grid[0, 0] = np.nan
+        values = self.zone_index.gather_grid(grid)
+
+        np.testing.assert_allclose(zonal_mean(values, self.zone_index),
+                                   [10 / 3, 12, np.nan])
+        np.testing.assert_allclose(zonal_sum(values, self.zone_index), [10, 72, 0])
+        np.testing.assert_allclose(zonal_min(values, self.zone_index), [1, 9, np.nan])
+        np.testing.assert_allclose(zonal_max(values, self.zone_index), [5, 15, np.nan])
+
+
+class TestZoneIndexEngine(unittest.TestCase):
+    """The zone_index engine matches the per-geometry masks of `process_and_aggregate_raster`."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.predictor_dir, cls.shapefile_path = write_archive(cls.root)
+        cls.mask_path = os.path.join(cls.root, 'mask.tif')
+        cls.shape_file = gpd.read_file(cls.shapefile_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def expected(self, calculation_mode, use_mask, all_touched):
+        rows = []
+        for date in DATES:
+            rows.extend(process_and_aggregate_raster(
+                os.path.join(self.predictor_dir, f'fpar_{date}.tif'), self.shape_file,
+                invalid_values=[251], use_mask=use_mask, mask_path=self.mask_path,
+                calculation_mode=calculation_mode, predictor_name='fpar',
+                all_touched=all_touched))
+
+        return sort_rows(pd.DataFrame(rows))
+
+    def test_calculation_modes(self):
+        for calculation_mode, use_mask in CALCULATION_MODES:
+            for all_touched in (False, True):
+                with self.subTest(calculation_mode=calculation_mode,
+                                  all_touched=all_touched):
+                    output_path = os.path.join(
+                        self.root, f'{calculation_mode}_{all_touched}.csv')
+                    conAggregate(self.predictor_dir, self.shapefile_path, output_path,
+                                 mask_path=self.mask_path, use_mask=use_mask,
+                                 invalid_values=[251], calculation_mode=calculation_mode,
+                                 predictor_name='fpar', all_touched=all_touched,
+                                 engine='zone_index', write_every=3)
+
+                    output = sort_rows(readOutput(output_path))
+                    expected = self.expected(calculation_mode, use_mask, all_touched)
+
+                    self.assertEqual(list(output['NAME']), list(expected['NAME']))
+                    self.assertEqual(list(output['date'].astype(str)),
+                                     list(expected['date'].astype(str)))
+                    # The output is rounded to 3 decimals
+                    np.testing.assert_allclose(output['fpar'], expected['fpar'], atol=1e-3)
+
+    def test_statistics(self):
+        """Several statistics are written in one pass, the counts as integers."""
+        output_path = os.path.join(self.root, 'statistics.csv')
+        conAggregate(self.predictor_dir, self.shapefile_path, output_path,
+                     invalid_values=[251], predictor_name='fpar',
+                     stats=['mean', 'count', 'max'])
+        output = sort_rows(readOutput(output_path))
+
+        expected = self.expected('overall_mean', False, False)
+        np.testing.assert_allclose(output['fpar_mean'], expected['fpar'], atol=1e-3)
+        self.assertTrue(pd.api.types.is_integer_dtype(output['fpar_count']))
+
+        # Valid pixels of the geometries cropped like `process_and_aggregate_raster`
+        counts = []
+        for date in DATES:
+            raster_path = os.path.join(self.predictor_dir, f'fpar_{date}.tif')
+            with rasterio.open(raster_path) as src:
+                for name, geometry in zip(self.shape_file['NAME'],
+                                          self.shape_file.geometry):
+                    values, _ = mask(src, [geometry], crop=True, filled=False)
+                    valid = ~values.mask & (values != 251)
+                    counts.append(
+                        {'date': int(date), 'NAME': name, 'count': int(valid.sum())})
+
+        expected_counts = sort_rows(pd.DataFrame(counts))['count']
+        self.assertEqual(list(output['fpar_count']), list(expected_counts))
+
+    def test_invalid_engine(self):
+        with self.assertRaises(ValueError):
+            conAggregate(self.predictor_dir, self.shapefile_path,
+                         os.path.join(self.root, 'invalid.csv'), engine='pixels')
+
+
+if __name__ == '__main__':
+    unittest.main()